@@ -7,46 +7,82 @@ License: MIT
 """
 
 import os
+import re
 import sys
+import copy
+import errno
+import atexit
+import io
 import json
+import gzip
+import math
+import base64
+import bisect
 import time
 import yaml
 import uuid
+import fcntl
 import shutil
 import socket
+import struct
 import hashlib
+import heapq
+import hmac
+import queue
+import ipaddress
 import logging
+import logging.handlers
 import sqlite3
 import argparse
+import tempfile
+import itertools
 import subprocess
 import threading
 import urllib.parse
 from pathlib import Path
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Tuple, Any
+from typing import Dict, List, Optional, Tuple, Any, Iterable, Iterator
 from functools import wraps
+from collections import deque
 from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, Future, wait, as_completed, TimeoutError as FutureTimeoutError
 
 # Flask及扩展
-from flask import Flask, request, jsonify, send_file, Response, g
+from flask import Flask, request, jsonify, send_file, Response, g, has_request_context
 from flask_cors import CORS
 import jwt
 import bcrypt
 import requests
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import jeepney
+    import jeepney.io.blocking
+except ImportError:
+    jeepney = None
+
 # ==================== 配置常量 ====================
 VERSION = "2.0.0"
-BASE_DIR = Path("/opt/hysteria2-manager")
-DATA_DIR = BASE_DIR / "data"
-LOG_DIR = Path("/var/log/hysteria2")
+# 目录可通过环境变量覆盖（测试脚本用临时目录运行，不影响正在使用的数据）
+BASE_DIR = Path(os.environ.get('HY2_MANAGER_BASE_DIR', '/opt/hysteria2-manager'))
+DATA_DIR = Path(os.environ.get('HY2_MANAGER_DATA_DIR', str(BASE_DIR / "data")))
+LOG_DIR = Path(os.environ.get('HY2_MANAGER_LOG_DIR', '/var/log/hysteria2'))
 STATIC_DIR = BASE_DIR / "static"
 HYSTERIA_BIN = Path("/usr/local/bin/hysteria")
-HYSTERIA_CONFIG = Path("/etc/hysteria2/client.yaml")
+HYSTERIA_CONFIG = Path(os.environ.get('HY2_MANAGER_CLIENT_CONFIG', '/etc/hysteria2/client.yaml'))
 CONFIG_FILE = DATA_DIR / "config.json"
 USERS_FILE = DATA_DIR / "users.json"
 NODES_FILE = DATA_DIR / "nodes.json"
 STATS_FILE = DATA_DIR / "stats.json"
+BENCHMARK_FILE = DATA_DIR / "benchmarks.json"
 SESSIONS_FILE = DATA_DIR / "sessions.json"
+DB_FILE = DATA_DIR / "manager.db"
+LEADER_LOCK_FILE = DATA_DIR / "manager.lock"
+SERVICE_LOCK_FILE = DATA_DIR / "service.lock"
 
 # JWT配置
 JWT_SECRET_KEY = os.environ.get('JWT_SECRET', 'hysteria2-manager-secret-key-change-me')
@@ -67,12 +103,85 @@ DEFAULT_CONFIG = {
     "hysteria": {
         "bin_path": str(HYSTERIA_BIN),
         "config_path": str(HYSTERIA_CONFIG),
-        "log_level": "info"
+        "log_level": "info",
+        "switch_mode": "fast"      # fast: 单次restart; restart: 停止-等待-启动
     },
     "system": {
         "auto_start": True,
         "auto_optimize": True,
         "check_update": True
+    },
+    "monitor": {
+        "service_interval": 5,      # 服务状态刷新间隔(秒)
+        "connection_interval": 300, # 连接测试刷新间隔(秒)，只在有人查看状态时执行
+        "traffic_interval": 5,      # 流量统计刷新间隔(秒)
+        "status_backend": "auto"    # 服务状态查询方式: auto/dbus/cgroup/command
+    },
+    "benchmark": {
+        "samples": 5,               # 每个节点的UDP探测次数
+        "timeout": 1.0,             # 单次探测超时(秒)
+        "concurrency": 16,          # 并发测试的节点数
+        "history_size": 20,         # 每个节点保留的历史记录数
+        "download_url": "https://speed.cloudflare.com/__down?bytes=10000000",
+        "download_timeout": 10,     # 下载测速超时(秒)
+        "bind_interface": "auto"    # 探测绕过TUN所用的出口网卡，auto为默认路由网卡
+    },
+    "subscription": {
+        "timeout": 10,              # 下载超时(秒)
+        "max_bytes": 8 * 1024 * 1024,  # 订阅内容大小上限
+        "interval": 3600,           # 新建订阅的默认刷新间隔(秒)
+        "check_interval": 60        # 检查到期订阅的间隔(秒)
+    },
+    "persistence": {
+        "mode": "batched",          # batched: 合并延迟写入; sync: 每次修改立即写入并fsync
+        "debounce": 0.5             # batched 模式下的合并延迟(秒)
+    },
+    "log_rotation": {
+        "max_bytes": 10 * 1024 * 1024,  # 单个日志文件超过该大小时轮转
+        "interval": 86400,          # 日志文件最长使用时间(秒)，到期即使未满也轮转
+        "compression": "gzip",      # 归档压缩格式: gzip / zstd（需安装 zstandard）
+        "max_files": 14,            # 每个来源最多保留的归档数
+        "max_age_days": 30,         # 归档最长保留天数
+        "max_total_bytes": 200 * 1024 * 1024,  # 所有归档的总大小上限
+        "check_interval": 60        # 检查是否需要轮转的间隔(秒)
+    },
+    "config_cache": {
+        "keep": 5                   # 保留最近应用过的客户端配置份数（用于回滚）
+    },
+    "dns": {
+        "ttl": 300,                 # 解析结果缓存时间(秒)
+        "negative_ttl": 30,         # 解析失败的缓存时间(秒)
+        "timeout": 2.0,             # 首次解析的最长等待时间(秒)
+        "refresh_interval": 60      # 后台预解析节点域名的间隔(秒)
+    },
+    "jobs": {
+        "workers": 4,               # 后台任务线程数
+        "max_queued": 32,           # 排队任务上限，超出时返回429
+        "keep_seconds": 3600        # 已结束任务的保留时间(秒)
+    },
+    "tracing": {
+        "enabled": False,           # 记录每个请求的分段耗时（run_command、HTTP、DNS、文件写入）
+        "slow_requests": 50,        # 保留最慢的请求数
+        "min_duration_ms": 0,       # 低于该耗时的请求不进入慢请求列表
+        "profiler": False           # 是否允许 /api/debug/profile 采样分析
+    },
+    "metrics": {
+        "enabled": True,            # 是否开放 /metrics
+        "token": "",                # 非空时抓取需携带 Authorization: Bearer <token>
+        "allow_remote": False       # 未设置token时是否允许非本机地址抓取
+    },
+    "streams": {
+        "max_per_worker": 4,        # 每个worker同时打开的SSE连接上限，超出时返回503
+        "retry_after": 10           # 503响应建议客户端重试的间隔(秒)
+    },
+    "failover": {
+        "enabled": False,           # 是否启用自动切换
+        "interval": 60,             # 评估间隔(秒)
+        "min_score": 40,            # 当前节点低于该得分视为降级
+        "fail_threshold": 2,        # 连续降级次数达到后才切换
+        "hysteresis": 15,           # 候选节点需领先的分数
+        "cooldown": 300,            # 两次切换的最小间隔(秒)
+        "candidates": 5             # 需要切换时重新测速的候选节点数
     }
 }
 
@@ -85,7 +194,10 @@ DEFAULT_USER = {
 
 # ==================== 日志配置 ====================
 class ColoredFormatter(logging.Formatter):
-    """彩色日志格式化器"""
+    """彩色日志格式化器（仅用于控制台）
+    
+    在记录的副本上着色，不修改原记录，其他处理器不会拿到带颜色转义码的级别名。
+    """
     
     COLORS = {
         'DEBUG': '\033[36m',    # Cyan
@@ -98,9 +210,89 @@ class ColoredFormatter(logging.Formatter):
     
     def format(self, record):
         log_color = self.COLORS.get(record.levelname, self.RESET)
+        record = copy.copy(record)
         record.levelname = f"{log_color}{record.levelname}{self.RESET}"
         return super().format(record)
 
+class JsonFormatter(logging.Formatter):
+    """JSON行格式化器（用于日志文件）"""
+    
+    FIELDS = ("request_id", "method", "endpoint", "status", "duration_ms", "node_id")
+    
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage()
+        }
+        for field in self.FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+class RequestContextFilter(logging.Filter):
+    """在产生日志的线程中附加请求上下文（请求ID、方法、路径、节点ID）"""
+    
+    def filter(self, record):
+        if has_request_context():
+            if getattr(record, 'request_id', None) is None:
+                record.request_id = g.get('request_id')
+            if getattr(record, 'endpoint', None) is None:
+                record.method = request.method
+                record.endpoint = request.path
+            if getattr(record, 'node_id', None) is None and request.view_args:
+                record.node_id = request.view_args.get('node_id')
+        return True
+
+class PreparedQueueHandler(logging.handlers.QueueHandler):
+    """只合并消息参数、预先格式化异常堆栈，不套用格式，保留原始级别与上下文字段"""
+    
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+class LogPipeline:
+    """非阻塞日志管道
+    
+    根日志器只挂一个 QueueHandler，调用方只把记录放入队列；
+    由 QueueListener 线程格式化并写入控制台（彩色文本）与日志文件（JSON行）。
+    fork 出的子进程（gunicorn worker）中监听线程不存在，需要换新队列重新启动。
+    """
+    
+    def __init__(self, handlers: List[logging.Handler]):
+        self.handlers = handlers
+        self.queue_handler = PreparedQueueHandler(queue.Queue(-1))
+        self.queue_handler.addFilter(RequestContextFilter())
+        self.listener = None
+    
+    def start(self):
+        self.listener = logging.handlers.QueueListener(
+            self.queue_handler.queue, *self.handlers, respect_handler_level=True
+        )
+        self.listener.start()
+    
+    def stop(self):
+        """写出队列中剩余的日志"""
+        if self.listener:
+            self.listener.stop()
+            self.listener = None
+    
+    def restart_after_fork(self):
+        self.queue_handler.queue = queue.Queue(-1)
+        self.listener = None
+        self.start()
+
 def setup_logging():
     """配置日志系统"""
     log_format = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
@@ -108,39 +300,346 @@ def setup_logging():
     # 控制台处理器（彩色）
     console_handler = logging.StreamHandler()
     console_handler.setFormatter(ColoredFormatter(log_format))
+    console_handler.addFilter(lambda record: record.name != f"{__name__}.access")
     
-    # 文件处理器
+    # 文件处理器：JSON行；文件被 LogArchive 轮转（重命名）后自动重新打开，多个worker进程可共用
     LOG_DIR.mkdir(parents=True, exist_ok=True)
-    file_handler = logging.FileHandler(LOG_DIR / "manager.log")
-    file_handler.setFormatter(logging.Formatter(log_format))
+    file_handler = logging.handlers.WatchedFileHandler(LOG_DIR / "manager.log", encoding='utf-8')
+    file_handler.setFormatter(JsonFormatter())
+    
+    global log_pipeline
+    log_pipeline = LogPipeline([console_handler, file_handler])
+    log_pipeline.start()
+    atexit.register(log_pipeline.stop)
+    os.register_at_fork(after_in_child=log_pipeline.restart_after_fork)
     
     # 配置根日志器
     logging.basicConfig(
         level=logging.INFO,
-        handlers=[console_handler, file_handler]
+        handlers=[log_pipeline.queue_handler]
     )
     
+    # 访问日志只写入文件，不输出到控制台和实时日志
+    access_logger = logging.getLogger(f"{__name__}.access")
+    access_logger.propagate = False
+    access_logger.addHandler(log_pipeline.queue_handler)
+    
     return logging.getLogger(__name__)
 
 logger = setup_logging()
+access_logger = logging.getLogger(f"{__name__}.access")
+
+# ==================== 运行指标 ====================
+class MetricsRegistry:
+    """Prometheus 文本格式的运行指标
+
+    计数器与直方图保存在内存中，记录一次只是在锁内做几次加法。
+    多worker部署时各进程把自己的快照写入SQLite，/metrics 汇总所有进程的快照；
+    流量、TUN状态、当前节点等瞬时值在抓取时由 collector 现场读取。
+    """
+    
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.families = {}
+        self.values = {}
+        self.collectors = []
+        self.version = 0
+    
+    def counter(self, name: str, help_text: str, labels: Tuple[str, ...] = ()):
+        self.families[name] = {"type": "counter", "help": help_text, "labels": labels}
+        # 无标签的计数器从0开始输出，便于直接计算 rate()
+        self.values[name] = {} if labels else {(): 0.0}
+    
+    def histogram(self, name: str, help_text: str, labels: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.families[name] = {"type": "histogram", "help": help_text, "labels": labels, "buckets": buckets}
+        self.values[name] = {}
+    
+    def add_collector(self, collector):
+        """注册抓取时调用的采集函数，返回 [(名称, 类型, 说明, [(标签, 值), ...]), ...]"""
+        self.collectors.append(collector)
+    
+    def inc(self, name: str, labels: Tuple[str, ...] = (), amount: float = 1.0):
+        with self.lock:
+            series = self.values[name]
+            series[labels] = series.get(labels, 0.0) + amount
+            self.version += 1
+    
+    def observe(self, name: str, labels: Tuple[str, ...], value: float):
+        """记录一次观测值；每个序列保存 [各桶计数..., +Inf桶计数, 总和, 次数]"""
+        buckets = self.families[name]["buckets"]
+        with self.lock:
+            series = self.values[name]
+            entry = series.get(labels)
+            if entry is None:
+                entry = series[labels] = [0] * (len(buckets) + 1) + [0.0, 0]
+            entry[bisect.bisect_left(buckets, value)] += 1
+            entry[-2] += value
+            entry[-1] += 1
+            self.version += 1
+    
+    def snapshot(self) -> Dict[str, List[List[Any]]]:
+        """导出可JSON序列化的快照"""
+        with self.lock:
+            return {
+                name: [[list(labels), list(value) if isinstance(value, list) else value]
+                       for labels, value in series.items()]
+                for name, series in self.values.items()
+            }
+    
+    def merge(self, snapshots: Iterable[Dict[str, List[List[Any]]]]) -> Dict[str, Dict[tuple, Any]]:
+        """按标签累加多个进程的快照"""
+        merged = {name: {} for name in self.families}
+        for snapshot in snapshots:
+            for name, series in snapshot.items():
+                if name not in merged:
+                    continue
+                target = merged[name]
+                for labels, value in series:
+                    labels = tuple(labels)
+                    if isinstance(value, list):
+                        current = target.get(labels)
+                        target[labels] = value if current is None else [a + b for a, b in zip(current, value)]
+                    else:
+                        target[labels] = target.get(labels, 0.0) + value
+        return merged
+    
+    @staticmethod
+    def format_labels(labels: Dict[str, Any]) -> str:
+        if not labels:
+            return ""
+        pairs = []
+        for key, value in labels.items():
+            value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            pairs.append(f'{key}="{value}"')
+        return "{" + ",".join(pairs) + "}"
+    
+    @staticmethod
+    def format_value(value: float) -> str:
+        if isinstance(value, float) and value.is_integer():
+            return str(int(value))
+        return repr(value)
+    
+    def render(self, snapshots: Optional[Iterable[Dict[str, List[List[Any]]]]] = None) -> str:
+        """生成 Prometheus 文本格式；提供 snapshots 时汇总多个进程"""
+        values = self.merge(snapshots) if snapshots is not None else self.merge([self.snapshot()])
+        lines = []
+        for name, family in self.families.items():
+            lines.append(f"# HELP {name} {family['help']}")
+            lines.append(f"# TYPE {name} {family['type']}")
+            for labels, value in sorted(values[name].items()):
+                label_map = dict(zip(family["labels"], labels))
+                if family["type"] == "counter":
+                    lines.append(f"{name}{self.format_labels(label_map)} {self.format_value(value)}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(family["buckets"] + (float('inf'),), value):
+                    cumulative += count
+                    le = "+Inf" if bound == float('inf') else self.format_value(bound)
+                    lines.append(f"{name}_bucket{self.format_labels(dict(label_map, le=le))} {cumulative}")
+                lines.append(f"{name}_sum{self.format_labels(label_map)} {self.format_value(value[-2])}")
+                lines.append(f"{name}_count{self.format_labels(label_map)} {value[-1]}")
+        
+        for collector in self.collectors:
+            try:
+                families = collector()
+            except Exception as e:
+                logger.warning(f"指标采集失败: {e}")
+                continue
+            for name, metric_type, help_text, samples in families:
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {metric_type}")
+                for labels, value in samples:
+                    lines.append(f"{name}{self.format_labels(labels)} {self.format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+metrics_registry = MetricsRegistry()
+metrics_registry.counter("hysteria2_manager_http_requests_total", "HTTP请求数", ("route", "method", "status"))
+metrics_registry.histogram("hysteria2_manager_http_request_duration_seconds", "HTTP请求耗时", ("route", "method"))
+metrics_registry.counter("hysteria2_manager_subprocess_calls_total", "系统命令调用次数", ("command", "result"))
+metrics_registry.histogram("hysteria2_manager_subprocess_duration_seconds", "系统命令执行耗时", ("command",))
+metrics_registry.histogram("hysteria2_manager_persistence_flush_duration_seconds", "持久化写入耗时",
+                           buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0))
+metrics_registry.counter("hysteria2_manager_persistence_bytes_written_total", "持久化写入字节数")
+metrics_registry.counter("hysteria2_manager_persistence_errors_total", "持久化写入失败次数")
+
+# ==================== 请求追踪 ====================
+class RequestTracer:
+    """请求级耗时追踪（按需开启）
+
+    开启后每个请求在线程局部变量中记录一个 trace，run_command、HTTP请求、DNS解析、
+    文件写入等操作通过 span() 记录各自的耗时；请求结束时按总耗时保留最慢的N个请求。
+    未开启或不在请求线程中时 span() 不做任何记录。
+    """
+    
+    MAX_SPANS = 200
+    
+    def __init__(self):
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.slowest = []
+        self.sequence = itertools.count()
+    
+    def begin(self, record: Dict[str, Any], started: Optional[float] = None):
+        """开始记录当前线程的请求，started 为请求开始时的 perf_counter"""
+        record["spans"] = []
+        record["started"] = started if started is not None else time.perf_counter()
+        self.local.trace = record
+    
+    def current(self) -> Optional[Dict[str, Any]]:
+        return getattr(self.local, 'trace', None)
+    
+    def finish(self, keep: int, min_duration_ms: float = 0, **fields) -> Optional[Dict[str, Any]]:
+        """结束当前请求的 trace，耗时进入前 keep 名时保留"""
+        trace = self.current()
+        self.local.trace = None
+        if trace is None:
+            return None
+        trace.update(fields)
+        trace["spans"].sort(key=lambda span: span["start_ms"])
+        trace["duration_ms"] = round((time.perf_counter() - trace.pop("started")) * 1000, 2)
+        if trace["duration_ms"] < min_duration_ms:
+            return trace
+        
+        with self.lock:
+            item = (trace["duration_ms"], next(self.sequence), trace)
+            if len(self.slowest) < keep:
+                heapq.heappush(self.slowest, item)
+            elif self.slowest and item[0] > self.slowest[0][0]:
+                heapq.heapreplace(self.slowest, item)
+            while len(self.slowest) > keep:
+                heapq.heappop(self.slowest)
+        return trace
+    
+    def record_span(self, kind: str, started: float, detail: str = ""):
+        """记录一段已经结束的操作（started 为开始时的 perf_counter）"""
+        trace = self.current()
+        if trace is None or len(trace["spans"]) >= self.MAX_SPANS:
+            return
+        trace["spans"].append({
+            "kind": kind,
+            "detail": detail[:200],
+            "thread": threading.current_thread().name,
+            "start_ms": round((started - trace["started"]) * 1000, 2),
+            "duration_ms": round((time.perf_counter() - started) * 1000, 2)
+        })
+    
+    def discard(self):
+        self.local.trace = None
+    
+    @contextmanager
+    def span(self, kind: str, detail: str = ""):
+        """记录一段操作的耗时"""
+        trace = self.current()
+        if trace is None:
+            yield
+            return
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_span(kind, started, detail)
+    
+    def bind(self, func):
+        """把当前请求的 trace 传递给线程池中执行的函数"""
+        trace = self.current()
+        if trace is None:
+            return func
+        
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            previous = self.current()
+            self.local.trace = trace
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.local.trace = previous
+        return wrapper
+    
+    def get_slowest(self) -> List[Dict[str, Any]]:
+        with self.lock:
+            items = sorted(self.slowest, key=lambda item: item[0], reverse=True)
+        return [item[2] for item in items]
+    
+    def clear(self):
+        with self.lock:
+            self.slowest = []
+
+class SamplingProfiler:
+    """按需的采样分析器
+
+    在指定时长内定期读取所有线程的调用栈（sys._current_frames），
+    输出 flamegraph.pl / speedscope 可直接读取的折叠栈格式："线程;帧;帧 次数"。
+    同一时间只允许一次采样。
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+    
+    @staticmethod
+    def frame_label(frame) -> str:
+        code = frame.f_code
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+    
+    def profile(self, seconds: float, interval: float) -> Optional[Tuple[str, int]]:
+        """采样 seconds 秒，返回 (折叠栈文本, 采样次数)；已有采样在进行时返回None"""
+        if not self.lock.acquire(blocking=False):
+            return None
+        try:
+            stacks = {}
+            samples = 0
+            own = threading.get_ident()
+            deadline = time.monotonic() + seconds
+            while time.monotonic() < deadline:
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+                for ident, frame in sys._current_frames().items():
+                    if ident == own:
+                        continue
+                    labels = []
+                    while frame is not None:
+                        labels.append(self.frame_label(frame))
+                        frame = frame.f_back
+                    labels.append(names.get(ident, f"thread-{ident}"))
+                    key = ";".join(reversed(labels))
+                    stacks[key] = stacks.get(key, 0) + 1
+                samples += 1
+                time.sleep(interval)
+            lines = [f"{stack} {count}" for stack, count in sorted(stacks.items(), key=lambda item: -item[1])]
+            return "\n".join(lines) + "\n", samples
+        finally:
+            self.lock.release()
+
+tracer = RequestTracer()
 
 # ==================== 工具函数 ====================
 def run_command(cmd: List[str], timeout: int = 30) -> Tuple[int, str, str]:
     """执行系统命令"""
+    command = os.path.basename(cmd[0]) if cmd else ""
+    started = time.perf_counter()
+    outcome = "error"
     try:
-        result = subprocess.run(
-            cmd,
-            capture_output=True,
-            text=True,
-            timeout=timeout
-        )
+        with tracer.span("command", " ".join(cmd)):
+            result = subprocess.run(
+                cmd,
+                capture_output=True,
+                text=True,
+                timeout=timeout
+            )
+        outcome = "ok" if result.returncode == 0 else "failed"
         return result.returncode, result.stdout, result.stderr
     except subprocess.TimeoutExpired:
+        outcome = "timeout"
         logger.error(f"命令超时: {' '.join(cmd)}")
         return -1, "", "Command timeout"
     except Exception as e:
         logger.error(f"命令执行失败: {e}")
         return -1, "", str(e)
+    finally:
+        metrics_registry.inc("hysteria2_manager_subprocess_calls_total", (command, outcome))
+        metrics_registry.observe("hysteria2_manager_subprocess_duration_seconds", (command,),
+                                 time.perf_counter() - started)
 
 def ensure_dirs():
     """确保必要目录存在"""
@@ -156,81 +655,888 @@ def load_json_file(filepath: Path, default: Any = None) -> Any:
                 return json.load(f)
     except Exception as e:
         logger.error(f"加载JSON文件失败 {filepath}: {e}")
-    return default if default is not None else {}
+    # 返回默认值的副本，避免调用方修改全局默认配置
+    return copy.deepcopy(default) if default is not None else {}
 
-def save_json_file(filepath: Path, data: Any) -> bool:
-    """保存JSON文件"""
-    try:
+def write_file_atomic(filepath: Path, payload: bytes):
+    """原子写入文件（写入临时文件并fsync后重命名，中途崩溃不会留下半个文件）"""
+    with tracer.span("file", str(filepath)):
         filepath.parent.mkdir(parents=True, exist_ok=True)
-        with open(filepath, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=2, ensure_ascii=False)
+        fd, tmp_path = tempfile.mkstemp(dir=str(filepath.parent), prefix=f".{filepath.name}.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(payload)
+                f.flush()
+                os.fsync(f.fileno())
+            mode = filepath.stat().st_mode & 0o777 if filepath.exists() else 0o644
+            os.chmod(tmp_path, mode)
+            os.replace(tmp_path, filepath)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+    
+        # 确保重命名本身落盘
+        dir_fd = os.open(str(filepath.parent), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+def dump_json(data: Any, pretty: bool = False) -> bytes:
+    """序列化JSON，默认使用紧凑格式"""
+    if pretty:
+        return json.dumps(data, indent=2, ensure_ascii=False).encode('utf-8')
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+def save_json_file(filepath: Path, data: Any, pretty: bool = True) -> bool:
+    """原子保存JSON文件"""
+    try:
+        write_file_atomic(filepath, dump_json(data, pretty))
         return True
     except Exception as e:
         logger.error(f"保存JSON文件失败 {filepath}: {e}")
         return False
 
-def get_server_ip(domain: str) -> str:
-    """解析域名为IP地址"""
-    try:
-        # 检查是否已是IP地址
-        socket.inet_aton(domain)
-        return domain
-    except socket.error:
-        # 解析域名
+class RWLock:
+    """读写锁：多个读者可并发持有，写者独占；有写者等待时新读者让行"""
+    
+    def __init__(self):
+        self.cond = threading.Condition(threading.Lock())
+        self.readers = 0
+        self.writer = False
+        self.waiting_writers = 0
+    
+    @contextmanager
+    def read(self):
+        with self.cond:
+            while self.writer or self.waiting_writers:
+                self.cond.wait()
+            self.readers += 1
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.readers -= 1
+                if self.readers == 0:
+                    self.cond.notify_all()
+    
+    @contextmanager
+    def write(self):
+        with self.cond:
+            self.waiting_writers += 1
+            while self.writer or self.readers:
+                self.cond.wait()
+            self.waiting_writers -= 1
+            self.writer = True
         try:
-            ip = socket.gethostbyname(domain)
-            logger.info(f"域名解析: {domain} -> {ip}")
-            return ip
-        except socket.gaierror:
-            logger.warning(f"域名解析失败: {domain}")
-            return domain
+            yield
+        finally:
+            with self.cond:
+                self.writer = False
+                self.cond.notify_all()
 
-def get_network_traffic() -> Dict[str, int]:
-    """获取网络流量统计（简化版本）"""
-    try:
-        # 读取网络接口统计
-        with open('/proc/net/dev', 'r') as f:
-            lines = f.readlines()
+class PersistenceWriter:
+    """后台持久化写入器
+
+    两种持久化模式：
+    - batched（默认）：submit() 只把文件标记为待写入并立即返回。首次标记后等待
+      debounce 秒再由写入线程一次性写出，期间的多次提交合并为一次写入
+    - sync：submit() 在调用线程中立即写入并fsync后返回
+    两种模式都通过临时文件+重命名原子写入；进程退出时 flush() 立即写出所有待写数据。
+    提交的数据此后不能再被修改（调用方传入副本或不可变快照）。
+    """
+    
+    def __init__(self, mode: str = "batched", debounce: float = 0.5):
+        self.mode = mode
+        self.debounce = debounce
+        self.pending = {}
+        self.cond = threading.Condition()
+        self.write_lock = threading.Lock()
+        self.busy = False
+        self.flush_now = False
+        self.thread = None
+        self.metrics = {
+            "submits": 0,
+            "flushes": 0,
+            "bytes_written": 0,
+            "errors": 0,
+            "flush_ms_total": 0.0,
+            "flush_ms_max": 0.0,
+            "last_flush_ms": 0.0,
+            "last_flush_at": None
+        }
+    
+    def configure(self, mode: Optional[str] = None, debounce: Optional[float] = None):
+        """调整持久化模式与合并延迟"""
+        if mode in ("sync", "batched"):
+            self.mode = mode
+        if debounce is not None:
+            self.debounce = max(0.0, float(debounce))
+        if self.mode == "sync":
+            self.flush()
+    
+    def submit(self, filepath: Path, data: Any, on_written=None, pretty: bool = False):
+        """提交写入请求，on_written 在写入成功后调用；pretty 为真时保留缩进格式（供人工编辑的文件）"""
+        with self.cond:
+            self.metrics["submits"] += 1
+            if self.mode == "sync":
+                self.pending.pop(filepath, None)
+        
+        if self.mode == "sync":
+            if self._write(filepath, data, pretty):
+                if on_written:
+                    on_written()
+            return
+        
+        with self.cond:
+            _, callbacks, _, due = self.pending.get(filepath, (None, [], pretty, time.monotonic() + self.debounce))
+            if on_written:
+                callbacks.append(on_written)
+            self.pending[filepath] = (data, callbacks, pretty, due)
+            # 线程按需启动（fork出的worker进程中需要重新启动）
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name="persistence", daemon=True)
+                self.thread.start()
+            self.cond.notify_all()
+    
+    def is_pending(self, filepath: Path) -> bool:
+        """文件是否有尚未完成的写入"""
+        with self.cond:
+            return filepath in self.pending or self.busy
+    
+    def flush(self, timeout: float = 10.0) -> bool:
+        """立即写出所有待写入数据并等待完成（退出前调用）"""
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            self.flush_now = True
+            self.cond.notify_all()
+            try:
+                while self.pending or self.busy:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or self.thread is None or not self.thread.is_alive():
+                        return False
+                    self.cond.wait(remaining)
+            finally:
+                self.flush_now = False
+        return True
+    
+    def get_metrics(self) -> Dict[str, Any]:
+        """写入统计：提交次数、实际写入次数、写入字节数与耗时"""
+        with self.cond:
+            metrics = dict(self.metrics, mode=self.mode, debounce=self.debounce, pending=len(self.pending))
+        flushes = metrics["flushes"]
+        metrics["flush_ms_avg"] = round(metrics["flush_ms_total"] / flushes, 2) if flushes else 0.0
+        metrics["coalesced"] = max(0, metrics["submits"] - flushes - metrics["errors"] - metrics["pending"])
+        return metrics
+    
+    def _write(self, filepath: Path, data: Any, pretty: bool) -> bool:
+        started = time.monotonic()
+        try:
+            payload = dump_json(data, pretty)
+            with self.write_lock:
+                write_file_atomic(filepath, payload)
+        except Exception as e:
+            logger.error(f"持久化写入失败 {filepath}: {e}")
+            with self.cond:
+                self.metrics["errors"] += 1
+            metrics_registry.inc("hysteria2_manager_persistence_errors_total")
+            return False
+        
+        duration = time.monotonic() - started
+        metrics_registry.observe("hysteria2_manager_persistence_flush_duration_seconds", (), duration)
+        metrics_registry.inc("hysteria2_manager_persistence_bytes_written_total", (), len(payload))
+        elapsed = round(duration * 1000, 2)
+        with self.cond:
+            self.metrics["flushes"] += 1
+            self.metrics["bytes_written"] += len(payload)
+            self.metrics["flush_ms_total"] += elapsed
+            self.metrics["flush_ms_max"] = max(self.metrics["flush_ms_max"], elapsed)
+            self.metrics["last_flush_ms"] = elapsed
+            self.metrics["last_flush_at"] = datetime.now().isoformat()
+        return True
+    
+    def _run(self):
+        while True:
+            with self.cond:
+                while True:
+                    if self.pending:
+                        filepath = min(self.pending, key=lambda path: self.pending[path][3])
+                        wait = self.pending[filepath][3] - time.monotonic()
+                        if wait <= 0 or self.flush_now:
+                            break
+                        self.cond.wait(wait)
+                    else:
+                        self.cond.wait()
+                data, callbacks, pretty, _ = self.pending.pop(filepath)
+                self.busy = True
+            try:
+                if self._write(filepath, data, pretty):
+                    for callback in callbacks:
+                        callback()
+            finally:
+                with self.cond:
+                    self.busy = False
+                    self.cond.notify_all()
+
+class DNSCache:
+    """节点域名解析缓存
+
+    解析在后台线程池中进行，单次解析有超时上限；结果按 TTL 缓存，解析失败也缓存较短时间。
+    过期的结果先继续使用，同时在后台刷新，因此切换节点不需要等待DNS。
+    后台线程定期预解析所有已保存节点的域名。返回全部 A / AAAA 记录。
+    预解析使用单独的小线程池，排队数不超过 PREFETCH_QUEUE：批量导入大量节点时
+    预解析不会阻塞切换节点等交互解析，超出的域名由定期预解析分批完成。
+    """
+    
+    PREFETCH_WORKERS = 2
+    PREFETCH_QUEUE = 64
+    BACKLOG_INTERVAL = 5
+    
+    def __init__(self, settings):
+        self.settings = settings
+        self.entries = {}
+        self.inflight = {}
+        self.prefetching = {}
+        self.lock = threading.Lock()
+        self.executors = {}
+        self.executor_pid = None
+        self.stats = {"hits": 0, "stale": 0, "misses": 0, "failures": 0, "timeouts": 0}
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.running = False
+    
+    @staticmethod
+    def literal(host: str) -> Optional[str]:
+        """host 本身是IP地址时返回规范形式"""
+        try:
+            return str(ipaddress.ip_address(host.strip('[]')))
+        except ValueError:
+            return None
+    
+    @staticmethod
+    def lookup(host: str) -> List[str]:
+        """阻塞解析，返回去重后的 IPv4 / IPv6 地址"""
+        addresses = []
+        for family, _, _, _, sockaddr in socket.getaddrinfo(host, None, type=socket.SOCK_STREAM):
+            if family in (socket.AF_INET, socket.AF_INET6) and sockaddr[0] not in addresses:
+                addresses.append(sockaddr[0])
+        return addresses
+    
+    def _refresh(self, host: str, inflight: Dict[str, Future]) -> List[str]:
+        settings = self.settings()
+        error = None
+        try:
+            addresses = self.lookup(host)
+        except (OSError, UnicodeError) as e:
+            addresses, error = [], str(e)
+        
+        ttl = float(settings["ttl"] if addresses else settings["negative_ttl"])
+        with self.lock:
+            self.entries[host] = {
+                "addresses": addresses,
+                "error": error,
+                "resolved_at": datetime.now().isoformat(),
+                "expires": time.monotonic() + ttl
+            }
+            inflight.pop(host, None)
+            if error:
+                self.stats["failures"] += 1
+        if error:
+            logger.warning(f"域名解析失败: {host}: {error}")
+        return addresses
+    
+    def refresh_async(self, host: str, prefetch: bool = False) -> Future:
+        """在后台解析 host，同一域名同时只解析一次；prefetch 为真时使用预解析线程池"""
+        inflight = self.prefetching if prefetch else self.inflight
+        with self.lock:
+            future = inflight.get(host)
+            if future is None:
+                # 线程池在首次使用时创建；fork出的worker进程中重新创建
+                if self.executor_pid != os.getpid():
+                    self.executors = {
+                        False: ThreadPoolExecutor(max_workers=8, thread_name_prefix="dns"),
+                        True: ThreadPoolExecutor(max_workers=self.PREFETCH_WORKERS, thread_name_prefix="dns-prefetch")
+                    }
+                    self.executor_pid = os.getpid()
+                future = self.executors[prefetch].submit(self._refresh, host, inflight)
+                inflight[host] = future
+            return future
+    
+    def resolve(self, host: str, wait: bool = True) -> List[str]:
+        """返回 host 的全部地址；只有从未解析过时才等待（最长 timeout 秒）"""
+        address = self.literal(host)
+        if address:
+            return [address]
+        
+        with self.lock:
+            entry = self.entries.get(host)
+            if entry and entry["expires"] > time.monotonic():
+                self.stats["hits"] += 1
+                return list(entry["addresses"])
         
-        total_bytes_sent = 0
-        total_bytes_recv = 0
+        if entry and entry["addresses"]:
+            # 已过期：先使用旧结果，后台刷新
+            with self.lock:
+                self.stats["stale"] += 1
+            self.refresh_async(host)
+            return list(entry["addresses"])
         
-        for line in lines[2:]:  # 跳过头部
+        with self.lock:
+            self.stats["misses"] += 1
+        future = self.refresh_async(host)
+        if not wait:
+            return []
+        with tracer.span("dns", host):
+            try:
+                return future.result(timeout=float(self.settings()["timeout"]))
+            except FutureTimeoutError:
+                with self.lock:
+                    self.stats["timeouts"] += 1
+                logger.warning(f"域名解析超时: {host}")
+                return []
+    
+    def prefetch(self, hosts: Iterable[str]) -> bool:
+        """后台解析尚未缓存或即将过期的域名；队列已满而有域名未提交时返回False"""
+        horizon = time.monotonic() + float(self.settings()["refresh_interval"])
+        for host in set(hosts):
+            if self.literal(host):
+                continue
+            with self.lock:
+                entry = self.entries.get(host)
+                queued = host in self.prefetching or host in self.inflight
+                full = len(self.prefetching) >= self.PREFETCH_QUEUE
+            if queued or (entry is not None and entry["expires"] > horizon):
+                continue
+            if full:
+                return False
+            self.refresh_async(host, prefetch=True)
+        return True
+    
+    def get_state(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        with self.lock:
+            entries = {
+                host: {
+                    "addresses": entry["addresses"],
+                    "error": entry["error"],
+                    "resolved_at": entry["resolved_at"],
+                    "ttl_remaining": round(entry["expires"] - now, 1)
+                }
+                for host, entry in self.entries.items()
+            }
+            return {"entries": entries, "stats": dict(self.stats), "inflight": len(self.inflight),
+                    "prefetching": len(self.prefetching)}
+    
+    def start(self, hosts):
+        """启动预解析线程，hosts 为返回当前所有节点域名的函数"""
+        if self.running:
+            return
+        self.running = True
+        self.hosts = hosts
+        self.thread = threading.Thread(target=self._run, name="dns-prefetch", daemon=True)
+        self.thread.start()
+    
+    def stop(self):
+        self.running = False
+        self.wakeup.set()
+    
+    def _run(self):
+        while self.running:
+            self.wakeup.clear()
+            interval = float(self.settings()["refresh_interval"])
+            try:
+                if not self.prefetch(self.hosts()):
+                    # 还有未提交的域名（如刚批量导入），稍后继续
+                    interval = min(interval, self.BACKLOG_INTERVAL)
+            except Exception as e:
+                logger.error(f"预解析节点域名失败: {e}")
+            self.wakeup.wait(interval)
+
+def read_net_dev() -> Dict[str, Tuple[int, int]]:
+    """读取 /proc/net/dev，返回 {网卡: (接收字节, 发送字节)}"""
+    counters = {}
+    with open('/proc/net/dev', 'r') as f:
+        for line in f.readlines()[2:]:  # 跳过头部
             if ':' in line:
-                parts = line.split(':')[1].split()
+                name, data = line.split(':', 1)
+                parts = data.split()
                 if len(parts) >= 9:
-                    total_bytes_recv += int(parts[0])
-                    total_bytes_sent += int(parts[8])
-        
+                    counters[name.strip()] = (int(parts[0]), int(parts[8]))
+    return counters
+
+def get_network_traffic() -> Dict[str, int]:
+    """获取网络流量统计（不含回环网卡）"""
+    try:
+        counters = read_net_dev()
         return {
-            "bytes_sent": total_bytes_sent,
-            "bytes_recv": total_bytes_recv
+            "bytes_sent": sum(tx for name, (_, tx) in counters.items() if name != "lo"),
+            "bytes_recv": sum(rx for name, (rx, _) in counters.items() if name != "lo")
         }
     except Exception as e:
         logger.error(f"获取网络流量失败: {e}")
         return {"bytes_sent": 0, "bytes_recv": 0}
 
+def count_tcp_connections() -> int:
+    """统计已建立的TCP连接数"""
+    count = 0
+    for path in ('/proc/net/tcp', '/proc/net/tcp6'):
+        try:
+            with open(path, 'r') as f:
+                next(f)
+                count += sum(1 for line in f if line.split()[3] == '01')
+        except (OSError, StopIteration, IndexError):
+            continue
+    return count
+
+class SystemStatus:
+    """服务与网卡状态查询
+
+    systemd 单元状态依次尝试 D-Bus（需要 jeepney）、cgroup 文件系统，最后才调用 systemctl；
+    网卡是否存在直接检查 /sys/class/net。某个后端出错后暂停使用 RETRY_INTERVAL 秒。
+    """
+    
+    BACKENDS = ("dbus", "cgroup", "command")
+    RETRY_INTERVAL = 60
+    DBUS_TIMEOUT = 2.0
+    CGROUP_ROOTS = ("/sys/fs/cgroup", "/sys/fs/cgroup/unified", "/sys/fs/cgroup/systemd")
+    
+    def __init__(self, preferred):
+        self.preferred = preferred
+        self.lock = threading.Lock()
+        self.connection = None
+        self.connection_pid = None
+        self.disabled_until = {}
+        self.last_backend = None
+    
+    def candidates(self) -> List[str]:
+        preferred = self.preferred()
+        backends = self.BACKENDS if preferred not in self.BACKENDS else (preferred, "command")
+        now = time.monotonic()
+        return [name for name in backends if self.disabled_until.get(name, 0) <= now]
+    
+    def unit_active(self, unit: str) -> bool:
+        """单元是否处于运行状态"""
+        for backend in self.candidates():
+            try:
+                active = getattr(self, f"{backend}_active")(unit)
+            except Exception as e:
+                self.disabled_until[backend] = time.monotonic() + self.RETRY_INTERVAL
+                logger.warning(f"状态查询后端 {backend} 不可用，暂时改用其他方式: {e}")
+                continue
+            if active is not None:
+                self.last_backend = backend
+                return active
+        return self.command_active(unit)
+    
+    def dbus_active(self, unit: str) -> Optional[bool]:
+        """通过 systemd 的 D-Bus 接口读取 ActiveState"""
+        if jeepney is None:
+            return None
+        with self.lock:
+            if self.connection is None or self.connection_pid != os.getpid():
+                # fork 后不能复用父进程的连接
+                self.connection = jeepney.io.blocking.open_dbus_connection(bus='SYSTEM')
+                self.connection_pid = os.getpid()
+            try:
+                manager = jeepney.DBusAddress('/org/freedesktop/systemd1', bus_name='org.freedesktop.systemd1',
+                                              interface='org.freedesktop.systemd1.Manager')
+                try:
+                    path, = self._dbus_call(jeepney.new_method_call(manager, 'GetUnit', 's', (unit,)))
+                except jeepney.DBusErrorResponse as e:
+                    # 未加载的单元一定没有运行
+                    if e.name == 'org.freedesktop.systemd1.NoSuchUnit':
+                        return False
+                    raise
+                address = jeepney.DBusAddress(path, bus_name='org.freedesktop.systemd1',
+                                              interface='org.freedesktop.systemd1.Unit')
+                (_, state), = self._dbus_call(jeepney.Properties(address).get('ActiveState'))
+                return state in ("active", "reloading")
+            except Exception:
+                self.connection = None
+                raise
+    
+    def _dbus_call(self, message):
+        return jeepney.unwrap_msg(self.connection.send_and_get_reply(message, timeout=self.DBUS_TIMEOUT))
+    
+    def cgroup_active(self, unit: str) -> Optional[bool]:
+        """根据 systemd 为单元创建的 cgroup 中是否有进程判断"""
+        for root in self.CGROUP_ROOTS:
+            slice_dir = Path(root) / "system.slice"
+            if not slice_dir.is_dir():
+                continue
+            unit_dir = slice_dir / unit
+            try:
+                events = (unit_dir / "cgroup.events").read_text()
+                return "populated 1" in events
+            except FileNotFoundError:
+                pass
+            try:
+                return bool((unit_dir / "cgroup.procs").read_text().strip())
+            except FileNotFoundError:
+                # 单元停止后 systemd 会删除其 cgroup
+                return False
+        return None
+    
+    def command_active(self, unit: str) -> bool:
+        ret, stdout, _ = run_command(["systemctl", "is-active", unit])
+        self.last_backend = "command"
+        return ret == 0 and "active" in stdout
+    
+    @staticmethod
+    def interface_exists(name: str) -> bool:
+        """网卡是否存在"""
+        net_dir = Path("/sys/class/net")
+        if net_dir.is_dir():
+            return (net_dir / name).exists()
+        ret, _, _ = run_command(["ip", "link", "show", name], timeout=3)
+        return ret == 0
+
+# ==================== 数据存储 ====================
+class Storage:
+    """SQLite存储层
+
+    使用WAL模式，读操作互不阻塞；每次修改只写入受影响的行。
+    每个线程持有独立连接，写事务通过 transaction() 串行化。
+    首次启动时自动从旧的JSON文件迁移数据。
+    """
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS nodes (
+            id TEXT PRIMARY KEY,
+            position INTEGER NOT NULL,
+            server TEXT NOT NULL,
+            port INTEGER NOT NULL,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_nodes_endpoint ON nodes(server, port);
+        CREATE INDEX IF NOT EXISTS idx_nodes_position ON nodes(position);
+        
+        CREATE TABLE IF NOT EXISTS users (
+            username TEXT PRIMARY KEY,
+            data TEXT NOT NULL
+        );
+        
+        CREATE TABLE IF NOT EXISTS sessions (
+            id TEXT PRIMARY KEY,
+            username TEXT NOT NULL,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_sessions_username ON sessions(username);
+        
+        CREATE TABLE IF NOT EXISTS benchmarks (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            node_id TEXT NOT NULL,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_benchmarks_node ON benchmarks(node_id, id);
+        
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            id TEXT PRIMARY KEY,
+            data TEXT NOT NULL
+        );
+        
+        CREATE TABLE IF NOT EXISTS kv (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+    """
+    
+    def __init__(self, db_path: Path):
+        self.db_path = db_path
+        self.local = threading.local()
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn.executescript(self.SCHEMA)
+        self.migrate_from_json()
+    
+    @property
+    def conn(self) -> sqlite3.Connection:
+        """当前线程的数据库连接"""
+        conn = getattr(self.local, "conn", None)
+        # fork 出的worker进程不能复用父进程的连接
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(str(self.db_path), timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+            self.local.depth = 0
+        return conn
+    
+    @contextmanager
+    def transaction(self):
+        """写事务（支持嵌套，最外层提交）"""
+        conn = self.conn
+        if self.local.depth == 0:
+            conn.execute("BEGIN IMMEDIATE")
+        self.local.depth += 1
+        try:
+            yield conn
+        except Exception:
+            self.local.depth -= 1
+            if self.local.depth == 0:
+                conn.execute("ROLLBACK")
+            raise
+        self.local.depth -= 1
+        if self.local.depth == 0:
+            try:
+                conn.execute("COMMIT")
+            except Exception:
+                # 提交失败（如 SQLITE_BUSY、磁盘已满）时事务仍然打开，回滚后本线程的连接才能开始新事务
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                raise
+    
+    # ---------- 节点 ----------
+    def list_nodes(self) -> List[Dict[str, Any]]:
+        rows = self.conn.execute("SELECT data FROM nodes ORDER BY position").fetchall()
+        return [json.loads(row[0]) for row in rows]
+    
+    def get_node(self, node_id: str) -> Optional[Dict[str, Any]]:
+        row = self.conn.execute("SELECT data FROM nodes WHERE id = ?", (node_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+    
+    def find_node(self, server: str, port: int) -> Optional[Dict[str, Any]]:
+        row = self.conn.execute(
+            "SELECT data FROM nodes WHERE server = ? AND port = ? LIMIT 1", (server, int(port))
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+    
+    def node_endpoints(self) -> Dict[Tuple[str, int], str]:
+        """所有节点的 (server, port) -> id 索引"""
+        rows = self.conn.execute("SELECT server, port, id FROM nodes").fetchall()
+        return {(server, port): node_id for server, port, node_id in rows}
+    
+    def subscription_nodes(self, subscription_id: str) -> List[Dict[str, Any]]:
+        """某个订阅下的全部节点"""
+        rows = self.conn.execute(
+            "SELECT data FROM nodes WHERE json_extract(data, '$.subscription_id') = ? ORDER BY position",
+            (subscription_id,)
+        ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+    
+    def count_nodes(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM nodes").fetchone()[0]
+    
+    def insert_nodes(self, nodes: List[Dict[str, Any]]):
+        """批量插入节点（单个事务）"""
+        with self.transaction() as conn:
+            position = conn.execute("SELECT COALESCE(MAX(position), 0) FROM nodes").fetchone()[0]
+            conn.executemany(
+                "INSERT INTO nodes (id, position, server, port, data) VALUES (?, ?, ?, ?, ?)",
+                [(node["id"], position + i, node["server"], int(node["port"]),
+                  json.dumps(node, ensure_ascii=False)) for i, node in enumerate(nodes, 1)]
+            )
+    
+    def insert_node(self, node: Dict[str, Any]):
+        self.insert_nodes([node])
+    
+    def update_node(self, node_id: str, fields: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """更新节点字段，返回更新后的节点"""
+        with self.transaction() as conn:
+            node = self.get_node(node_id)
+            if node is None:
+                return None
+            node.update({k: v for k, v in fields.items() if k != "id"})
+            conn.execute(
+                "UPDATE nodes SET server = ?, port = ?, data = ? WHERE id = ?",
+                (node["server"], int(node["port"]), json.dumps(node, ensure_ascii=False), node_id)
+            )
+        return node
+    
+    def save_node(self, node: Dict[str, Any]):
+        """整体覆盖已有节点的数据（保持排序位置）"""
+        with self.transaction() as conn:
+            conn.execute(
+                "UPDATE nodes SET server = ?, port = ?, data = ? WHERE id = ?",
+                (node["server"], int(node["port"]), json.dumps(node, ensure_ascii=False), node["id"])
+            )
+    
+    def delete_node(self, node_id: str) -> Optional[Dict[str, Any]]:
+        """删除节点及其测速历史，返回被删除的节点"""
+        with self.transaction() as conn:
+            node = self.get_node(node_id)
+            if node is None:
+                return None
+            conn.execute("DELETE FROM nodes WHERE id = ?", (node_id,))
+            conn.execute("DELETE FROM benchmarks WHERE node_id = ?", (node_id,))
+            if self.get_value("current_node") == node_id:
+                self.set_value("current_node", None)
+        return node
+    
+    def replace_nodes(self, nodes: List[Dict[str, Any]], current: Optional[str] = None):
+        """整体替换节点列表（配置导入）"""
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM nodes")
+            self.insert_nodes(nodes)
+            self.set_value("current_node", current)
+    
+    # ---------- 订阅 ----------
+    def list_subscriptions(self) -> List[Dict[str, Any]]:
+        rows = self.conn.execute("SELECT data FROM subscriptions ORDER BY rowid").fetchall()
+        return [json.loads(row[0]) for row in rows]
+    
+    def get_subscription(self, subscription_id: str) -> Optional[Dict[str, Any]]:
+        row = self.conn.execute("SELECT data FROM subscriptions WHERE id = ?", (subscription_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+    
+    def save_subscription(self, subscription: Dict[str, Any]):
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT INTO subscriptions (id, data) VALUES (?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET data = excluded.data",
+                (subscription["id"], json.dumps(subscription, ensure_ascii=False))
+            )
+    
+    def delete_subscription(self, subscription_id: str):
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM subscriptions WHERE id = ?", (subscription_id,))
+    
+    # ---------- 键值 ----------
+    def get_value(self, key: str, default: Any = None) -> Any:
+        row = self.conn.execute("SELECT value FROM kv WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+    
+    def set_value(self, key: str, value: Any):
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)",
+                (key, json.dumps(value, ensure_ascii=False))
+            )
+    
+    def get_values(self, prefix: str) -> Dict[str, Any]:
+        """读取以 prefix 开头的所有键"""
+        rows = self.conn.execute(
+            "SELECT key, value FROM kv WHERE substr(key, 1, ?) = ?", (len(prefix), prefix)
+        ).fetchall()
+        return {key: json.loads(value) for key, value in rows}
+    
+    def delete_value(self, key: str):
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM kv WHERE key = ?", (key,))
+    
+    # ---------- 用户与会话 ----------
+    def list_users(self) -> List[Dict[str, Any]]:
+        rows = self.conn.execute("SELECT data FROM users").fetchall()
+        return [json.loads(row[0]) for row in rows]
+    
+    def get_user(self, username: str) -> Optional[Dict[str, Any]]:
+        row = self.conn.execute("SELECT data FROM users WHERE username = ?", (username,)).fetchone()
+        return json.loads(row[0]) if row else None
+    
+    def save_user(self, user: Dict[str, Any], old_username: Optional[str] = None):
+        """保存用户，提供 old_username 时同时完成改名"""
+        with self.transaction() as conn:
+            if old_username and old_username != user["username"]:
+                conn.execute("DELETE FROM users WHERE username = ?", (old_username,))
+            conn.execute(
+                "INSERT OR REPLACE INTO users (username, data) VALUES (?, ?)",
+                (user["username"], json.dumps(user, ensure_ascii=False))
+            )
+    
+    def add_session(self, session_id: str, session: Dict[str, Any]):
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO sessions (id, username, data) VALUES (?, ?, ?)",
+                (session_id, session["username"], json.dumps(session, ensure_ascii=False))
+            )
+    
+    # ---------- 测速历史 ----------
+    def add_benchmark(self, node_id: str, result: Dict[str, Any], keep: int):
+        """记录测速结果，只保留最近 keep 条"""
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT INTO benchmarks (node_id, data) VALUES (?, ?)",
+                (node_id, json.dumps(result, ensure_ascii=False))
+            )
+            conn.execute(
+                "DELETE FROM benchmarks WHERE node_id = ? AND id NOT IN "
+                "(SELECT id FROM benchmarks WHERE node_id = ? ORDER BY id DESC LIMIT ?)",
+                (node_id, node_id, keep)
+            )
+    
+    def get_benchmarks(self, node_id: str) -> List[Dict[str, Any]]:
+        rows = self.conn.execute(
+            "SELECT data FROM benchmarks WHERE node_id = ? ORDER BY id", (node_id,)
+        ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+    
+    def latest_benchmarks(self) -> Dict[str, Dict[str, Any]]:
+        rows = self.conn.execute(
+            "SELECT node_id, data FROM benchmarks WHERE id IN "
+            "(SELECT MAX(id) FROM benchmarks GROUP BY node_id)"
+        ).fetchall()
+        return {node_id: json.loads(data) for node_id, data in rows}
+    
+    # ---------- 迁移 ----------
+    def migrate_from_json(self):
+        """从旧版JSON文件迁移数据（只执行一次）"""
+        if self.get_value("migrated_from_json"):
+            return
+        
+        with self.transaction():
+            nodes_data = load_json_file(NODES_FILE, {"nodes": [], "current": None})
+            existing = self.node_endpoints()
+            used_ids = set(existing.values())
+            nodes = []
+            for node in nodes_data.get("nodes", []):
+                # 跳过格式不正确的旧节点，不影响其余数据的迁移
+                try:
+                    key = (node["server"], int(node["port"]))
+                    node_id = node["id"]
+                except (KeyError, TypeError, ValueError) as e:
+                    logger.warning(f"跳过无效的旧节点记录: {e!r}")
+                    continue
+                if key in existing or node_id in used_ids:
+                    continue
+                existing[key] = node_id
+                used_ids.add(node_id)
+                nodes.append(node)
+            self.insert_nodes(nodes)
+            if nodes_data.get("current"):
+                self.set_value("current_node", nodes_data["current"])
+            
+            for user in load_json_file(USERS_FILE, []):
+                self.save_user(user)
+            
+            for session_id, session in load_json_file(SESSIONS_FILE, {}).items():
+                self.add_session(session_id, session)
+            
+            for node_id, entries in load_json_file(BENCHMARK_FILE, {}).items():
+                for entry in entries:
+                    self.add_benchmark(node_id, entry, len(entries))
+            
+            self.set_value("migrated_from_json", datetime.now().isoformat())
+        
+        # 保留旧文件作为备份
+        for filepath in (NODES_FILE, USERS_FILE, SESSIONS_FILE, BENCHMARK_FILE):
+            if filepath.exists():
+                filepath.rename(filepath.with_suffix('.json.migrated'))
+                logger.info(f"已迁移到SQLite: {filepath.name}")
+
 # ==================== 认证系统 ====================
 class AuthManager:
     """认证管理器"""
     
-    def __init__(self):
-        self.users = {}
-        self.sessions = {}
+    def __init__(self, storage: Storage):
+        self.storage = storage
         self.load_users()
     
     def load_users(self):
         """加载用户数据"""
-        users_data = load_json_file(USERS_FILE, [DEFAULT_USER])
+        users_data = self.storage.list_users()
+        if not users_data:
+            users_data = [dict(DEFAULT_USER)]
         
         # 如果是默认用户，加密密码
         for user in users_data:
             if user['username'] == 'admin' and user['password'] == 'admin':
                 user['password'] = self.hash_password('admin')
-                save_json_file(USERS_FILE, users_data)
+                self.storage.save_user(user)
         
-        self.users = {u['username']: u for u in users_data}
-        logger.info(f"加载了 {len(self.users)} 个用户")
+        logger.info(f"加载了 {len(users_data)} 个用户")
     
     def hash_password(self, password: str) -> str:
         """密码哈希"""
@@ -267,43 +1573,47 @@ class AuthManager:
     
     def login(self, username: str, password: str) -> Optional[str]:
         """用户登录"""
-        user = self.users.get(username)
+        user = self.storage.get_user(username)
         if not user:
             return None
         
         if self.verify_password(password, user['password']):
             token = self.create_token(username)
             session_id = str(uuid.uuid4())
-            self.sessions[session_id] = {
+            self.storage.add_session(session_id, {
                 'username': username,
                 'token': token,
                 'login_time': datetime.now().isoformat(),
                 'last_activity': datetime.now().isoformat()
-            }
-            save_json_file(SESSIONS_FILE, self.sessions)
+            })
             logger.info(f"用户登录成功: {username}")
             return token
         return None
     
     def change_password(self, username: str, old_password: str, new_password: str) -> bool:
         """修改密码"""
-        user = self.users.get(username)
+        user = self.storage.get_user(username)
         if not user:
             return False
         
         if not self.verify_password(old_password, user['password']):
             return False
         
-        user['password'] = self.hash_password(new_password)
-        users_list = list(self.users.values())
-        save_json_file(USERS_FILE, users_list)
+        # bcrypt在事务外计算，写入前确认期间没有其他请求修改过该用户
+        hashed = self.hash_password(new_password)
+        with self.storage.transaction():
+            current = self.storage.get_user(username)
+            if not current or current['password'] != user['password']:
+                return False
+            current['password'] = hashed
+            self.storage.save_user(current)
         logger.info(f"用户密码已更新: {username}")
         return True
     
     def change_username(self, old_username: str, password: str, new_username: str) -> bool:
         """修改用户名"""
         # 验证原用户
-        user = self.users.get(old_username)
+        user = self.storage.get_user(old_username)
         if not user:
             return False
         
@@ -311,36 +1621,210 @@ class AuthManager:
         if not self.verify_password(password, user['password']):
             return False
         
-        # 检查新用户名是否已存在
-        if new_username in self.users:
-            return False
-        
-        # 更新用户名
-        user['username'] = new_username
-        
-        # 重新构建用户字典
-        del self.users[old_username]
-        self.users[new_username] = user
-        
-        # 保存到文件
-        users_list = list(self.users.values())
-        save_json_file(USERS_FILE, users_list)
+        # 检查与改名在同一事务内完成，避免并发请求重复占用用户名
+        with self.storage.transaction():
+            current = self.storage.get_user(old_username)
+            if not current or current['password'] != user['password']:
+                return False
+            if self.storage.get_user(new_username):
+                return False
+            current['username'] = new_username
+            self.storage.save_user(current, old_username=old_username)
         
         logger.info(f"用户名已更新: {old_username} -> {new_username}")
         return True
 
+# ==================== 客户端配置缓存 ====================
+class ConfigCache:
+    """客户端配置缓存
+
+    渲染结果以输入（影响配置的节点字段、服务器地址、日志级别）的哈希为键保存在缓存目录，
+    相同输入直接复用。应用配置时内容与当前文件相同则不写入，调用方据此跳过重启。
+    最近应用过的 keep 份配置记录在历史中，回滚无需重新渲染。
+    """
+    
+    RENDER_FIELDS = (
+        "server", "port", "password", "sni", "insecure", "alpn",
+        "obfs", "obfs_password", "bandwidth_up", "bandwidth_down", "mtu"
+    )
+    HISTORY_KEY = "config_history"
+    
+    def __init__(self, manager: 'Hysteria2Manager', directory: Path):
+        self.manager = manager
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "renders": 0, "writes": 0, "unchanged": 0}
+    
+    def settings(self) -> Dict[str, Any]:
+        return dict(DEFAULT_CONFIG["config_cache"], **self.manager.config.get("config_cache", {}))
+    
+    def key(self, node: Dict[str, Any], addresses: List[str]) -> str:
+        """计算渲染输入的哈希"""
+        inputs = {
+            "version": VERSION,
+            "node": {field: node.get(field) for field in self.RENDER_FIELDS},
+            "addresses": sorted(addresses),
+            "log_level": self.manager.config.get("hysteria", {}).get("log_level", "info")
+        }
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()[:32]
+    
+    def path(self, key: str) -> Path:
+        return self.directory / f"{key}.yaml"
+    
+    def render(self, node: Dict[str, Any]) -> Tuple[str, bytes]:
+        """返回 (缓存键, 配置内容)，缓存未命中时渲染并保存"""
+        addresses = dns_cache.resolve(node["server"])
+        key = self.key(node, addresses)
+        try:
+            content = self.path(key).read_bytes()
+            with self.lock:
+                self.stats["hits"] += 1
+            return key, content
+        except FileNotFoundError:
+            pass
+        
+        content = self.manager.generate_hysteria_config(node, addresses).encode('utf-8')
+        write_file_atomic(self.path(key), content)
+        with self.lock:
+            self.stats["renders"] += 1
+        return key, content
+    
+    def apply(self, key: str, content: bytes, node: Dict[str, Any]) -> bool:
+        """写入客户端配置文件并记录历史，返回内容是否发生变化"""
+        with self.lock:
+            try:
+                changed = HYSTERIA_CONFIG.read_bytes() != content
+            except FileNotFoundError:
+                changed = True
+            if changed:
+                write_file_atomic(HYSTERIA_CONFIG, content)
+                self.stats["writes"] += 1
+            else:
+                self.stats["unchanged"] += 1
+            self.record(key, content, node)
+        return changed
+    
+    def record(self, key: str, content: bytes, node: Dict[str, Any]):
+        """把配置移到历史最前，超出 keep 的配置从缓存目录删除"""
+        history = [entry for entry in self.get_history() if entry["key"] != key]
+        history.insert(0, {
+            "key": key,
+            "node_id": node["id"],
+            "name": node["name"],
+            "sha256": hashlib.sha256(content).hexdigest(),
+            "applied_at": datetime.now().isoformat()
+        })
+        history = history[:max(1, int(self.settings()["keep"]))]
+        self.manager.storage.set_value(self.HISTORY_KEY, history)
+        
+        kept = {entry["key"] for entry in history}
+        for path in self.directory.glob("*.yaml"):
+            if path.stem not in kept:
+                try:
+                    path.unlink()
+                except OSError:
+                    pass
+    
+    def get_history(self) -> List[Dict[str, Any]]:
+        return self.manager.storage.get_value(self.HISTORY_KEY, [])
+    
+    def lookup(self, key: Optional[str] = None) -> Tuple[Optional[Dict[str, Any]], Optional[bytes]]:
+        """查找历史配置，未指定 key 时返回上一份"""
+        history = self.get_history()
+        if key is None:
+            entry = history[1] if len(history) > 1 else None
+        else:
+            entry = next((item for item in history if item["key"] == key), None)
+        if entry is None:
+            return None, None
+        try:
+            return entry, self.path(entry["key"]).read_bytes()
+        except FileNotFoundError:
+            return None, None
+    
+    def get_state(self) -> Dict[str, Any]:
+        try:
+            active = hashlib.sha256(HYSTERIA_CONFIG.read_bytes()).hexdigest()
+        except FileNotFoundError:
+            active = None
+        history = [dict(entry, active=entry["sha256"] == active) for entry in self.get_history()]
+        with self.lock:
+            stats = dict(self.stats)
+        return {"active_sha256": active, "history": history, "stats": stats}
+
 # ==================== Hysteria2管理器 ====================
 class Hysteria2Manager:
     """Hysteria2核心管理器"""
     
-    def __init__(self):
-        self.config = load_json_file(CONFIG_FILE, DEFAULT_CONFIG)
-        self.nodes = load_json_file(NODES_FILE, {"nodes": [], "current": None})
+    def __init__(self, storage: Storage):
+        self.storage = storage
+        # 配置采用写时复制：写者在写锁内生成新字典后整体替换，读者拿到的快照不会再被修改
+        self.state_lock = RWLock()
+        self._config = load_json_file(CONFIG_FILE, DEFAULT_CONFIG)
+        self.config_mtime = self._config_mtime()
         self.stats = load_json_file(STATS_FILE, {})
         self.service_status = {"hysteria": "stopped", "manager": "running"}
-        
-    def parse_hysteria2_url(self, url: str) -> Optional[Dict[str, Any]]:
-        """解析Hysteria2节点链接（支持所有格式）"""
+    
+    @staticmethod
+    def _config_mtime() -> Optional[float]:
+        try:
+            return CONFIG_FILE.stat().st_mtime
+        except OSError:
+            return None
+    
+    @property
+    def config(self) -> Dict[str, Any]:
+        """当前配置快照（只读，修改请使用 update_config）"""
+        with self.state_lock.read():
+            return self._config
+    
+    def update_config(self, changes: Dict[str, Any], replace: bool = False) -> Dict[str, Any]:
+        """更新顶层配置项（replace 为真时整体替换）并异步保存，返回新配置"""
+        with self.state_lock.write():
+            config = copy.deepcopy(changes if replace else dict(self._config, **changes))
+            self._config = config
+            self.save_config()
+        if "persistence" in config:
+            persistence_writer.configure(**config["persistence"])
+        return config
+    
+    def save_config(self):
+        """提交配置到后台写入线程"""
+        def written():
+            # 记录本进程写入后的修改时间，避免把自己的写入当作外部修改
+            self.config_mtime = self._config_mtime()
+        
+        # config.json 可能被手动编辑，保留缩进格式
+        persistence_writer.submit(CONFIG_FILE, self._config, on_written=written, pretty=True)
+    
+    def reload_config_if_changed(self) -> bool:
+        """配置文件被其他进程修改时重新加载"""
+        mtime = self._config_mtime()
+        if mtime is None or mtime == self.config_mtime:
+            return False
+        # 本进程还有未落盘的配置时以内存为准
+        if persistence_writer.is_pending(CONFIG_FILE):
+            return False
+        with self.state_lock.write():
+            self._config = load_json_file(CONFIG_FILE, DEFAULT_CONFIG)
+            self.config_mtime = mtime
+        return True
+    
+    @property
+    def current_node_id(self) -> Optional[str]:
+        """当前使用的节点ID"""
+        return self.storage.get_value("current_node")
+    
+    def get_nodes(self) -> List[Dict[str, Any]]:
+        """获取全部节点"""
+        return self.storage.list_nodes()
+    
+    def get_node(self, node_id: str) -> Optional[Dict[str, Any]]:
+        """按ID获取节点"""
+        return self.storage.get_node(node_id)
+        
+    def parse_hysteria2_url(self, url: str, verbose: bool = True) -> Optional[Dict[str, Any]]:
+        """解析Hysteria2节点链接（支持所有格式）"""
         try:
             # URL完整解码
             url = urllib.parse.unquote(url.strip())
@@ -394,43 +1878,56 @@ class Hysteria2Manager:
                 server = server_part
                 port = 443
             
-            # 处理insecure参数
-            insecure = str(params.get('insecure', '0')) in ['1', 'true', 'True']
-            
             # 构建节点配置
-            node = {
-                "id": str(uuid.uuid4())[:8],
-                "name": custom_name or f"{server}:{port}",
-                "server": server,
-                "port": port,
-                "password": auth_part,
-                "protocol": protocol,
-                "sni": params.get("sni", server),
-                "insecure": insecure,
-                "obfs": params.get("obfs"),
-                "obfs_password": params.get("obfs-password") or params.get("obfs_password"),
-                "alpn": params.get("alpn"),
-                "bandwidth_up": params.get("up"),
-                "bandwidth_down": params.get("down"),
-                "mtu": int(params.get("mtu", 1500)),
-                "created_at": datetime.now().isoformat()
-            }
-            
-            # 清理None值
-            node = {k: v for k, v in node.items() if v is not None}
+            node = self.normalize_node(
+                server, port, auth_part,
+                name=custom_name,
+                protocol=protocol,
+                sni=params.get("sni"),
+                insecure=str(params.get('insecure', '0')) in ['1', 'true', 'True'],
+                obfs=params.get("obfs"),
+                obfs_password=params.get("obfs-password") or params.get("obfs_password"),
+                alpn=params.get("alpn"),
+                bandwidth_up=params.get("up"),
+                bandwidth_down=params.get("down"),
+                mtu=params.get("mtu")
+            )
             
-            logger.info(f"成功解析节点: {node['name']}")
+            if verbose:
+                logger.info(f"成功解析节点: {node['name']}")
             return node
             
         except Exception as e:
             logger.error(f"解析URL失败: {e}")
             return None
     
-    def generate_hysteria_config(self, node: Dict[str, Any]) -> str:
-        """生成Hysteria2配置文件"""
-        # 解析服务器IP（用于路由排除）
-        server_ip = get_server_ip(node["server"])
+    def normalize_node(self, server: str, port: Any, password: str,
+                       name: Optional[str] = None, **options) -> Dict[str, Any]:
+        """将各来源（链接、Clash、sing-box）的字段统一为内部节点格式"""
+        port = int(port)
+        node = {
+            "id": str(uuid.uuid4())[:8],
+            "name": name or f"{server}:{port}",
+            "server": server,
+            "port": port,
+            "password": password,
+            "protocol": options.get("protocol", "hysteria2"),
+            "sni": options.get("sni") or server,
+            "insecure": bool(options.get("insecure", False)),
+            "obfs": options.get("obfs"),
+            "obfs_password": options.get("obfs_password"),
+            "alpn": options.get("alpn"),
+            "bandwidth_up": options.get("bandwidth_up"),
+            "bandwidth_down": options.get("bandwidth_down"),
+            "mtu": int(options.get("mtu") or 1500),
+            "created_at": datetime.now().isoformat()
+        }
         
+        # 清理None值
+        return {k: v for k, v in node.items() if v is not None}
+    
+    def build_client_config(self, node: Dict[str, Any]) -> Dict[str, Any]:
+        """生成节点连接相关的客户端配置（不含TUN和日志）"""
         config = {
             "server": f"{node['server']}:{node['port']}",
             "auth": node["password"],
@@ -450,6 +1947,28 @@ class Hysteria2Manager:
             if node.get("obfs_password"):
                 config["obfs"]["password"] = node["obfs_password"]
         
+        # 带宽限制
+        if node.get("bandwidth_up") or node.get("bandwidth_down"):
+            config["bandwidth"] = {}
+            if node.get("bandwidth_up"):
+                config["bandwidth"]["up"] = node["bandwidth_up"]
+            if node.get("bandwidth_down"):
+                config["bandwidth"]["down"] = node["bandwidth_down"]
+        
+        return config
+    
+    def generate_hysteria_config(self, node: Dict[str, Any], addresses: Optional[List[str]] = None) -> str:
+        """生成Hysteria2配置文件"""
+        # 服务器的全部地址都需要排除在TUN路由之外；域名通常已被后台预解析
+        if addresses is None:
+            addresses = dns_cache.resolve(node["server"])
+        if not addresses:
+            logger.warning(f"无法解析服务器地址 {node['server']}，路由排除中不包含服务器IP")
+        ipv4_exclude = [f"{address}/32" for address in addresses if ':' not in address]
+        ipv6_exclude = [f"{address}/128" for address in addresses if ':' in address]
+        
+        config = self.build_client_config(node)
+        
         # TUN配置
         config["tun"] = {
             "name": "hytun",
@@ -458,8 +1977,7 @@ class Hysteria2Manager:
             "route": {
                 "ipv4": ["0.0.0.0/0"],
                 "ipv6": ["2000::/3"],
-                "ipv4Exclude": [
-                    f"{server_ip}/32",  # 使用解析后的IP
+                "ipv4Exclude": ipv4_exclude + [
                     "127.0.0.0/8",
                     "10.0.0.0/8",
                     "172.16.0.0/12",
@@ -470,14 +1988,8 @@ class Hysteria2Manager:
                 ]
             }
         }
-        
-        # 带宽限制
-        if node.get("bandwidth_up") or node.get("bandwidth_down"):
-            config["bandwidth"] = {}
-            if node.get("bandwidth_up"):
-                config["bandwidth"]["up"] = node["bandwidth_up"]
-            if node.get("bandwidth_down"):
-                config["bandwidth"]["down"] = node["bandwidth_down"]
+        if ipv6_exclude:
+            config["tun"]["route"]["ipv6Exclude"] = ipv6_exclude
         
         # 日志配置
         config["log"] = {
@@ -511,15 +2023,13 @@ class Hysteria2Manager:
                     "created_at": datetime.now().isoformat()
                 }
             
-            # 检查重复
-            for existing in self.nodes["nodes"]:
-                if (existing["server"] == node["server"] and 
-                    existing["port"] == node["port"]):
-                    return False, "节点已存在", None
+            # 检查重复（按 server+port 索引查询）
+            if self.storage.find_node(node["server"], node["port"]):
+                return False, "节点已存在", None
             
             # 添加节点
-            self.nodes["nodes"].append(node)
-            save_json_file(NODES_FILE, self.nodes)
+            self.storage.insert_node(node)
+            dns_cache.prefetch([node["server"]])
             
             logger.info(f"添加节点: {node['name']}")
             return True, "节点添加成功", node["id"]
@@ -528,27 +2038,131 @@ class Hysteria2Manager:
             logger.error(f"添加节点失败: {e}")
             return False, str(e), None
     
+    def import_nodes(self, entries: Iterable[Tuple[Dict[str, Any], Optional[Dict[str, Any]]]]) -> Dict[str, Any]:
+        """批量导入已解析的节点
+
+        entries 为 (来源位置, 节点或None) 序列，通常来自 SubscriptionParser。
+        先收集全部节点，用 (server, port) 哈希索引去重，最后在一个事务内写入。
+        返回每一项的处理结果（added / duplicate / invalid）。
+        """
+        index = self.storage.node_endpoints()
+        used_ids = set(index.values())
+        batch = []
+        report = []
+        
+        for ref, node in entries:
+            entry = dict(ref)
+            if not node:
+                entry.update(status="invalid", reason="无效的节点链接")
+                report.append(entry)
+                continue
+            
+            key = (node["server"], int(node["port"]))
+            if key in index:
+                entry.update(status="duplicate", name=node["name"], existing_id=index[key])
+                report.append(entry)
+                continue
+            
+            # 短ID在大批量导入时可能碰撞，重新生成
+            while node["id"] in used_ids:
+                node["id"] = str(uuid.uuid4())[:8]
+            used_ids.add(node["id"])
+            index[key] = node["id"]
+            batch.append(node)
+            entry.update(status="added", name=node["name"], id=node["id"])
+            report.append(entry)
+        
+        if batch:
+            self.storage.insert_nodes(batch)
+            dns_cache.prefetch(node["server"] for node in batch)
+        
+        summary = {
+            "added": len(batch),
+            "duplicate": sum(1 for entry in report if entry["status"] == "duplicate"),
+            "invalid": sum(1 for entry in report if entry["status"] == "invalid"),
+            "lines": report
+        }
+        logger.info(f"批量导入节点: 新增 {summary['added']}, 重复 {summary['duplicate']}, 无效 {summary['invalid']}")
+        return summary
+    
+    def sync_subscription_nodes(self, subscription_id: str,
+                                entries: Iterable[Tuple[Dict[str, Any], Optional[Dict[str, Any]]]]) -> Dict[str, Any]:
+        """按订阅内容增量同步节点
+
+        以 (server, port) 对比订阅现有节点：新出现的节点插入，消失的节点删除，
+        参数变化的节点原地更新并保留ID（测速历史随之保留）。
+        当前使用中的节点即使从订阅中消失也不会删除。所有修改在一个事务内完成。
+        """
+        existing = {(node["server"], int(node["port"])): node
+                    for node in self.storage.subscription_nodes(subscription_id)}
+        index = self.storage.node_endpoints()
+        used_ids = set(index.values())
+        seen = set()
+        added, updated = [], []
+        duplicate = invalid = 0
+        
+        for _, node in entries:
+            if not node:
+                invalid += 1
+                continue
+            
+            key = (node["server"], int(node["port"]))
+            if key in seen:
+                duplicate += 1
+                continue
+            seen.add(key)
+            
+            old = existing.get(key)
+            if old is None:
+                # 与手动添加或其他订阅的节点重复
+                if key in index:
+                    duplicate += 1
+                    continue
+                while node["id"] in used_ids:
+                    node["id"] = str(uuid.uuid4())[:8]
+                used_ids.add(node["id"])
+                node["subscription_id"] = subscription_id
+                added.append(node)
+                continue
+            
+            # 保留原有ID与创建时间，其余字段以订阅内容为准
+            node.update(id=old["id"], created_at=old.get("created_at", node["created_at"]), subscription_id=subscription_id)
+            if node != old:
+                updated.append(node)
+        
+        current = self.current_node_id
+        removed = [node["id"] for key, node in existing.items() if key not in seen and node["id"] != current]
+        kept = sum(1 for key, node in existing.items() if key not in seen and node["id"] == current)
+        
+        with self.storage.transaction():
+            if added:
+                self.storage.insert_nodes(added)
+            for node in updated:
+                self.storage.save_node(node)
+            for node_id in removed:
+                self.storage.delete_node(node_id)
+        dns_cache.prefetch(node["server"] for node in added + updated)
+        
+        summary = {
+            "added": len(added),
+            "updated": len(updated),
+            "removed": len(removed),
+            "kept": kept,
+            "unchanged": len(existing) - len(updated) - len(removed) - kept,
+            "duplicate": duplicate,
+            "invalid": invalid
+        }
+        logger.info(f"同步订阅 {subscription_id}: 新增 {len(added)}, 更新 {len(updated)}, 删除 {len(removed)}")
+        return summary
+    
     def delete_node(self, node_id: str) -> Tuple[bool, str]:
         """删除节点"""
         try:
-            # 查找节点
-            node_index = None
-            for i, node in enumerate(self.nodes["nodes"]):
-                if node["id"] == node_id:
-                    node_index = i
-                    break
-            
-            if node_index is None:
+            # 删除节点（如果是当前节点，同时清除选择）
+            deleted = self.storage.delete_node(node_id)
+            if deleted is None:
                 return False, "节点不存在"
             
-            # 如果是当前节点，清除选择
-            if self.nodes["current"] == node_id:
-                self.nodes["current"] = None
-            
-            # 删除节点
-            deleted = self.nodes["nodes"].pop(node_index)
-            save_json_file(NODES_FILE, self.nodes)
-            
             logger.info(f"删除节点: {deleted['name']}")
             return True, "节点已删除"
             
@@ -556,55 +2170,87 @@ class Hysteria2Manager:
             logger.error(f"删除节点失败: {e}")
             return False, str(e)
     
-    def use_node(self, node_id: str) -> Tuple[bool, str]:
-        """使用指定节点"""
+    def update_node(self, node_id: str, fields: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """更新节点字段"""
+        node = self.storage.update_node(node_id, fields)
+        if node:
+            dns_cache.prefetch([node["server"]])
+            logger.info(f"更新节点: {node['name']}")
+        return node
+    
+    def use_node(self, node_id: str) -> Tuple[bool, str, Optional[Dict[str, Any]]]:
+        """使用指定节点，返回 (是否成功, 消息, 切换耗时信息)"""
         try:
             # 查找节点
-            target_node = None
-            for node in self.nodes["nodes"]:
-                if node["id"] == node_id:
-                    target_node = node
-                    break
-            
+            target_node = self.storage.get_node(node_id)
             if not target_node:
-                return False, "节点不存在"
+                return False, "节点不存在", None
             
-            # 生成配置文件
-            config_content = self.generate_hysteria_config(target_node)
+            # 生成配置文件（相同输入直接使用缓存）
+            key, content = config_cache.render(target_node)
+            return self.activate_config(key, content, target_node)
             
-            # 备份旧配置
-            if HYSTERIA_CONFIG.exists():
-                shutil.copy(HYSTERIA_CONFIG, HYSTERIA_CONFIG.with_suffix('.yaml.bak'))
-            
-            # 写入新配置
-            HYSTERIA_CONFIG.parent.mkdir(parents=True, exist_ok=True)
-            with open(HYSTERIA_CONFIG, 'w', encoding='utf-8') as f:
-                f.write(config_content)
-            
-            # 更新当前节点
-            self.nodes["current"] = node_id
-            save_json_file(NODES_FILE, self.nodes)
+        except Exception as e:
+            logger.error(f"切换节点失败: {e}")
+            return False, str(e), None
+    
+    def rollback_config(self, key: Optional[str] = None) -> Tuple[bool, str, Optional[Dict[str, Any]]]:
+        """回滚到历史中的客户端配置，未指定 key 时回滚到上一份"""
+        try:
+            entry, content = config_cache.lookup(key)
+            if entry is None:
+                return False, "没有可回滚的配置", None
             
-            # 重启服务
-            if self.service_status["hysteria"] == "running":
-                self.restart_service()
+            target_node = self.storage.get_node(entry["node_id"])
+            if not target_node:
+                return False, "该配置对应的节点已删除", None
             
-            logger.info(f"切换到节点: {target_node['name']}")
-            return True, f"已切换到节点: {target_node['name']}"
+            logger.info(f"回滚客户端配置: {entry['key']}")
+            return self.activate_config(entry["key"], content, target_node)
             
         except Exception as e:
-            logger.error(f"切换节点失败: {e}")
-            return False, str(e)
+            logger.error(f"回滚配置失败: {e}")
+            return False, str(e), None
+    
+    def activate_config(self, key: str, content: bytes, node: Dict[str, Any]) -> Tuple[bool, str, Optional[Dict[str, Any]]]:
+        """写入配置并在内容变化时重启服务"""
+        changed = config_cache.apply(key, content, node)
+        
+        # 更新当前节点
+        self.storage.set_value("current_node", node["id"])
+        
+        # 重启服务并测量中断时长；配置未变化且服务正在运行时才跳过，
+        # 上次重启失败或服务已停止时重试同一节点仍会重启
+        switch = None
+        running = self.service_status["hysteria"] == "running"
+        if not changed and running:
+            logger.info("客户端配置未变化，跳过重启")
+        elif running or not changed:
+            started = time.monotonic()
+            success, message = self.restart_service()
+            tun_ready = success and self.wait_for_tun()
+            switch = {
+                "mode": self.switch_mode(),
+                "switchover_ms": round((time.monotonic() - started) * 1000, 1),
+                "tun_ready": tun_ready
+            }
+            logger.info(f"节点切换耗时: {switch['switchover_ms']} ms ({switch['mode']})")
+            if not success:
+                return False, f"节点已切换，但服务重启失败: {message}", switch
+        
+        logger.info(f"切换到节点: {node['name']}", extra={"node_id": node["id"]})
+        event_bus.publish("node", {"current_node": node["id"], "name": node["name"], "switch": switch})
+        return True, f"已切换到节点: {node['name']}", switch
     
     def start_service(self) -> Tuple[bool, str]:
         """启动Hysteria2服务"""
         try:
-            if not self.nodes["current"]:
+            if not self.current_node_id:
                 return False, "请先选择一个节点"
             
             ret, _, stderr = run_command(["systemctl", "start", "hysteria2-client"])
+            service_watcher.refresh_unit()
             if ret == 0:
-                self.service_status["hysteria"] = "running"
                 logger.info("Hysteria2服务已启动")
                 return True, "服务启动成功"
             else:
@@ -619,115 +2265,2770 @@ class Hysteria2Manager:
         """停止Hysteria2服务"""
         try:
             ret, _, _ = run_command(["systemctl", "stop", "hysteria2-client"])
+            service_watcher.refresh_unit()
             if ret == 0:
-                self.service_status["hysteria"] = "stopped"
                 logger.info("Hysteria2服务已停止")
                 return True, "服务已停止"
             else:
                 return False, "停止失败"
                 
         except Exception as e:
-            logger.error(f"停止服务失败: {e}")
-            return False, str(e)
+            logger.error(f"停止服务失败: {e}")
+            return False, str(e)
+    
+    def switch_mode(self) -> str:
+        """节点切换方式：fast 为单次 systemctl restart，restart 为旧的停止/等待/启动流程"""
+        return self.config.get("hysteria", {}).get("switch_mode", "fast")
+    
+    def restart_service(self) -> Tuple[bool, str]:
+        """重启Hysteria2服务"""
+        if self.switch_mode() == "restart":
+            self.stop_service()
+            time.sleep(2)
+            return self.start_service()
+        
+        if not self.current_node_id:
+            return False, "请先选择一个节点"
+        
+        # 由systemd在一次作业内完成停止与启动，省去固定等待
+        ret, _, stderr = run_command(["systemctl", "restart", "hysteria2-client"])
+        service_watcher.refresh_unit()
+        if ret == 0:
+            logger.info("Hysteria2服务已重启")
+            return True, "服务重启成功"
+        else:
+            logger.error(f"重启失败: {stderr}")
+            return False, f"重启失败: {stderr}"
+    
+    def wait_for_tun(self, timeout: float = 10.0) -> bool:
+        """等待TUN接口出现（新客户端已接管流量）"""
+        return service_watcher.wait_for_link(timeout)
+    
+    def get_service_status(self) -> Dict[str, Any]:
+        """获取服务状态（由 service_watcher 维护，不再主动查询）"""
+        if not service_watcher.running:
+            service_watcher.refresh_unit()
+            service_watcher.refresh_link()
+        state = service_watcher.get()
+        
+        return {
+            "hysteria": state["hysteria"],
+            "manager": "running",
+            "tun_interface": state["tun_interface"],
+            "backend": system_status.last_backend,
+            "events": state["events"]
+        }
+    
+    def _connection_probes(self) -> Dict[str, Any]:
+        """连接测试的各个独立探针"""
+        def dns_probe(cmd):
+            def probe():
+                ret, _, _ = run_command(cmd, timeout=3)
+                return {"ok": ret == 0}
+            return probe
+        
+        def ipify_probe():
+            with tracer.span("http", "GET https://api.ipify.org"):
+                response = requests.get("https://api.ipify.org?format=json", timeout=5)
+            response.raise_for_status()
+            ip = response.json().get("ip")
+            return {"ok": bool(ip), "ip": ip}
+        
+        def geo_probe():
+            # 不依赖ipify的结果，直接查询请求方自身的归属地
+            with tracer.span("http", "GET https://ipapi.co/country/"):
+                response = requests.get("https://ipapi.co/country/", timeout=3)
+            response.raise_for_status()
+            return {"ok": True, "location": response.text.strip()}
+        
+        def curl_ip_probe():
+            ret, stdout, _ = run_command(["curl", "-s", "-m", "5", "https://ifconfig.io/ip"], timeout=6)
+            return {"ok": ret == 0 and bool(stdout.strip()), "ip": stdout.strip()}
+        
+        def curl_geo_probe():
+            ret, stdout, _ = run_command(["curl", "-s", "-m", "3", "https://ifconfig.io/country_code"], timeout=4)
+            return {"ok": ret == 0 and bool(stdout.strip()), "location": stdout.strip()}
+        
+        def ping_probe():
+            ret, stdout, _ = run_command(["ping", "-c", "1", "-W", "2", "8.8.8.8"], timeout=3)
+            match = re.search(r'time=(\d+\.?\d*)', stdout) if ret == 0 else None
+            return {"ok": bool(match), "latency": float(match.group(1)) if match else -1}
+        
+        def tun_probe():
+            return {"ok": system_status.interface_exists("hytun")}
+        
+        return {
+            "dns_nslookup": dns_probe(["nslookup", "google.com", "8.8.8.8"]),
+            "dns_getent": dns_probe(["getent", "hosts", "google.com"]),
+            "http_ipify": ipify_probe,
+            "geo_ipapi": geo_probe,
+            "http_curl": curl_ip_probe,
+            "geo_curl": curl_geo_probe,
+            "ping": ping_probe,
+            "tun": tun_probe
+        }
+    
+    def run_probes(self, probes: Dict[str, Any], deadline: float) -> Dict[str, Dict[str, Any]]:
+        """并发执行探针，所有探针共享一个整体截止时间"""
+        results = {}
+        
+        def timed(func):
+            started = time.monotonic()
+            try:
+                value = func()
+            except Exception as e:
+                value = {"ok": False, "error": str(e)}
+            value["duration_ms"] = round((time.monotonic() - started) * 1000, 1)
+            return value
+        
+        executor = ThreadPoolExecutor(max_workers=len(probes), thread_name_prefix="probe")
+        try:
+            futures = {executor.submit(tracer.bind(timed), func): name for name, func in probes.items()}
+            done, not_done = wait(futures, timeout=deadline)
+            for future in done:
+                results[futures[future]] = future.result()
+            for future in not_done:
+                future.cancel()
+                results[futures[future]] = {"ok": False, "error": "timeout", "duration_ms": deadline * 1000}
+        finally:
+            # 超时的探针在后台自行结束，不阻塞调用方
+            executor.shutdown(wait=False)
+        
+        return {name: results[name] for name in probes}
+    
+    def test_connection(self, deadline: float = 8.0) -> Dict[str, Any]:
+        """测试连接状态（独立探针并发执行）"""
+        result = {
+            "status": "unknown",
+            "latency": -1,
+            "ip": "N/A",
+            "location": "N/A",
+            "dns": False,
+            "http": False,
+            "probes": {}
+        }
+        
+        try:
+            # 检查服务状态
+            if self.service_status["hysteria"] != "running":
+                result["status"] = "disconnected"
+                return result
+            
+            started = time.monotonic()
+            probes = self.run_probes(self._connection_probes(), deadline)
+            result["probes"] = probes
+            result["duration_ms"] = round((time.monotonic() - started) * 1000, 1)
+            
+            # 汇总DNS结果
+            result["dns"] = probes["dns_nslookup"]["ok"] or probes["dns_getent"]["ok"]
+            
+            # 汇总HTTP结果（优先使用ipify，curl作为备用）
+            for ip_probe in ("http_ipify", "http_curl"):
+                if probes[ip_probe]["ok"]:
+                    result["http"] = True
+                    result["ip"] = probes[ip_probe]["ip"]
+                    break
+            for geo_probe in ("geo_ipapi", "geo_curl"):
+                if probes[geo_probe]["ok"]:
+                    result["location"] = probes[geo_probe]["location"]
+                    break
+            
+            # 如果HTTP正常但DNS显示失败，修正为正常
+            if result["http"] and not result["dns"]:
+                result["dns"] = True
+            
+            # 延迟
+            if probes["ping"]["ok"]:
+                result["latency"] = probes["ping"]["latency"]
+            
+            # 判断连接状态
+            tun_exists = probes["tun"]["ok"]
+            
+            if tun_exists and result["http"]:
+                result["status"] = "connected"
+            elif self.service_status["hysteria"] == "running":
+                result["status"] = "connecting"
+            else:
+                result["status"] = "disconnected"
+                
+        except Exception as e:
+            logger.error(f"连接测试失败: {e}")
+        
+        return result
+
+# ==================== 订阅解析 ====================
+class SubscriptionTooLarge(Exception):
+    """订阅内容超过大小限制"""
+
+class SubscriptionParser:
+    """流式订阅解析器
+
+    根据首个非空行自动识别格式：
+    - 明文链接列表（hy2:// 等）：逐行解析，内存中只保留当前行
+    - base64 编码的链接列表：按4字节对齐分块解码，解码结果同样逐行解析
+    - Clash YAML / sing-box JSON：需要完整文档，缓冲后再解析
+    所有格式共用 max_bytes 上限，超出时抛出 SubscriptionTooLarge。
+    """
+    
+    URI_PREFIXES = ('hy2://', 'hysteria2://', 'hysteria://')
+    YAML_HINT = re.compile(r'^(---|#|[\w.-]+:(\s|$))')
+    
+    def __init__(self, manager: 'Hysteria2Manager', max_bytes: int):
+        self.manager = manager
+        self.max_bytes = max_bytes
+        self.received = 0
+        self.format = None
+    
+    def parse_response(self, response) -> Iterator[Tuple[Dict[str, Any], Optional[Dict[str, Any]]]]:
+        """解析 requests 流式响应（需以 stream=True 发起）"""
+        length = response.headers.get('Content-Length')
+        if length and length.isdigit() and int(length) > self.max_bytes:
+            raise SubscriptionTooLarge(f"订阅内容过大: {length} 字节")
+        return self.parse_chunks(response.iter_content(chunk_size=65536))
+    
+    def parse_chunks(self, chunks: Iterable[bytes]) -> Iterator[Tuple[Dict[str, Any], Optional[Dict[str, Any]]]]:
+        """解析按块读取的原始字节内容"""
+        def lines():
+            # 在块级别执行大小上限，单行超长的内容也不会无限缓冲
+            pending = b''
+            for chunk in chunks:
+                self.received += len(chunk)
+                if self.received > self.max_bytes:
+                    raise SubscriptionTooLarge(f"订阅内容超过 {self.max_bytes} 字节上限")
+                *complete, pending = (pending + chunk).split(b'\n')
+                for raw in complete:
+                    yield raw.decode('utf-8', errors='replace')
+            if pending:
+                yield pending.decode('utf-8', errors='replace')
+        
+        return self._parse(lines())
+    
+    def parse_lines(self, lines: Iterable[str]) -> Iterator[Tuple[Dict[str, Any], Optional[Dict[str, Any]]]]:
+        """解析逐行输入的订阅内容"""
+        return self._parse(self._counted(lines))
+    
+    def _parse(self, lines: Iterator[str]):
+        for first in lines:
+            first = first.strip().lstrip('\ufeff')
+            if first:
+                break
+        else:
+            self.format = "empty"
+            return
+        
+        rest = itertools.chain([first], lines)
+        if '://' in first:
+            self.format = "uri"
+            yield from self._parse_uris(rest)
+        elif first.startswith(('{', '[')):
+            self.format = "sing-box"
+            yield from self._parse_document(json.loads('\n'.join(rest)))
+        elif self.YAML_HINT.match(first):
+            self.format = "clash"
+            yield from self._parse_document(yaml.safe_load('\n'.join(rest)))
+        else:
+            self.format = "base64"
+            yield from self._parse_uris(self._decode_base64(rest))
+    
+    def _counted(self, lines: Iterable[str]) -> Iterator[str]:
+        """统计读取量并执行大小上限"""
+        for line in lines:
+            self.received += len(line) + 1
+            if self.received > self.max_bytes:
+                raise SubscriptionTooLarge(f"订阅内容超过 {self.max_bytes} 字节上限")
+            yield line
+    
+    def _parse_uris(self, lines: Iterable[str]):
+        for line_no, line in enumerate(lines, 1):
+            line = line.strip()
+            if not line:
+                continue
+            node = None
+            if line.startswith(self.URI_PREFIXES):
+                node = self.manager.parse_hysteria2_url(line, verbose=False)
+            yield {"line": line_no}, node
+    
+    def _decode_base64(self, lines: Iterable[str]) -> Iterator[str]:
+        """增量解码base64，并按换行切分出解码后的行"""
+        pending = ''
+        buffer = ''
+        for chunk in itertools.chain(lines, [None]):
+            if chunk is None:
+                # 补齐缺失的填充
+                data, pending = pending + '=' * (-len(pending) % 4), ''
+            else:
+                pending += ''.join(chunk.split()).replace('-', '+').replace('_', '/')
+                cut = len(pending) - len(pending) % 4
+                data, pending = pending[:cut], pending[cut:]
+            if not data:
+                continue
+            
+            buffer += base64.b64decode(data).decode('utf-8', errors='replace')
+            *complete, buffer = buffer.split('\n')
+            yield from complete
+        if buffer:
+            yield buffer
+    
+    def _parse_document(self, document: Any):
+        """解析 Clash（proxies）或 sing-box（outbounds）文档"""
+        if isinstance(document, dict) and isinstance(document.get("proxies"), list):
+            self.format = "clash"
+            for index, proxy in enumerate(document["proxies"]):
+                yield {"entry": f"proxies[{index}]"}, self._from_clash(proxy)
+        elif isinstance(document, dict) and isinstance(document.get("outbounds"), list):
+            self.format = "sing-box"
+            for index, outbound in enumerate(document["outbounds"]):
+                # 跳过 direct/block/selector 等非代理出站
+                if isinstance(outbound, dict) and outbound.get("server"):
+                    yield {"entry": f"outbounds[{index}]"}, self._from_sing_box(outbound)
+        else:
+            yield {"entry": "document"}, None
+    
+    def _from_clash(self, proxy: Any) -> Optional[Dict[str, Any]]:
+        if not isinstance(proxy, dict) or proxy.get("type") != "hysteria2":
+            return None
+        try:
+            alpn = proxy.get("alpn")
+            return self.manager.normalize_node(
+                proxy["server"], proxy["port"], str(proxy.get("password") or proxy.get("auth", "")),
+                name=proxy.get("name"),
+                sni=proxy.get("sni"),
+                insecure=bool(proxy.get("skip-cert-verify")),
+                obfs=proxy.get("obfs"),
+                obfs_password=proxy.get("obfs-password"),
+                alpn=",".join(alpn) if isinstance(alpn, list) else alpn,
+                bandwidth_up=str(proxy["up"]) if proxy.get("up") else None,
+                bandwidth_down=str(proxy["down"]) if proxy.get("down") else None
+            )
+        except (KeyError, ValueError, TypeError):
+            return None
+    
+    def _from_sing_box(self, outbound: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        if outbound.get("type") != "hysteria2":
+            return None
+        try:
+            tls = outbound.get("tls") or {}
+            obfs = outbound.get("obfs") or {}
+            alpn = tls.get("alpn")
+            return self.manager.normalize_node(
+                outbound["server"], outbound["server_port"], str(outbound.get("password", "")),
+                name=outbound.get("tag"),
+                sni=tls.get("server_name"),
+                insecure=bool(tls.get("insecure")),
+                obfs=obfs.get("type"),
+                obfs_password=obfs.get("password"),
+                alpn=",".join(alpn) if isinstance(alpn, list) else alpn,
+                bandwidth_up=f"{outbound['up_mbps']} mbps" if outbound.get("up_mbps") else None,
+                bandwidth_down=f"{outbound['down_mbps']} mbps" if outbound.get("down_mbps") else None
+            )
+        except (KeyError, ValueError, TypeError):
+            return None
+
+# ==================== 订阅管理 ====================
+class SubscriptionManager:
+    """持久化订阅与定时刷新
+
+    所有请求复用同一个带连接池的 requests.Session，并携带 ETag / Last-Modified
+    发起条件请求：服务端返回304时不下载也不解析。服务端不支持条件请求时，
+    下载内容先写入临时文件并计算哈希，与上次一致则跳过解析。
+    内容变化时按差异同步节点（见 Hysteria2Manager.sync_subscription_nodes）。
+    """
+    
+    def __init__(self, manager: 'Hysteria2Manager'):
+        self.manager = manager
+        self.storage = manager.storage
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=8, pool_maxsize=8)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers['User-Agent'] = f"hysteria2-manager/{VERSION}"
+        self.locks = {}
+        self.locks_guard = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.running = False
+    
+    def settings(self) -> Dict[str, Any]:
+        """读取订阅配置"""
+        return dict(DEFAULT_CONFIG["subscription"], **self.manager.config.get("subscription", {}))
+    
+    def list_subscriptions(self) -> List[Dict[str, Any]]:
+        subscriptions = self.storage.list_subscriptions()
+        for subscription in subscriptions:
+            subscription["node_count"] = len(self.storage.subscription_nodes(subscription["id"]))
+        return subscriptions
+    
+    def get(self, subscription_id: str) -> Optional[Dict[str, Any]]:
+        return self.storage.get_subscription(subscription_id)
+    
+    def add(self, url: str, name: Optional[str] = None, interval: Optional[int] = None) -> Dict[str, Any]:
+        """创建订阅（同一地址只保存一份）"""
+        for subscription in self.storage.list_subscriptions():
+            if subscription["url"] == url:
+                return subscription
+        
+        subscription = {
+            "id": str(uuid.uuid4())[:8],
+            "name": name or "未命名订阅",
+            "url": url,
+            "interval": int(interval or self.settings()["interval"]),
+            "enabled": True,
+            "etag": None,
+            "last_modified": None,
+            "content_hash": None,
+            "last_refresh": None,
+            "last_result": None,
+            "created_at": datetime.now().isoformat()
+        }
+        self.storage.save_subscription(subscription)
+        logger.info(f"添加订阅: {subscription['name']}")
+        return subscription
+    
+    def update(self, subscription_id: str, fields: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        subscription = self.storage.get_subscription(subscription_id)
+        if subscription is None:
+            return None
+        for key in ("name", "interval", "enabled"):
+            if key in fields:
+                subscription[key] = fields[key]
+        if "url" in fields and fields["url"] != subscription["url"]:
+            # 地址变化后缓存的校验信息失效
+            subscription.update(url=fields["url"], etag=None, last_modified=None, content_hash=None)
+        self.storage.save_subscription(subscription)
+        self.wakeup.set()
+        return subscription
+    
+    def delete(self, subscription_id: str, keep_nodes: bool = False) -> bool:
+        """删除订阅，默认同时删除其节点（当前节点除外）"""
+        subscription = self.storage.get_subscription(subscription_id)
+        if subscription is None:
+            return False
+        
+        current = self.manager.current_node_id
+        with self.storage.transaction():
+            for node in self.storage.subscription_nodes(subscription_id):
+                if keep_nodes or node["id"] == current:
+                    node.pop("subscription_id", None)
+                    self.storage.save_node(node)
+                else:
+                    self.storage.delete_node(node["id"])
+            self.storage.delete_subscription(subscription_id)
+        
+        logger.info(f"删除订阅: {subscription['name']}")
+        return True
+    
+    def _lock(self, subscription_id: str) -> threading.Lock:
+        with self.locks_guard:
+            return self.locks.setdefault(subscription_id, threading.Lock())
+    
+    def refresh(self, subscription_id: str, force: bool = False) -> Dict[str, Any]:
+        """刷新订阅，返回本次刷新结果
+
+        status: not_modified（304）、unchanged（内容哈希未变）、updated（已同步节点）
+        """
+        with self._lock(subscription_id):
+            subscription = self.storage.get_subscription(subscription_id)
+            if subscription is None:
+                raise KeyError(subscription_id)
+            
+            started = time.monotonic()
+            try:
+                result = self._fetch_and_sync(subscription, force)
+            except Exception as e:
+                result = {"status": "error", "error": str(e)}
+                raise
+            finally:
+                result["duration_ms"] = round((time.monotonic() - started) * 1000, 1)
+                subscription["last_refresh"] = datetime.now().isoformat()
+                subscription["last_result"] = result
+                self.storage.save_subscription(subscription)
+            return result
+    
+    def _fetch_and_sync(self, subscription: Dict[str, Any], force: bool) -> Dict[str, Any]:
+        settings = self.settings()
+        max_bytes = int(settings["max_bytes"])
+        headers = {}
+        if not force:
+            if subscription.get("etag"):
+                headers["If-None-Match"] = subscription["etag"]
+            if subscription.get("last_modified"):
+                headers["If-Modified-Since"] = subscription["last_modified"]
+        
+        # 订阅链接的查询参数通常包含令牌，不记入追踪信息
+        endpoint = urllib.parse.urlsplit(subscription["url"])
+        with tracer.span("http", f"GET {endpoint.scheme}://{endpoint.netloc}{endpoint.path}"):
+            response = self.session.get(subscription["url"], headers=headers,
+                                        timeout=settings["timeout"], stream=True)
+        with response:
+            if response.status_code == 304:
+                return {"status": "not_modified"}
+            response.raise_for_status()
+            
+            length = response.headers.get("Content-Length")
+            if length and length.isdigit() and int(length) > max_bytes:
+                raise SubscriptionTooLarge(f"订阅内容过大: {length} 字节")
+            
+            # 先落盘并计算哈希，内容不变时无需解析
+            with tempfile.SpooledTemporaryFile(max_size=1024 * 1024) as spool:
+                digest = hashlib.sha256()
+                size = 0
+                for chunk in response.iter_content(chunk_size=65536):
+                    size += len(chunk)
+                    if size > max_bytes:
+                        raise SubscriptionTooLarge(f"订阅内容超过 {max_bytes} 字节上限")
+                    digest.update(chunk)
+                    spool.write(chunk)
+                
+                # 校验信息在同步成功后才保存，失败时下次刷新会重新下载
+                validators = {
+                    "etag": response.headers.get("ETag"),
+                    "last_modified": response.headers.get("Last-Modified")
+                }
+                content_hash = digest.hexdigest()
+                if not force and content_hash == subscription.get("content_hash"):
+                    subscription.update(validators)
+                    return {"status": "unchanged", "bytes": size}
+                
+                spool.seek(0)
+                parser = SubscriptionParser(self.manager, max_bytes)
+                entries = parser.parse_chunks(iter(lambda: spool.read(65536), b''))
+                result = self.manager.sync_subscription_nodes(subscription["id"], entries)
+            
+            subscription.update(validators, content_hash=content_hash)
+            result.update(status="updated", format=parser.format, bytes=size)
+            return result
+    
+    def refresh_due(self) -> int:
+        """刷新所有到期的订阅，返回刷新数量"""
+        now = datetime.now()
+        count = 0
+        for subscription in self.storage.list_subscriptions():
+            if not subscription.get("enabled", True):
+                continue
+            last = subscription.get("last_refresh")
+            if last and (now - datetime.fromisoformat(last)).total_seconds() < subscription["interval"]:
+                continue
+            try:
+                self.refresh(subscription["id"])
+            except Exception as e:
+                logger.warning(f"刷新订阅失败 {subscription['name']}: {e}")
+            count += 1
+        return count
+    
+    def start(self):
+        """启动定时刷新线程"""
+        if self.running:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name="subscriptions", daemon=True)
+        self.thread.start()
+    
+    def stop(self):
+        self.running = False
+        self.wakeup.set()
+    
+    def _run(self):
+        while self.running:
+            self.wakeup.clear()
+            try:
+                self.refresh_due()
+            except Exception as e:
+                logger.error(f"订阅刷新调度失败: {e}")
+            self.wakeup.wait(self.settings()["check_interval"])
+
+# ==================== 事件推送 ====================
+class EventBus:
+    """SSE事件总线
+
+    每个事件只序列化一次，然后放入各订阅者的有界队列，
+    后台采集的开销与在线客户端数量无关。消费过慢的订阅者队列满时被断开，
+    客户端（EventSource）会自动重连并重新获取快照。
+    """
+    
+    QUEUE_SIZE = 256
+    
+    def __init__(self):
+        self.subscribers = set()
+        self.lock = threading.Lock()
+        self.sequence = 0
+    
+    def subscribe(self) -> queue.Queue:
+        subscriber = queue.Queue(maxsize=self.QUEUE_SIZE)
+        with self.lock:
+            self.subscribers.add(subscriber)
+        return subscriber
+    
+    def unsubscribe(self, subscriber: queue.Queue):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+    
+    @staticmethod
+    def format(event: str, data: Any, event_id: Optional[int] = None) -> str:
+        """生成SSE消息帧"""
+        frame = f"event: {event}\n"
+        if event_id is not None:
+            frame += f"id: {event_id}\n"
+        return frame + f"data: {json.dumps(data, ensure_ascii=False, separators=(',', ':'))}\n\n"
+    
+    def publish(self, event: str, data: Any):
+        """向所有订阅者广播事件"""
+        with self.lock:
+            if not self.subscribers:
+                return
+            self.sequence += 1
+            frame = self.format(event, data, self.sequence)
+            for subscriber in list(self.subscribers):
+                try:
+                    subscriber.put_nowait(frame)
+                except queue.Full:
+                    # 通知该连接结束，由客户端重连
+                    self.subscribers.discard(subscriber)
+                    while True:
+                        try:
+                            subscriber.get_nowait()
+                        except queue.Empty:
+                            break
+                    subscriber.put_nowait(None)
+    
+    def client_count(self) -> int:
+        with self.lock:
+            return len(self.subscribers)
+
+class StreamLimiter:
+    """限制同时打开的SSE连接数
+
+    gthread / waitress 下每个SSE连接在整个连接期间占用一个请求线程，
+    连接数不加限制时长连接会占满线程池，普通请求只能排队。
+    上限取 streams.max_per_worker 与线程数一半中的较小值，超出时接口返回503，
+    至少一半线程始终留给普通请求。
+    """
+    
+    def __init__(self, settings):
+        self.settings = settings
+        self.threads = None
+        self.active = 0
+        self.rejected = 0
+        self.lock = threading.Lock()
+    
+    def limit(self) -> int:
+        limit = max(1, int(self.settings()["max_per_worker"]))
+        if self.threads:
+            limit = min(limit, max(1, self.threads // 2))
+        return limit
+    
+    def acquire(self) -> bool:
+        limit = self.limit()
+        with self.lock:
+            if self.active >= limit:
+                self.rejected += 1
+                return False
+            self.active += 1
+            return True
+    
+    def release(self):
+        with self.lock:
+            self.active = max(0, self.active - 1)
+    
+    def get_state(self) -> Dict[str, Any]:
+        with self.lock:
+            return {"active": self.active, "limit": self.limit(), "rejected": self.rejected}
+
+class EventBusHandler(logging.Handler):
+    """把管理器日志作为 log 事件推送"""
+    
+    def __init__(self, bus: EventBus):
+        super().__init__(logging.INFO)
+        self.bus = bus
+        self.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    
+    def emit(self, record):
+        try:
+            self.bus.publish("log", {"source": "manager", "line": self.format(record)})
+        except Exception:
+            self.handleError(record)
+
+# ==================== 服务状态监听 ====================
+class ServiceWatcher:
+    """监听 hysteria 客户端服务与 TUN 网卡的状态变化
+
+    单元状态订阅 systemd 的 D-Bus PropertiesChanged 信号（需要 jeepney），
+    网卡通过 netlink RTMGRP_LINK 组接收 RTM_NEWLINK / RTM_DELLINK 消息。
+    状态保存在内存中，变化时通知监听者；事件源不可用时退回按 service_interval 轮询，
+    并每 RETRY_INTERVAL 秒重新尝试订阅。
+    """
+    
+    RETRY_INTERVAL = 60
+    DBUS_TIMEOUT = 2.0
+    RTMGRP_LINK = 1
+    RTM_NEWLINK = 16
+    RTM_DELLINK = 17
+    IFLA_IFNAME = 3
+    
+    def __init__(self, unit: str, interface: str, poll_interval):
+        self.unit = unit
+        self.interface = interface
+        self.poll_interval = poll_interval
+        self.state = {"hysteria": "stopped", "active_state": None, "tun_interface": False}
+        self.live = {"dbus": False, "netlink": False}
+        self.condition = threading.Condition()
+        self.listeners = []
+        self.wakeup = threading.Event()
+        self.running = False
+    
+    def add_listener(self, func):
+        """注册状态变化回调 func(state, changed)"""
+        self.listeners.append(func)
+    
+    def get(self) -> Dict[str, Any]:
+        with self.condition:
+            return dict(self.state, events=dict(self.live))
+    
+    def set(self, **fields):
+        """更新状态，有变化时通知监听者"""
+        with self.condition:
+            changed = {key: value for key, value in fields.items() if self.state.get(key) != value}
+            self.state.update(changed)
+            state = dict(self.state)
+            # 每个事件都唤醒等待者，由等待者自行确认条件
+            self.condition.notify_all()
+        
+        if changed:
+            logger.info(f"服务状态变化: {changed}")
+            for listener in self.listeners:
+                try:
+                    listener(state, changed)
+                except Exception as e:
+                    logger.error(f"服务状态回调失败: {e}")
+    
+    def set_unit_state(self, active_state: str):
+        running = active_state in ("active", "reloading")
+        self.set(active_state=active_state, hysteria="running" if running else "stopped")
+    
+    def refresh_unit(self):
+        """主动查询单元状态（启停命令返回后、事件源不可用时）"""
+        active = system_status.unit_active(self.unit)
+        self.set(hysteria="running" if active else "stopped")
+    
+    def refresh_link(self):
+        self.set(tun_interface=system_status.interface_exists(self.interface))
+    
+    def wait_for_link(self, timeout: float) -> bool:
+        """等待网卡出现：以 sysfs 为准，netlink 事件到达时立即重新检查"""
+        deadline = time.monotonic() + timeout
+        while True:
+            if system_status.interface_exists(self.interface):
+                self.set(tun_interface=True)
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            with self.condition:
+                self.condition.wait(remaining if self.live["netlink"] else min(remaining, 0.05))
+    
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        if jeepney is None:
+            logger.warning("未安装 jeepney，无法通过 D-Bus 获取服务状态，改为读取 cgroup / systemctl 并轮询")
+        self.refresh_unit()
+        self.refresh_link()
+        for target, name in ((self._watch_unit, "watch-unit"), (self._watch_link, "watch-link")):
+            threading.Thread(target=target, name=name, daemon=True).start()
+    
+    def stop(self):
+        self.running = False
+        self.wakeup.set()
+    
+    def _watch(self, source: str, follow, refresh, available: bool):
+        """跟随事件源；失败或不可用时轮询，并定期重试"""
+        while self.running:
+            if available:
+                try:
+                    follow()
+                except Exception as e:
+                    logger.warning(f"{source} 状态监听中断，改为轮询: {e}")
+                finally:
+                    with self.condition:
+                        self.live[source] = False
+            
+            retry_at = time.monotonic() + self.RETRY_INTERVAL
+            while self.running and (not available or time.monotonic() < retry_at):
+                self.wakeup.clear()
+                try:
+                    refresh()
+                except Exception as e:
+                    logger.error(f"查询服务状态失败: {e}")
+                self.wakeup.wait(self.poll_interval())
+    
+    def _watch_unit(self):
+        self._watch("dbus", self._follow_dbus, self.refresh_unit, jeepney is not None)
+    
+    def _watch_link(self):
+        self._watch("netlink", self._follow_netlink, self.refresh_link, hasattr(socket, "AF_NETLINK"))
+    
+    def _follow_dbus(self):
+        def call(connection, message):
+            return jeepney.unwrap_msg(connection.send_and_get_reply(message, timeout=self.DBUS_TIMEOUT))
+        
+        with jeepney.io.blocking.open_dbus_connection(bus='SYSTEM') as connection:
+            manager = jeepney.DBusAddress('/org/freedesktop/systemd1', bus_name='org.freedesktop.systemd1',
+                                          interface='org.freedesktop.systemd1.Manager')
+            path, = call(connection, jeepney.new_method_call(manager, 'LoadUnit', 's', (self.unit,)))
+            rule = jeepney.MatchRule(type='signal', interface='org.freedesktop.DBus.Properties',
+                                     member='PropertiesChanged', path=path)
+            call(connection, jeepney.message_bus.AddMatch(rule))
+            # systemd 只在有订阅者时发送单元信号
+            call(connection, jeepney.new_method_call(manager, 'Subscribe'))
+            
+            with connection.filter(rule) as signals:
+                with self.condition:
+                    self.live["dbus"] = True
+                # 订阅之后再读取一次当前状态，避免漏掉订阅前的变化
+                address = jeepney.DBusAddress(path, bus_name='org.freedesktop.systemd1',
+                                              interface='org.freedesktop.systemd1.Unit')
+                (_, state), = call(connection, jeepney.Properties(address).get('ActiveState'))
+                self.set_unit_state(state)
+                logger.info(f"通过 D-Bus 监听 {self.unit} 状态")
+                
+                while self.running:
+                    try:
+                        message = connection.recv_until_filtered(signals, timeout=1.0)
+                    except TimeoutError:
+                        continue
+                    interface, changed, _ = message.body
+                    if interface == 'org.freedesktop.systemd1.Unit' and 'ActiveState' in changed:
+                        self.set_unit_state(changed['ActiveState'][1])
+    
+    def _follow_netlink(self):
+        with socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE) as sock:
+            sock.bind((0, self.RTMGRP_LINK))
+            sock.settimeout(1.0)
+            with self.condition:
+                self.live["netlink"] = True
+            self.refresh_link()
+            logger.info(f"通过 netlink 监听网卡 {self.interface}")
+            
+            while self.running:
+                try:
+                    data = sock.recv(65536)
+                except socket.timeout:
+                    continue
+                except OSError as e:
+                    # 接收缓冲区溢出时丢失了消息，重新读取一次当前状态
+                    if e.errno == errno.ENOBUFS:
+                        self.refresh_link()
+                        continue
+                    raise
+                for msg_type, name in self.parse_link_messages(data):
+                    if name == self.interface:
+                        self.set(tun_interface=msg_type == self.RTM_NEWLINK)
+    
+    @classmethod
+    def parse_link_messages(cls, data: bytes) -> Iterator[Tuple[int, str]]:
+        """解析 netlink 消息，返回 (消息类型, 网卡名)"""
+        offset = 0
+        while offset + 16 <= len(data):
+            length, msg_type = struct.unpack_from("=IH", data, offset)
+            if length < 16:
+                break
+            if msg_type in (cls.RTM_NEWLINK, cls.RTM_DELLINK):
+                # nlmsghdr(16字节) + ifinfomsg(16字节)之后是属性列表
+                attr = offset + 32
+                end = min(offset + length, len(data))
+                while attr + 4 <= end:
+                    attr_len, attr_type = struct.unpack_from("=HH", data, attr)
+                    if attr_len < 4:
+                        break
+                    if attr_type == cls.IFLA_IFNAME:
+                        yield msg_type, data[attr + 4:attr + attr_len].split(b'\0', 1)[0].decode('utf-8', 'replace')
+                        break
+                    attr += (attr_len + 3) & ~3
+            offset += (length + 3) & ~3
+
+# ==================== 状态采集器 ====================
+class StatusCollector:
+    """后台状态采集器
+
+    每个探针在独立线程中按各自的间隔刷新，结果写入内存快照，
+    /api/status 只读取快照，不再在请求线程中执行系统命令。
+    on_demand 探针（访问外部服务的连接测试）只在最近 DEMAND_WINDOW 秒内有人读取状态
+    或有SSE客户端在线时按间隔执行；request_refresh 始终立即执行。
+    多worker部署时其他进程的访问与刷新请求通过SQLite转交给 leader。
+    """
+    
+    DEMAND_WINDOW = 120
+    IDLE_POLL = 5
+    
+    def __init__(self):
+        self.probes = {}
+        self.snapshot = {}
+        self.listeners = []
+        self.lock = threading.Lock()
+        self.running = False
+        self.storage = None
+        self.last_demand = 0.0
+    
+    def register(self, name: str, func, interval: float, default: Optional[Dict] = None, on_demand: bool = False):
+        """注册探针"""
+        self.probes[name] = {
+            "func": func,
+            "interval": interval,
+            "on_demand": on_demand,
+            "forced": False,
+            "last_run": 0.0,
+            "wakeup": threading.Event(),
+            "thread": None
+        }
+        self.snapshot[name] = dict(default or {}, collected_at=None)
+    
+    def add_listener(self, func):
+        """注册结果回调 func(name, entry)"""
+        self.listeners.append(func)
+    
+    def start(self, storage: Optional[Storage] = None):
+        """启动所有探针线程，提供 storage 时把结果共享给其他worker进程"""
+        if self.running:
+            return
+        self.running = True
+        self.storage = storage
+        for name, probe in self.probes.items():
+            probe["thread"] = threading.Thread(
+                target=self._run_probe, args=(name,), name=f"collector-{name}", daemon=True
+            )
+            probe["thread"].start()
+        logger.info(f"状态采集器已启动: {', '.join(self.probes)}")
+    
+    def stop(self):
+        """停止所有探针线程"""
+        self.running = False
+        for probe in self.probes.values():
+            probe["wakeup"].set()
+    
+    def request_refresh(self, *names: str):
+        """立即刷新指定探针（服务启停、切换节点后调用）"""
+        if not self.running:
+            # 采集器运行在 leader 进程中，通过共享存储转交
+            pending = set(storage.get_value("status_refresh") or [])
+            storage.set_value("status_refresh", sorted(pending | set(names)))
+            return
+        for name in names:
+            probe = self.probes.get(name)
+            if probe:
+                probe["forced"] = True
+                probe["wakeup"].set()
+    
+    def touch(self):
+        """记录一次状态读取，唤醒空闲的按需探针"""
+        self.last_demand = time.time()
+        for probe in self.probes.values():
+            if probe["on_demand"]:
+                probe["wakeup"].set()
+    
+    def local_demand(self) -> bool:
+        """本进程最近是否有人读取状态"""
+        return event_bus.client_count() > 0 or time.time() - self.last_demand < self.DEMAND_WINDOW
+    
+    def has_demand(self) -> bool:
+        """任一进程最近是否有人读取状态"""
+        if self.local_demand():
+            return True
+        shared = self.storage.get_value("status_demand") if self.storage is not None else None
+        return bool(shared) and time.time() - shared < self.DEMAND_WINDOW
+    
+    def update(self, name: str, value: Dict[str, Any]):
+        """写入探针结果"""
+        entry = dict(value, collected_at=datetime.now().isoformat())
+        self.apply(name, entry)
+        if self.storage is not None:
+            self.storage.set_value(f"status:{name}", entry)
+    
+    def apply(self, name: str, entry: Dict[str, Any]):
+        """更新快照（本进程采集或来自共享状态），内容变化时推送事件"""
+        with self.lock:
+            previous = self.snapshot.get(name) or {}
+            self.snapshot[name] = entry
+        
+        def content(item):
+            return {k: v for k, v in item.items() if k != "collected_at"}
+        
+        if content(previous) != content(entry):
+            event_bus.publish(name, entry)
+        for listener in self.listeners:
+            listener(name, entry)
+    
+    def get(self, name: str) -> Dict[str, Any]:
+        """获取单个探针的最新结果"""
+        with self.lock:
+            return dict(self.snapshot.get(name) or {})
+    
+    def get_snapshot(self) -> Dict[str, Dict[str, Any]]:
+        """获取完整快照"""
+        with self.lock:
+            return {name: dict(value) for name, value in self.snapshot.items()}
+    
+    def _run_probe(self, name: str):
+        probe = self.probes[name]
+        while self.running:
+            probe["wakeup"].clear()
+            due = time.time() - probe["last_run"] >= probe["interval"]
+            if probe["forced"] or (due and (not probe["on_demand"] or self.has_demand())):
+                probe["forced"] = False
+                probe["last_run"] = time.time()
+                try:
+                    self.update(name, probe["func"]())
+                except Exception as e:
+                    logger.error(f"状态探针 {name} 执行失败: {e}")
+            # 按需探针空闲时定期检查其他进程的访问记录
+            probe["wakeup"].wait(min(probe["interval"], self.IDLE_POLL) if probe["on_demand"] else probe["interval"])
+
+# ==================== 流量采样 ====================
+class TrafficSampler:
+    """按固定间隔采样 /proc/net/dev，计算各网卡收发速率
+
+    秒级采样写入环形缓冲区，并逐级汇总为分钟、小时平均值，
+    三个级别各自保留固定数量的点。分钟与小时数据保存在 STATS_FILE，
+    重启后继续累积。汇总时 hytun 单独统计，总量不含回环网卡。
+    """
+    
+    TUN_INTERFACE = "hytun"
+    # 级别: (每个点的秒数, 保留点数)
+    RESOLUTIONS = {
+        "1s": (1, 300),      # 最近5分钟
+        "1m": (60, 1440),    # 最近24小时
+        "1h": (3600, 720)    # 最近30天
+    }
+    
+    def __init__(self, manager: 'Hysteria2Manager'):
+        self.manager = manager
+        self.lock = threading.Lock()
+        self.series = {name: deque(maxlen=size) for name, (_, size) in self.RESOLUTIONS.items()}
+        self.buckets = {}
+        self.previous = None
+        self.interfaces = {}
+        self.totals = {"rx": 0, "tx": 0}
+        self.tun_since = None
+        self.thread = None
+        self.running = False
+        self.persist = False
+        
+        # 恢复持久化的历史数据
+        history = manager.stats.get("traffic", {})
+        for name in ("1m", "1h"):
+            self.series[name].extend(history.get(name, []))
+    
+    def sample(self, now: Optional[float] = None):
+        """采样一次并更新速率与汇总"""
+        now = now or time.time()
+        counters = read_net_dev()
+        
+        with self.lock:
+            previous, self.previous = self.previous, (now, counters)
+            if previous is None:
+                return
+            elapsed = now - previous[0]
+            if elapsed <= 0:
+                return
+            
+            interfaces = {}
+            for name, (rx, tx) in counters.items():
+                old_rx, old_tx = previous[1].get(name, (rx, tx))
+                # 计数器回绕或网卡重建时以当前值为增量起点
+                rx_delta = rx - old_rx if rx >= old_rx else rx
+                tx_delta = tx - old_tx if tx >= old_tx else tx
+                interfaces[name] = {
+                    "rx_rate": round(rx_delta / elapsed, 1),
+                    "tx_rate": round(tx_delta / elapsed, 1),
+                    "rx_bytes": rx,
+                    "tx_bytes": tx
+                }
+            self.interfaces = interfaces
+            self.totals = {
+                "rx": sum(rx for name, (rx, _) in counters.items() if name != "lo"),
+                "tx": sum(tx for name, (_, tx) in counters.items() if name != "lo")
+            }
+            
+            tun = interfaces.get(self.TUN_INTERFACE)
+            if tun is None:
+                self.tun_since = None
+            elif self.tun_since is None:
+                self.tun_since = now
+            
+            point = {
+                "t": int(now),
+                "rx": round(sum(v["rx_rate"] for k, v in interfaces.items() if k != "lo"), 1),
+                "tx": round(sum(v["tx_rate"] for k, v in interfaces.items() if k != "lo"), 1),
+                "tun_rx": tun["rx_rate"] if tun else 0.0,
+                "tun_tx": tun["tx_rate"] if tun else 0.0
+            }
+            self.series["1s"].append(point)
+            minute_flushed = self._rollup("1m", point)
+            if minute_flushed:
+                self._rollup("1h", self.series["1m"][-1])
+        
+        event_bus.publish("traffic", point)
+        
+        # 每完成一个分钟汇总点持久化一次（多进程时只由 leader 写入）
+        if minute_flushed and self.persist:
+            self.save()
+    
+    def _rollup(self, name: str, point: Dict[str, Any]) -> bool:
+        """把一个点累加到该级别的当前时间桶，桶结束时写入平均值，返回是否写入"""
+        step = self.RESOLUTIONS[name][0]
+        start = point["t"] - point["t"] % step
+        bucket = self.buckets.get(name)
+        flushed = False
+        if bucket and bucket["t"] != start:
+            count = bucket.pop("count")
+            self.series[name].append({k: (v if k == "t" else round(v / count, 1)) for k, v in bucket.items()})
+            bucket = None
+            flushed = True
+        if bucket is None:
+            bucket = self.buckets[name] = {"t": start, "rx": 0.0, "tx": 0.0, "tun_rx": 0.0, "tun_tx": 0.0, "count": 0}
+        for key in ("rx", "tx", "tun_rx", "tun_tx"):
+            bucket[key] += point[key]
+        bucket["count"] += 1
+        return flushed
+    
+    def save(self):
+        """保存分钟与小时数据（提交到后台写入线程）"""
+        with self.lock:
+            self.manager.stats["traffic"] = {name: list(self.series[name]) for name in ("1m", "1h")}
+            data = copy.deepcopy(self.manager.stats)
+        persistence_writer.submit(STATS_FILE, data)
+    
+    def resolution_for(self, seconds: int) -> str:
+        """选择能覆盖指定时长的最细级别"""
+        for name, (step, size) in self.RESOLUTIONS.items():
+            if seconds <= step * size:
+                return name
+        return "1h"
+    
+    def get_series(self, resolution: str, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """获取指定级别的速率序列"""
+        with self.lock:
+            points = list(self.series[resolution])
+        return points[-limit:] if limit else points
+    
+    def get_current(self) -> Dict[str, Any]:
+        """获取最新的速率、累计流量与各网卡数据"""
+        with self.lock:
+            latest = self.series["1s"][-1] if self.series["1s"] else None
+            return {
+                "rate": {"up": latest["tx"], "down": latest["rx"]} if latest else {"up": 0, "down": 0},
+                "tun_rate": {"up": latest["tun_tx"], "down": latest["tun_rx"]} if latest else {"up": 0, "down": 0},
+                "totals": dict(self.totals),
+                "interfaces": copy.deepcopy(self.interfaces),
+                "tun_uptime": int(time.time() - self.tun_since) if self.tun_since else 0
+            }
+    
+    def start(self):
+        """启动采样线程"""
+        if self.running:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name="traffic-sampler", daemon=True)
+        self.thread.start()
+    
+    def stop(self):
+        self.running = False
+    
+    def _run(self):
+        interval = self.RESOLUTIONS["1s"][0]
+        while self.running:
+            started = time.monotonic()
+            try:
+                self.sample()
+            except Exception as e:
+                logger.error(f"流量采样失败: {e}")
+            # 按固定节拍采样，扣除本次采样的耗时
+            time.sleep(max(0.0, interval - (time.monotonic() - started)))
+
+def collect_traffic_stats() -> Dict[str, Any]:
+    """流量统计探针（读取采样器的最新数据）"""
+    current = traffic_sampler.get_current()
+    totals = current["totals"]
+    return {
+        "traffic": {
+            "up": totals["tx"],
+            "down": totals["rx"],
+            "total": totals["tx"] + totals["rx"],
+            "rate_up": current["rate"]["up"],
+            "rate_down": current["rate"]["down"],
+            "tun_rate_up": current["tun_rate"]["up"],
+            "tun_rate_down": current["tun_rate"]["down"]
+        },
+        "connections": count_tcp_connections(),
+        "uptime": current["tun_uptime"]
+    }
+
+# ==================== 节点测速 ====================
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    """计算百分位数（最近秩法）"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, math.ceil(pct / 100.0 * len(ordered)) - 1)
+    return round(ordered[index], 2)
+
+def build_quic_probe() -> bytes:
+    """构造QUIC长包头探测包
+
+    使用保留版本号 0x?a?a?a?a（RFC 9000 第15节），QUIC服务端收到后会
+    立即回复版本协商包，无需完成TLS握手即可测得往返时延。
+    数据报按协议要求填充到1200字节。
+    """
+    dcid = os.urandom(8)
+    scid = os.urandom(8)
+    header = bytes([0xc0 | (os.urandom(1)[0] & 0x0f)])
+    header += b'\x1a\x2a\x3a\x4a'
+    header += bytes([len(dcid)]) + dcid + bytes([len(scid)]) + scid
+    return header + b'\x00' * (1200 - len(header))
+
+SO_BINDTODEVICE = getattr(socket, "SO_BINDTODEVICE", 25)
+
+def get_default_interface() -> Optional[str]:
+    """从 /proc/net/route 读取默认路由所在的物理网卡（排除TUN）"""
+    best = None
+    try:
+        with open('/proc/net/route', 'r') as f:
+            for line in f.readlines()[1:]:
+                fields = line.split()
+                if len(fields) < 7 or fields[1] != "00000000" or fields[0] == "hytun":
+                    continue
+                metric = int(fields[6])
+                if best is None or metric < best[1]:
+                    best = (fields[0], metric)
+    except (OSError, ValueError):
+        return None
+    return best[0] if best else None
+
+def find_free_port() -> int:
+    """获取一个空闲的本地TCP端口"""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+class NodeBenchmark:
+    """节点测速引擎
+
+    快速模式只测量到 server:port 的UDP/QUIC往返时延与丢包；
+    完整模式额外在隔离的SOCKS端口上启动一个临时hysteria客户端，
+    通过它完成一次限时下载以测量吞吐量。
+    """
+    
+    def __init__(self, manager: 'Hysteria2Manager'):
+        self.manager = manager
+    
+    def settings(self) -> Dict[str, Any]:
+        """读取测速配置"""
+        return dict(DEFAULT_CONFIG["benchmark"], **self.manager.config.get("benchmark", {}))
+    
+    def probe_udp_rtt(self, host: str, port: int, samples: int, timeout: float) -> Dict[str, Any]:
+        """向 host:port 发送QUIC探测包并统计往返时延"""
+        rtts = []
+        addresses = dns_cache.resolve(host)
+        if not addresses:
+            return {"rtts": [], "sent": samples, "error": "解析失败"}
+        family = socket.AF_INET6 if ':' in addresses[0] else socket.AF_INET
+        address = (addresses[0], port)
+        
+        interface = None if ipaddress.ip_address(address[0]).is_loopback else self.bind_interface()
+        for _ in range(samples):
+            # 每次探测使用独立的socket，收到的任何应答都属于本次探测
+            with socket.socket(family, socket.SOCK_DGRAM) as sock:
+                sock.settimeout(timeout)
+                try:
+                    if interface:
+                        # 绑定物理网卡，避免探测流量经过当前节点的TUN
+                        sock.setsockopt(socket.SOL_SOCKET, SO_BINDTODEVICE, interface.encode())
+                    sock.connect(address)
+                    started = time.monotonic()
+                    sock.send(build_quic_probe())
+                    sock.recv(2048)
+                    rtts.append((time.monotonic() - started) * 1000)
+                except OSError:
+                    continue
+        
+        return {"rtts": rtts, "sent": samples, "address": address[0]}
+    
+    def bind_interface(self) -> Optional[str]:
+        """确定探测流量使用的出口网卡"""
+        interface = self.settings().get("bind_interface")
+        if interface != "auto":
+            return interface or None
+        return get_default_interface()
+    
+    def measure_throughput(self, node: Dict[str, Any], settings: Dict[str, Any]) -> Dict[str, Any]:
+        """通过临时hysteria客户端进行限时下载测速"""
+        bin_path = self.manager.config.get("hysteria", {}).get("bin_path", str(HYSTERIA_BIN))
+        if not Path(bin_path).exists():
+            return {"error": "hysteria 程序不存在"}
+        
+        socks_port = find_free_port()
+        config = self.manager.build_client_config(node)
+        config["socks5"] = {"listen": f"127.0.0.1:{socks_port}"}
+        
+        with tempfile.NamedTemporaryFile('w', suffix='.yaml', prefix='hy2-bench-', delete=False) as f:
+            yaml.dump(config, f, default_flow_style=False, allow_unicode=True, sort_keys=False)
+            config_path = f.name
+        
+        process = None
+        try:
+            process = subprocess.Popen(
+                [bin_path, "client", "-c", config_path],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL
+            )
+            
+            # 等待SOCKS端口就绪
+            deadline = time.monotonic() + 5
+            while time.monotonic() < deadline:
+                if process.poll() is not None:
+                    return {"error": "hysteria 客户端启动失败"}
+                try:
+                    socket.create_connection(("127.0.0.1", socks_port), timeout=0.2).close()
+                    break
+                except OSError:
+                    time.sleep(0.1)
+            else:
+                return {"error": "hysteria 客户端启动超时"}
+            
+            return self.timed_download(settings["download_url"], settings["download_timeout"],
+                                       proxy=f"127.0.0.1:{socks_port}")
+        finally:
+            if process and process.poll() is None:
+                process.terminate()
+                try:
+                    process.wait(timeout=2)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+            os.unlink(config_path)
+    
+    def timed_download(self, url: str, timeout: float, proxy: Optional[str] = None) -> Dict[str, Any]:
+        """限时下载并计算吞吐量"""
+        cmd = ["curl", "-s", "-o", "/dev/null", "-m", str(timeout),
+               "-w", "%{http_code} %{size_download} %{time_total}"]
+        if proxy:
+            cmd += ["--socks5-hostname", proxy]
+        cmd.append(url)
+        
+        # curl 超时返回28，但已下载的部分仍可用于计算吞吐量
+        ret, stdout, stderr = run_command(cmd, timeout=int(timeout) + 5)
+        try:
+            _, size, elapsed = stdout.split()
+            size, elapsed = int(float(size)), float(elapsed)
+        except ValueError:
+            return {"error": stderr.strip() or f"curl 返回 {ret}"}
+        
+        if size == 0 or elapsed <= 0:
+            return {"error": f"下载失败 (curl 返回 {ret})"}
+        
+        return {
+            "bytes": size,
+            "seconds": round(elapsed, 3),
+            "throughput_mbps": round(size * 8 / elapsed / 1e6, 2)
+        }
+    
+    def benchmark_node(self, node: Dict[str, Any], full: bool = False) -> Dict[str, Any]:
+        """测试单个节点"""
+        settings = self.settings()
+        probe = self.probe_udp_rtt(node["server"], int(node["port"]),
+                                   int(settings["samples"]), float(settings["timeout"]))
+        rtts = probe["rtts"]
+        
+        result = {
+            "node_id": node["id"],
+            "mode": "full" if full else "quick",
+            "tested_at": datetime.now().isoformat(),
+            "samples": probe["sent"],
+            "rtt_min": round(min(rtts), 2) if rtts else None,
+            "rtt_p50": percentile(rtts, 50),
+            "rtt_p95": percentile(rtts, 95),
+            "loss": round(1 - len(rtts) / probe["sent"], 3) if probe["sent"] else 1.0,
+            "throughput_mbps": None
+        }
+        if probe.get("error"):
+            result["error"] = probe["error"]
+        
+        if full and rtts:
+            download = self.measure_throughput(node, settings)
+            result["download"] = download
+            result["throughput_mbps"] = download.get("throughput_mbps")
+        
+        self.record(node["id"], result)
+        return result
+    
+    def benchmark_nodes(self, nodes: List[Dict[str, Any]], full: bool = False, progress=None,
+                        cancelled: Optional[threading.Event] = None) -> Dict[str, Dict[str, Any]]:
+        """并发测试多个节点；progress(完成数, 总数) 报告进度，cancelled 被设置后不再开始新的测试"""
+        if not nodes:
+            return {}
+        
+        workers = max(1, min(int(self.settings()["concurrency"]), len(nodes)))
+        results = {}
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="benchmark") as executor:
+            benchmark_node = tracer.bind(self.benchmark_node)
+            futures = {executor.submit(benchmark_node, node, full): node["id"] for node in nodes}
+            for future in as_completed(futures):
+                node_id = futures[future]
+                if future.cancelled():
+                    continue
+                try:
+                    results[node_id] = future.result()
+                except Exception as e:
+                    logger.error(f"节点测速失败 {node_id}: {e}")
+                    results[node_id] = {"node_id": node_id, "error": str(e)}
+                if progress:
+                    progress(len(results), len(nodes))
+                if cancelled is not None and cancelled.is_set():
+                    for pending in futures:
+                        pending.cancel()
+        
+        logger.info(f"完成 {len(results)} 个节点的测速")
+        return {node["id"]: results[node["id"]] for node in nodes if node["id"] in results}
+    
+    def record(self, node_id: str, result: Dict[str, Any]):
+        """记录测速结果到历史"""
+        self.manager.storage.add_benchmark(node_id, result, int(self.settings()["history_size"]))
+    
+    def get_history(self, node_id: str) -> List[Dict[str, Any]]:
+        """获取节点测速历史"""
+        return self.manager.storage.get_benchmarks(node_id)
+    
+    def latest(self) -> Dict[str, Dict[str, Any]]:
+        """获取每个节点最近一次测速结果"""
+        return self.manager.storage.latest_benchmarks()
+
+# ==================== 自动故障切换 ====================
+class FailoverScheduler:
+    """节点自动选优与故障切换调度器
+
+    每个周期只对当前节点做快速测速并打分。当前节点连续多次低于阈值时，
+    按最近一次测速结果取前 candidates 个候选节点重新测速，切换到得分最高且
+    领先幅度超过滞后区间的节点；两次切换之间受冷却时间约束，避免来回抖动。
+    切换通过服务任务执行，与手动操作依次进行。每次决策都会记录到事件日志。
+    """
+    
+    def __init__(self, manager: 'Hysteria2Manager', benchmark: NodeBenchmark):
+        self.manager = manager
+        self.benchmark = benchmark
+        self.events = deque(maxlen=200)
+        self.scores = {}
+        self.bad_checks = 0
+        self.last_switch = 0.0
+        self.manual = False
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.running = False
+        self.shared = False
+    
+    def settings(self) -> Dict[str, Any]:
+        """读取故障切换配置"""
+        return dict(DEFAULT_CONFIG["failover"], **self.manager.config.get("failover", {}))
+    
+    @staticmethod
+    def score(history: List[Dict[str, Any]]) -> float:
+        """根据最近的测速结果计算节点得分(0-100)"""
+        recent = [entry for entry in history[-3:] if "loss" in entry]
+        if not recent:
+            return 0.0
+        
+        scores = []
+        for entry in recent:
+            if entry.get("rtt_p50") is None:
+                scores.append(0.0)
+                continue
+            # 延迟: 0ms=100分，每增加10ms扣1分；丢包按比例扣减
+            latency_score = max(0.0, 100 - entry["rtt_p50"] / 10)
+            value = latency_score * (1 - entry["loss"])
+            if entry.get("throughput_mbps") is not None:
+                value = value * 0.7 + min(100.0, entry["throughput_mbps"]) * 0.3
+            scores.append(value)
+        
+        return round(sum(scores) / len(scores), 1)
+    
+    def log_event(self, action: str, reason: str, **details):
+        """记录调度决策"""
+        event = {"time": datetime.now().isoformat(), "action": action, "reason": reason}
+        event.update(details)
+        with self.lock:
+            self.events.append(event)
+        if action == "switch":
+            logger.warning(f"故障切换: {reason}")
+    
+    def rescore(self, nodes: List[Dict[str, Any]]) -> Dict[str, float]:
+        """测速指定节点并更新得分"""
+        self.benchmark.benchmark_nodes(nodes)
+        scores = {node["id"]: self.score(self.benchmark.get_history(node["id"])) for node in nodes}
+        with self.lock:
+            self.scores.update(scores)
+        return scores
+    
+    def candidates(self, current: Optional[str], count: int) -> List[Dict[str, Any]]:
+        """按最近一次测速结果选出得分最高的 count 个候选节点（未测速的节点排在最后）"""
+        latest = self.benchmark.latest()
+        all_nodes = self.manager.get_nodes()
+        ids = {node["id"] for node in all_nodes}
+        with self.lock:
+            # 去掉已删除节点的得分
+            self.scores = {node_id: score for node_id, score in self.scores.items() if node_id in ids}
+        nodes = [node for node in all_nodes if node["id"] != current]
+        
+        def rank(node):
+            entry = latest.get(node["id"])
+            return self.score([entry]) if entry else -1.0
+        # sorted 是稳定排序，得分相同（包括未测速）时保持节点列表顺序
+        return sorted(nodes, key=rank, reverse=True)[:max(1, count)]
+    
+    def evaluate(self) -> Dict[str, Any]:
+        """测速当前节点并判断是否需要切换；只有需要切换时才重新测速前几名候选节点"""
+        settings = self.settings()
+        current = self.manager.current_node_id
+        node = self.manager.get_node(current) if current else None
+        if node is None:
+            # 没有当前节点时只观察候选节点
+            scores = self.rescore(self.candidates(None, int(settings["candidates"])))
+            if not scores:
+                self.log_event("skip", "没有可用节点")
+                return {}
+            best = max(scores, key=scores.get)
+            details = {"current": current, "current_score": None, "best": best, "best_score": scores[best]}
+            self.log_event("hold" if settings["enabled"] else "observe", "未选择当前节点", **details)
+            return details
+        
+        current_score = self.rescore([node])[current]
+        details = {"current": current, "current_score": current_score}
+        
+        if not settings["enabled"]:
+            scores = self.rescore(self.candidates(current, int(settings["candidates"])))
+            if scores:
+                best = max(scores, key=scores.get)
+                details.update(best=best, best_score=scores[best])
+            self.log_event("observe", "自动切换未启用", **details)
+            return details
+        if self.manager.service_status["hysteria"] != "running":
+            self.log_event("hold", "服务未运行", **details)
+            return details
+        
+        # 当前节点是否健康（需连续多次低于阈值才判定为故障）
+        if current_score >= settings["min_score"]:
+            self.bad_checks = 0
+            self.log_event("hold", "当前节点健康", **details)
+            return details
+        
+        self.bad_checks += 1
+        details["bad_checks"] = self.bad_checks
+        if self.bad_checks < settings["fail_threshold"]:
+            self.log_event("hold", f"当前节点低于阈值 {settings['min_score']}，等待确认", **details)
+            return details
+        
+        remaining = settings["cooldown"] - (time.time() - self.last_switch)
+        if remaining > 0:
+            self.log_event("cooldown", f"冷却中，{int(remaining)} 秒后允许切换", **details)
+            return details
+        
+        # 候选节点需达到阈值并超出当前节点一个滞后区间
+        scores = self.rescore(self.candidates(current, int(settings["candidates"])))
+        if not scores:
+            self.log_event("hold", "没有候选节点", **details)
+            return details
+        best = max(scores, key=scores.get)
+        details.update(best=best, best_score=scores[best])
+        if scores[best] < settings["min_score"] or scores[best] < current_score + settings["hysteresis"]:
+            self.log_event("hold", "没有明显更优的候选节点", **details)
+            return details
+        
+        # 与所有worker的手动切换、启停服务共用服务任务槽位，依次执行
+        def action():
+            # 排队期间节点可能已被其他操作切换，此时放弃本次切换
+            if self.manager.current_node_id != current:
+                return {"success": False, "message": "当前节点已被其他操作切换"}, 409
+            success, message, switch = self.manager.use_node(best)
+            return {"success": success, "message": message, "data": {"switch": switch}}, 200 if success else 400
+        job, deduplicated = job_manager.submit_service("自动切换节点", action, replace=False)
+        if job is None or deduplicated:
+            self.log_event("hold", "有其他服务操作正在进行，本次不切换", **details)
+            return details
+        
+        details["job_id"] = job["id"]
+        job = job_manager.wait(job["id"], timeout=120)
+        result = job.get("result") or {}
+        switch = (result.get("data") or {}).get("switch")
+        if switch:
+            details["switchover_ms"] = switch["switchover_ms"]
+        if job["status"] == "succeeded":
+            self.last_switch = time.time()
+            self.bad_checks = 0
+            self.log_event("switch", f"{current}({current_score}) -> {best}({scores[best]})", **details)
+        elif job.get("status_code") == 409:
+            self.bad_checks = 0
+            self.log_event("hold", result["message"], **details)
+        else:
+            self.log_event("error", f"切换失败: {result.get('message') or job['message']}", **details)
+        return details
+    
+    def start(self, shared: bool = False):
+        """启动调度线程，shared 为真时把状态写入共享存储供其他worker读取"""
+        if self.running:
+            return
+        self.running = True
+        self.shared = shared
+        self.thread = threading.Thread(target=self._run, name="failover", daemon=True)
+        self.thread.start()
+    
+    def stop(self):
+        self.running = False
+        self.wakeup.set()
+    
+    def trigger(self):
+        """立即执行一次评估（未启用自动切换时只测速打分）"""
+        if not self.running:
+            # 调度器运行在 leader 进程中，通过共享存储转交
+            self.manager.storage.set_value("failover_trigger", time.time())
+            return
+        self.manual = True
+        self.wakeup.set()
+    
+    def get_state(self) -> Dict[str, Any]:
+        """获取调度器状态与事件日志"""
+        if not self.running:
+            shared = self.manager.storage.get_value("failover_state")
+            if shared:
+                return dict(shared, settings=self.settings())
+        with self.lock:
+            return {
+                "settings": self.settings(),
+                "scores": dict(self.scores),
+                "bad_checks": self.bad_checks,
+                "last_switch": datetime.fromtimestamp(self.last_switch).isoformat() if self.last_switch else None,
+                "events": list(self.events)
+            }
+    
+    def _run(self):
+        while self.running:
+            self.wakeup.clear()
+            if self.settings()["enabled"] or self.manual:
+                self.manual = False
+                try:
+                    self.evaluate()
+                except Exception as e:
+                    logger.error(f"故障切换评估失败: {e}")
+                if self.shared:
+                    self.manager.storage.set_value("failover_state", self.get_state())
+            self.wakeup.wait(self.settings()["interval"])
+
+# ==================== 日志读取 ====================
+class LogReader:
+    """日志读取服务
+
+    文件日志从末尾按块向前查找换行，读取最后N行只需读取约N行的数据；
+    journald 通过 --show-cursor / --after-cursor 增量读取。
+    游标格式：文件为 "file:<inode>:<偏移量>"，journald 为 "journal:<游标>"。
+    文件被轮转或截断（inode变化、长度小于偏移量）时重新从末尾读取并标记 reset。
+    """
+    
+    BLOCK_SIZE = 8192
+    MAX_LINES = 5000
+    MAX_READ_BYTES = 4 * 1024 * 1024
+    SOURCES = {
+        "hysteria": {"unit": "hysteria2-client", "file": LOG_DIR / "hysteria.log"},
+        "manager": {"unit": "hysteria2-manager", "file": LOG_DIR / "manager.log"}
+    }
+    
+    def __init__(self):
+        self.has_journal = shutil.which("journalctl") is not None
+    
+    @staticmethod
+    def format_journal_entry(entry: Dict[str, Any]) -> str:
+        """把 journalctl -o json 的一条记录格式化为与默认 short 输出相同的文本行"""
+        message = entry.get("MESSAGE") or ""
+        if isinstance(message, list):
+            # 非UTF-8内容以字节数组表示
+            message = bytes(message).decode('utf-8', errors='replace')
+        timestamp = datetime.fromtimestamp(int(entry.get("__REALTIME_TIMESTAMP", 0)) / 1e6)
+        identifier = entry.get("SYSLOG_IDENTIFIER") or entry.get("_COMM") or ""
+        if entry.get("_PID"):
+            identifier += f"[{entry['_PID']}]"
+        return f"{timestamp.strftime('%b %d %H:%M:%S')} {entry.get('_HOSTNAME', '')} {identifier}: {message}"
+    
+    @classmethod
+    def tail_file(cls, path: Path, lines: int) -> Tuple[List[str], str]:
+        """读取文件最后 lines 行，返回 (行列表, 游标)"""
+        with open(path, 'rb') as f:
+            inode = os.fstat(f.fileno()).st_ino
+            f.seek(0, os.SEEK_END)
+            end = f.tell()
+            position = end
+            data = b''
+            # 多读一个换行，保证第一行完整
+            while position > 0 and data.count(b'\n') <= lines:
+                step = min(cls.BLOCK_SIZE, position)
+                position -= step
+                f.seek(position)
+                data = f.read(step) + data
+        
+        # 末尾未写完的行留给下一次增量读取
+        complete = data.rfind(b'\n') + 1
+        offset = end - (len(data) - complete)
+        chunk = data[:complete].splitlines()
+        if position > 0:
+            chunk = chunk[1:]
+        return [line.decode('utf-8', errors='replace') for line in chunk[-lines:]], f"file:{inode}:{offset}"
+    
+    @classmethod
+    def read_file_since(cls, path: Path, cursor: str, lines: int) -> Dict[str, Any]:
+        """从游标位置读取新增的行"""
+        try:
+            _, inode, offset = cursor.split(':')
+            inode, offset = int(inode), int(offset)
+        except ValueError:
+            inode, offset = None, None
+        
+        stat = path.stat()
+        if inode != stat.st_ino or offset > stat.st_size:
+            new_lines, new_cursor = cls.tail_file(path, lines)
+            return {"lines": new_lines, "cursor": new_cursor, "reset": True}
+        
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            data = f.read(cls.MAX_READ_BYTES)
+        complete = data.rfind(b'\n') + 1
+        chunk = data[:complete].splitlines()
+        # 新增内容超过 lines 行时只返回最后 lines 行
+        truncated = len(chunk) > lines
+        return {
+            "lines": [line.decode('utf-8', errors='replace') for line in chunk[-lines:]],
+            "cursor": f"file:{inode}:{offset + complete}",
+            "reset": truncated
+        }
+    
+    def read_journal(self, unit: str, lines: int, after: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """读取journald日志，不可用或没有记录时返回None"""
+        if not self.has_journal:
+            return None
+        cmd = ["journalctl", "-u", unit, "-n", str(lines), "--no-pager", "--show-cursor"]
+        if after:
+            cmd.append(f"--after-cursor={after}")
+        ret, stdout, _ = run_command(cmd, timeout=10)
+        if ret != 0:
+            return None
+        
+        output = [line for line in stdout.split('\n') if line.strip()]
+        cursor = after
+        if output and output[-1].startswith("-- cursor: "):
+            cursor = output.pop()[len("-- cursor: "):]
+        output = [line for line in output if not line.startswith("-- No entries --")]
+        if cursor is None:
+            return None
+        return {"lines": output, "cursor": f"journal:{cursor}", "reset": False}
+    
+    def read(self, source: str, lines: int, cursor: Optional[str] = None) -> Dict[str, Any]:
+        """读取指定来源的日志，提供游标时只返回游标之后的新行"""
+        lines = max(1, min(lines, self.MAX_LINES))
+        spec = self.SOURCES[source]
+        
+        if cursor and cursor.startswith("journal:"):
+            result = self.read_journal(spec["unit"], lines, cursor[len("journal:"):])
+            if result is not None:
+                return result
+        elif cursor and cursor.startswith("file:") and spec["file"].exists():
+            return self.read_file_since(spec["file"], cursor, lines)
+        
+        # 首次读取：优先journald，其次日志文件
+        result = self.read_journal(spec["unit"], lines)
+        if result is not None and result["lines"]:
+            return dict(result, reset=bool(cursor))
+        if spec["file"].exists():
+            file_lines, file_cursor = self.tail_file(spec["file"], lines)
+            return {"lines": file_lines, "cursor": file_cursor, "reset": bool(cursor)}
+        return result or {"lines": [], "cursor": None, "reset": bool(cursor)}
+    
+    @staticmethod
+    def encode_cursor(cursors: Dict[str, Optional[str]]) -> str:
+        """把各来源的游标编码为一个不透明字符串"""
+        return base64.urlsafe_b64encode(json.dumps(cursors).encode()).decode().rstrip('=')
+    
+    @staticmethod
+    def decode_cursor(value: Optional[str]) -> Dict[str, Optional[str]]:
+        if not value:
+            return {}
+        try:
+            decoded = json.loads(base64.urlsafe_b64decode(value + '=' * (-len(value) % 4)))
+            return decoded if isinstance(decoded, dict) else {}
+        except (ValueError, TypeError):
+            return {}
+
+class LogSubscription:
+    """日志流订阅者：服务端过滤，有界缓冲
+
+    缓冲区满时丢弃最旧的行并计数，由推送端通知客户端丢弃了多少行，
+    消费慢的客户端不会阻塞跟随线程，也不会让内存无限增长。
+    """
+    
+    LEVELS = {"debug": 10, "info": 20, "warn": 30, "warning": 30, "error": 40, "fatal": 50, "critical": 50}
+    LEVEL_PATTERN = re.compile(r'\b(DEBUG|INFO|WARN(?:ING)?|ERROR|FATAL|CRITICAL)\b', re.IGNORECASE)
+    BUFFER_SIZE = 1000
+    
+    def __init__(self, sources: Iterable[str], level: Optional[str] = None, pattern: Optional[str] = None):
+        self.sources = set(sources)
+        self.min_level = self.LEVELS.get((level or "").lower(), 0)
+        self.pattern = re.compile(pattern) if pattern else None
+        self.buffer = deque(maxlen=self.BUFFER_SIZE)
+        self.dropped = 0
+        self.closed = None
+        self.cond = threading.Condition()
+    
+    def matches(self, source: str, line: str) -> bool:
+        if source not in self.sources:
+            return False
+        if self.min_level:
+            match = self.LEVEL_PATTERN.search(line)
+            if match and self.LEVELS[match.group(1).lower()] < self.min_level:
+                return False
+        return not self.pattern or bool(self.pattern.search(line))
+    
+    def offer(self, source: str, line: str):
+        if not self.matches(source, line):
+            return
+        with self.cond:
+            if len(self.buffer) == self.buffer.maxlen:
+                self.dropped += 1
+            self.buffer.append((source, line))
+            self.cond.notify()
+    
+    def close(self, source: str, message: str):
+        """跟随器停止时结束订阅，推送端发送 end 事件后关闭连接"""
+        with self.cond:
+            self.closed = {"source": source, "message": message}
+            self.cond.notify()
+    
+    def drain(self, timeout: float) -> Tuple[List[Tuple[str, str]], int]:
+        """取出缓冲的所有行，返回 (行列表, 期间丢弃的行数)"""
+        with self.cond:
+            if not self.buffer and self.closed is None:
+                self.cond.wait(timeout)
+            items = list(self.buffer)
+            self.buffer.clear()
+            dropped, self.dropped = self.dropped, 0
+        return items, dropped
+
+class LogFollower:
+    """单个日志来源的共享跟随器
+
+    有订阅者时才启动：journald 可用时运行一个 journalctl -f 进程，否则按游标轮询日志文件；
+    新行分发给所有订阅者，最后一个订阅者离开后停止。
+    journalctl 以 JSON 输出，记录已分发的最后一行的游标；进程意外退出时按退避间隔重启，
+    从该游标之后继续（--after-cursor），期间产生的日志不会丢失。
+    连续 MAX_RESTARTS 次快速退出或跟随出错时，结束所有订阅，由客户端重连后重新启动。
+    """
+    
+    POLL_INTERVAL = 0.5
+    MAX_RESTARTS = 5
+    RESTART_BACKOFF_MAX = 30
+    STABLE_SECONDS = 60
+    
+    def __init__(self, source: str, reader: LogReader):
+        self.source = source
+        self.reader = reader
+        self.spec = LogReader.SOURCES[source]
+        self.subscribers = set()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.process = None
+        self.generation = 0
+    
+    def add(self, subscription: LogSubscription):
+        with self.lock:
+            self.subscribers.add(subscription)
+            if self.thread is None:
+                self.generation += 1
+                self.thread = threading.Thread(target=self._run, args=(self.generation,),
+                                               name=f"log-follow-{self.source}", daemon=True)
+                self.thread.start()
+    
+    def remove(self, subscription: LogSubscription):
+        with self.lock:
+            self.subscribers.discard(subscription)
+            if self.subscribers or self.thread is None:
+                return
+            # 没有订阅者了，停止跟随
+            self.thread = None
+            self.generation += 1
+            process, self.process = self.process, None
+        if process:
+            process.terminate()
+    
+    def active(self, generation: int) -> bool:
+        with self.lock:
+            return generation == self.generation
+    
+    def dispatch(self, line: str):
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for subscription in subscribers:
+            subscription.offer(self.source, line)
+    
+    def _run(self, generation: int):
+        reason = "日志跟随已停止"
+        try:
+            journal = self.reader.read_journal(self.spec["unit"], 1)
+            if journal is not None and journal["lines"]:
+                self._follow_journal(generation, journal["cursor"][len("journal:"):])
+            else:
+                self._follow_file(generation)
+        except Exception as e:
+            logger.error(f"跟随日志失败 {self.source}: {e}")
+            reason = f"日志跟随失败: {e}"
+        finally:
+            # 意外退出时结束现有订阅，客户端重连后由下一个订阅者重新启动跟随
+            subscribers = []
+            with self.lock:
+                if generation == self.generation:
+                    self.thread = None
+                    self.process = None
+                    subscribers = list(self.subscribers)
+                    self.subscribers.clear()
+            for subscription in subscribers:
+                subscription.close(self.source, reason)
+    
+    def _follow_journal(self, generation: int, cursor: str):
+        """从 cursor 之后跟随；cursor 始终是已分发的最后一条记录"""
+        failures = 0
+        while True:
+            process = subprocess.Popen(
+                ["journalctl", "-u", self.spec["unit"], "-f", "-o", "json",
+                 f"--after-cursor={cursor}", "--no-pager"],
+                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, errors='replace'
+            )
+            with self.lock:
+                if generation != self.generation:
+                    process.terminate()
+                    return
+                self.process = process
+            started = time.monotonic()
+            for line in process.stdout:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                cursor = entry.get("__CURSOR") or cursor
+                self.dispatch(LogReader.format_journal_entry(entry))
+            returncode = process.wait()
+            if not self.active(generation):
+                return
+            
+            # 仍有订阅者时进程退出：退避后从最后分发的记录之后重启
+            failures = 0 if time.monotonic() - started >= self.STABLE_SECONDS else failures + 1
+            if failures >= self.MAX_RESTARTS:
+                raise RuntimeError(f"journalctl 连续 {failures} 次快速退出（退出码 {returncode}）")
+            delay = min(self.RESTART_BACKOFF_MAX, 2 ** max(0, failures - 1))
+            logger.warning(f"journalctl 已退出（退出码 {returncode}），{delay} 秒后重启: {self.source}")
+            deadline = time.monotonic() + delay
+            while time.monotonic() < deadline:
+                if not self.active(generation):
+                    return
+                time.sleep(self.POLL_INTERVAL)
+    
+    def _follow_file(self, generation: int):
+        path = self.spec["file"]
+        cursor = None
+        while self.active(generation):
+            if path.exists():
+                if cursor is None:
+                    _, cursor = LogReader.tail_file(path, 1)
+                else:
+                    result = LogReader.read_file_since(path, cursor, LogSubscription.BUFFER_SIZE)
+                    cursor = result["cursor"]
+                    for line in result["lines"]:
+                        self.dispatch(line)
+            time.sleep(self.POLL_INTERVAL)
+
+class LogStreamHub:
+    """按来源管理共享的日志跟随器"""
+    
+    def __init__(self, reader: LogReader):
+        self.followers = {source: LogFollower(source, reader) for source in LogReader.SOURCES}
+    
+    def subscribe(self, subscription: LogSubscription):
+        for source in subscription.sources:
+            self.followers[source].add(subscription)
+    
+    def unsubscribe(self, subscription: LogSubscription):
+        for source in subscription.sources:
+            self.followers[source].remove(subscription)
+    
+    def get_state(self) -> Dict[str, Any]:
+        return {
+            source: {
+                "subscribers": len(follower.subscribers),
+                "following": follower.thread is not None,
+                "journal_process": follower.process.pid if follower.process else None
+            }
+            for source, follower in self.followers.items()
+        }
+
+# ==================== 日志归档 ====================
+class LogArchive:
+    """日志轮转与压缩归档
+
+    manager.log 按重命名方式轮转，各进程的 WatchedFileHandler 发现inode变化后自动重新打开；
+    hysteria.log 由 hysteria 进程持有，只能复制后截断（copytruncate）。
+    轮转出的片段压缩为 gzip / zstd，同时记录片段的时间索引：起止时间、行数，
+    以及每 CHECKPOINT_LINES 行的时间检查点。搜索时先按起止时间跳过不相关的片段，
+    片段内部再按检查点跳过早于 since 的行。
+    轮转与索引更新持有文件锁，任意worker都可以安全地触发。
+    """
+    
+    CHECKPOINT_LINES = 1000
+    COPY_TRUNCATE = {"hysteria"}
+    TIMESTAMP_RE = re.compile(r'^(?:\{"time": ")?(\d{4}-\d{2}-\d{2})[ T](\d{2}:\d{2}:\d{2})(?:[.,]\d+)?(Z|[+-]\d{2}:?\d{2})?')
+    
+    def __init__(self, manager: 'Hysteria2Manager', directory: Path):
+        self.manager = manager
+        self.directory = directory
+        self.index_file = directory / "index.json"
+        self.lock_file = directory / ".lock"
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.running = False
+        self.warned_zstd = False
+    
+    def settings(self) -> Dict[str, Any]:
+        """读取日志轮转配置"""
+        return dict(DEFAULT_CONFIG["log_rotation"], **self.manager.config.get("log_rotation", {}))
+    
+    @contextmanager
+    def locked(self):
+        """跨进程互斥的轮转锁"""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        fd = os.open(str(self.lock_file), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+    
+    def load_index(self) -> Dict[str, Any]:
+        index = load_json_file(self.index_file, {})
+        index.setdefault("segments", [])
+        index.setdefault("active", {})
+        return index
+    
+    @classmethod
+    def parse_timestamp(cls, line: str) -> Optional[float]:
+        """解析行首时间戳，返回Unix时间；无时区的时间按本地时间处理"""
+        match = cls.TIMESTAMP_RE.match(line)
+        if not match:
+            return None
+        date, clock, zone = match.groups()
+        try:
+            return datetime.fromisoformat(f"{date}T{clock}{zone or ''}").timestamp()
+        except ValueError:
+            return None
+    
+    @staticmethod
+    def open_segment(path: Path):
+        """以文本方式打开归档片段"""
+        if path.suffix == '.zst':
+            if zstandard is None:
+                raise RuntimeError("读取 .zst 归档需要安装 zstandard")
+            raw = zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+            return io.TextIOWrapper(raw, encoding='utf-8', errors='replace')
+        if path.suffix == '.gz':
+            return gzip.open(path, 'rt', encoding='utf-8', errors='replace')
+        return open(path, 'r', encoding='utf-8', errors='replace')
+    
+    def compress(self, source: str, raw: Path, fallback_time: float) -> Dict[str, Any]:
+        """压缩轮转出的原始片段并生成时间索引"""
+        compression = self.settings()["compression"]
+        if compression == "zstd" and zstandard is None:
+            if not self.warned_zstd:
+                self.warned_zstd = True
+                logger.warning("未安装 zstandard，日志归档改用 gzip 压缩")
+            compression = "gzip"
+        target = raw.with_name(raw.name + ('.zst' if compression == "zstd" else '.gz'))
+        
+        start = end = None
+        count = 0
+        checkpoints = []
+        with open(raw, 'rb') as src:
+            if compression == "zstd":
+                dst = zstandard.ZstdCompressor(level=3).stream_writer(open(target, 'wb'), closefd=True)
+            else:
+                dst = gzip.open(target, 'wb', compresslevel=6)
+            with dst:
+                pending = True
+                for line in src:
+                    dst.write(line)
+                    if count % self.CHECKPOINT_LINES == 0:
+                        pending = True
+                    # 检查点取每个边界处或之后第一个带时间戳的行（跳过 traceback 等续行）
+                    if pending:
+                        stamp = self.parse_timestamp(line.decode('utf-8', errors='replace'))
+                        if stamp is not None:
+                            if start is None:
+                                start = stamp
+                            checkpoints.append([count, stamp])
+                            pending = False
+                    count += 1
+                    last = line
+            if count:
+                # 末行通常带时间戳；没有时使用最后一个检查点
+                end = self.parse_timestamp(last.decode('utf-8', errors='replace'))
+        
+        if end is None:
+            end = checkpoints[-1][1] if checkpoints else fallback_time
+        raw.unlink()
+        return {
+            "file": target.name,
+            "source": source,
+            "start": start if start is not None else end,
+            "end": end,
+            "lines": count,
+            "bytes": target.stat().st_size,
+            "checkpoints": checkpoints
+        }
+    
+    def rotate(self, source: str, force: bool = False) -> Optional[Dict[str, Any]]:
+        """按大小/时间轮转指定来源的日志，未达到条件时返回None"""
+        settings = self.settings()
+        path = LogReader.SOURCES[source]["file"]
+        
+        with self.locked():
+            index = self.load_index()
+            now = time.time()
+            since = index["active"].get(source)
+            if since is None:
+                index["active"][source] = since = now
+                save_json_file(self.index_file, index, pretty=False)
+            try:
+                size = path.stat().st_size
+            except FileNotFoundError:
+                return None
+            if size == 0 or not (force or size >= settings["max_bytes"] or now - since >= settings["interval"]):
+                return None
+            
+            stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+            raw = self.directory / f"{source}.{stamp}.log"
+            suffix = 1
+            while any(self.directory.glob(f"{raw.name}*")):
+                raw = self.directory / f"{source}.{stamp}-{suffix}.log"
+                suffix += 1
+            if source in self.COPY_TRUNCATE:
+                shutil.copyfile(path, raw)
+                os.truncate(path, 0)
+            else:
+                os.replace(path, raw)
+            
+            segment = self.compress(source, raw, now)
+            index["segments"].append(segment)
+            index["active"][source] = now
+            removed = self.apply_retention(index, settings)
+            save_json_file(self.index_file, index, pretty=False)
+        
+        logger.info(f"日志已轮转: {segment['file']} ({segment['lines']} 行, {segment['bytes']} 字节)"
+                    + (f"，清理过期归档 {removed} 个" if removed else ""))
+        return segment
+    
+    def apply_retention(self, index: Dict[str, Any], settings: Dict[str, Any]) -> int:
+        """按数量、时间与总大小清理归档，返回删除的片段数"""
+        cutoff = time.time() - settings["max_age_days"] * 86400
+        segments = sorted(index["segments"], key=lambda item: item["end"])
+        expired = set()
+        
+        per_source = {}
+        for segment in reversed(segments):
+            kept = per_source.setdefault(segment["source"], 0)
+            if kept >= settings["max_files"] or segment["end"] < cutoff:
+                expired.add(segment["file"])
+            else:
+                per_source[segment["source"]] = kept + 1
+        
+        total = sum(segment["bytes"] for segment in segments if segment["file"] not in expired)
+        for segment in segments:
+            if total <= settings["max_total_bytes"]:
+                break
+            if segment["file"] not in expired:
+                expired.add(segment["file"])
+                total -= segment["bytes"]
+        
+        for name in expired:
+            try:
+                (self.directory / name).unlink()
+            except FileNotFoundError:
+                pass
+        index["segments"] = [segment for segment in segments if segment["file"] not in expired]
+        return len(expired)
+    
+    def recover(self):
+        """压缩上次进程中断时遗留的未压缩片段"""
+        if not self.directory.exists():
+            return
+        with self.locked():
+            index = self.load_index()
+            leftovers = [path for path in sorted(self.directory.glob("*.log"))
+                         if path.name.split('.', 1)[0] in LogReader.SOURCES]
+            for raw in leftovers:
+                try:
+                    index["segments"].append(self.compress(raw.name.split('.', 1)[0], raw, raw.stat().st_mtime))
+                except Exception as e:
+                    logger.warning(f"压缩遗留日志片段失败 {raw.name}: {e}")
+            if leftovers:
+                save_json_file(self.index_file, index, pretty=False)
+    
+    def list_segments(self) -> List[Dict[str, Any]]:
+        """列出归档片段（不含检查点）"""
+        segments = sorted(self.load_index()["segments"], key=lambda item: item["start"])
+        return [{key: value for key, value in segment.items() if key != "checkpoints"} for segment in segments]
+    
+    @staticmethod
+    def first_line(checkpoints: List[List[float]], since: Optional[float]) -> int:
+        """根据检查点找到可能包含 since 之后内容的第一行"""
+        line = 0
+        if since is None:
+            return line
+        for number, stamp in checkpoints:
+            if stamp >= since:
+                break
+            line = number
+        return line
+    
+    def search(self, sources: List[str], pattern: re.Pattern, since: Optional[float] = None,
+               until: Optional[float] = None, limit: int = 200) -> Dict[str, Any]:
+        """在归档片段与当前日志文件中搜索，返回时间范围内最近的 limit 条匹配"""
+        candidates = []
+        skipped = 0
+        for segment in self.load_index()["segments"]:
+            if segment["source"] not in sources:
+                continue
+            if (since is not None and segment["end"] < since) or (until is not None and segment["start"] > until):
+                skipped += 1
+                continue
+            candidates.append((segment["start"], segment["source"], self.directory / segment["file"],
+                               self.first_line(segment.get("checkpoints", []), since)))
+        for source in sources:
+            path = LogReader.SOURCES[source]["file"]
+            try:
+                mtime = path.stat().st_mtime
+            except FileNotFoundError:
+                continue
+            if since is not None and mtime < since:
+                skipped += 1
+                continue
+            candidates.append((mtime, source, path, 0))
+        candidates.sort(key=lambda item: item[0])
+        
+        matches = deque(maxlen=limit)
+        total = 0
+        for _, source, path, skip in candidates:
+            stamp = None
+            try:
+                with self.open_segment(path) as f:
+                    for number, line in enumerate(f):
+                        if number < skip:
+                            continue
+                        stamp = self.parse_timestamp(line) or stamp
+                        if stamp is not None:
+                            if since is not None and stamp < since:
+                                continue
+                            if until is not None and stamp > until:
+                                break
+                        if pattern.search(line):
+                            total += 1
+                            matches.append({
+                                "source": source,
+                                "segment": path.name,
+                                "time": stamp,
+                                "line": line.rstrip('\n')
+                            })
+            except FileNotFoundError:
+                # 搜索期间片段被轮转或清理
+                continue
+        
+        return {
+            "matches": list(matches),
+            "total": total,
+            "truncated": total > len(matches),
+            "scanned_segments": len(candidates),
+            "skipped_segments": skipped
+        }
+    
+    def check(self):
+        for source in LogReader.SOURCES:
+            try:
+                self.rotate(source)
+            except Exception as e:
+                logger.error(f"日志轮转失败 {source}: {e}")
+    
+    def start(self):
+        """启动轮转检查线程"""
+        if self.running:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name="log-archive", daemon=True)
+        self.thread.start()
+    
+    def stop(self):
+        self.running = False
+        self.wakeup.set()
+    
+    def _run(self):
+        try:
+            self.recover()
+        except Exception as e:
+            logger.error(f"恢复日志归档失败: {e}")
+        while self.running:
+            self.wakeup.clear()
+            self.check()
+            self.wakeup.wait(self.settings()["check_interval"])
+
+# ==================== 后台任务 ====================
+class Job:
+    """后台任务：状态、进度与结果"""
+    
+    TERMINAL = ("succeeded", "failed", "cancelled")
+    
+    def __init__(self, kind: str, key: str, description: str, on_change):
+        self.id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.key = key
+        self.description = description
+        self.status = "queued"
+        self.progress = 0
+        self.message = "等待执行"
+        self.result = None
+        self.status_code = None
+        self.error = None
+        self.created_at = datetime.now().isoformat()
+        self.started_at = None
+        self.finished_at = None
+        self.cancel_requested = threading.Event()
+        self.finished = threading.Event()
+        self.on_change = on_change
+        self.pid = os.getpid()
+    
+    @property
+    def done(self) -> bool:
+        return self.status in self.TERMINAL
+    
+    def update(self, progress: Optional[int] = None, message: Optional[str] = None):
+        """报告进度（由任务函数调用）"""
+        if progress is not None:
+            self.progress = max(0, min(100, int(progress)))
+        if message is not None:
+            self.message = message
+        self.on_change(self)
+    
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "key": self.key,
+            "description": self.description,
+            "status": self.status,
+            "progress": self.progress,
+            "message": self.message,
+            "result": self.result,
+            "status_code": self.status_code,
+            "error": self.error,
+            "cancel_requested": self.cancel_requested.is_set(),
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "pid": self.pid,
+            "updated_at": time.time()
+        }
+
+def pid_alive(pid: Optional[int]) -> bool:
+    """进程是否仍然存在"""
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+class JobManager:
+    """后台任务队列
+
+    耗时操作（切换节点、启停服务、连接测试、刷新订阅）提交为任务后立即返回任务ID，
+    由有界线程池执行。同类任务按 (kind, key) 去重：默认复用正在排队或执行的任务；
+    replace 为真时取消尚未开始的旧任务（已开始的旧任务收到取消请求，执行完当前步骤后结束）。
+    同一 (kind, key) 的任务依次执行，不会并发操作同一个服务或订阅。
+    任务状态写入SQLite，多worker部署时任意进程都能查询；每次变化推送 job 事件。
+    去重与排队上限在SQLite写事务中按所有worker的任务判断；服务操作（SHARED_KINDS）
+    另外持有 lock_path 文件锁，各worker的切换节点、启停服务依次执行，等待期间任务为 queued。
+    """
+    
+    SHARED_KINDS = {"service"}
+    SLOT_POLL_INTERVAL = 0.2
+    
+    def __init__(self, manager: 'Hysteria2Manager', storage: Storage, bus: EventBus, lock_path: Path):
+        self.manager = manager
+        self.storage = storage
+        self.bus = bus
+        self.lock_path = lock_path
+        self.jobs = {}
+        self.active = {}
+        self.lock = threading.Lock()
+        self.run_locks = {}
+        self.seen = None
+        self.executor = None
+        self.executor_pid = None
+    
+    def settings(self) -> Dict[str, Any]:
+        """读取任务队列配置"""
+        return dict(DEFAULT_CONFIG["jobs"], **self.manager.config.get("jobs", {}))
+    
+    def get_executor(self) -> ThreadPoolExecutor:
+        # 线程池在首次使用时创建；fork出的worker进程中重新创建
+        if self.executor is None or self.executor_pid != os.getpid():
+            self.executor = ThreadPoolExecutor(max_workers=int(self.settings()["workers"]), thread_name_prefix="job")
+            self.executor_pid = os.getpid()
+        return self.executor
+    
+    def changed(self, job: Job):
+        data = job.to_dict()
+        try:
+            self.storage.set_value(f"job:{job.id}", data)
+        except Exception as e:
+            logger.warning(f"保存任务状态失败 {job.id}: {e}")
+        self.bus.publish("job", data)
+    
+    def submit(self, kind: str, key: str, description: str, func,
+               replace: bool = False) -> Tuple[Optional[Dict[str, Any]], bool]:
+        """提交任务，返回 (任务, 是否复用了已有任务)；队列已满时返回 (None, False)"""
+        settings = self.settings()
+        # 写事务（BEGIN IMMEDIATE）使各worker的判断与登记互斥
+        with self.lock, self.storage.transaction():
+            self.prune_locked(float(settings["keep_seconds"]))
+            existing = self.jobs.get(self.active.get((kind, key)))
+            if existing is not None and not existing.done:
+                if not replace:
+                    return existing.to_dict(), True
+                self.cancel_locked(existing, f"已被新的{description}任务取代")
+            
+            pending = self.pending_jobs()
+            for data in pending:
+                if data["kind"] != kind or data["key"] != key or data["id"] in self.jobs:
+                    continue
+                if not replace:
+                    return data, True
+                self.request_cancel(data, f"已被新的{description}任务取代")
+            
+            queued = sum(1 for data in pending if data["status"] == "queued")
+            if queued >= int(settings["max_queued"]):
+                return None, False
+            
+            job = Job(kind, key, description, self.changed)
+            self.jobs[job.id] = job
+            self.active[(kind, key)] = job.id
+            self.changed(job)
+        
+        self.get_executor().submit(self._run, job, func)
+        return job.to_dict(), False
+    
+    def pending_jobs(self) -> List[Dict[str, Any]]:
+        """所有worker中尚未结束的任务（所属进程已退出的除外），新任务在前"""
+        jobs = [data for data in self.storage.get_values("job:").values()
+                if data["status"] not in Job.TERMINAL and pid_alive(data.get("pid"))]
+        return sorted(jobs, key=lambda data: data["created_at"], reverse=True)
+    
+    def request_cancel(self, data: Dict[str, Any], reason: str):
+        """请求取消其他worker中的任务：排队中的任务在等待服务槽位时读取并结束"""
+        self.storage.set_value(f"job_cancel:{data['id']}", reason)
+    
+    def submit_service(self, description: str, action, replace: bool = True) -> Tuple[Optional[Dict[str, Any]], bool]:
+        """服务相关操作（切换节点、启停服务）在所有worker间共用一个任务槽位，依次执行"""
+        def run(job):
+            job.update(10, f"正在{description}")
+            payload, status_code = action()
+            status_collector.request_refresh("service", "connection")
+            return payload, status_code
+        return self.submit("service", "", description, run, replace=replace)
+    
+    def wait(self, job_id: str, timeout: Optional[float] = None) -> Optional[Dict[str, Any]]:
+        """等待本进程中的任务结束，返回任务状态"""
+        job = self.jobs.get(job_id)
+        if job is not None:
+            job.finished.wait(timeout)
+        return self.get(job_id)
+    
+    def cancel_locked(self, job: Job, reason: str):
+        job.cancel_requested.set()
+        if job.status == "queued":
+            job.status = "cancelled"
+            job.message = reason
+            job.finished_at = datetime.now().isoformat()
+            job.finished.set()
+        self.changed(job)
+    
+    def cancel(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """取消任务；其他worker中的任务只能在排队时取消，无法取消时返回None"""
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                data = self.storage.get_value(f"job:{job_id}")
+                if data is None or data["status"] != "queued" or not pid_alive(data.get("pid")):
+                    return None
+                self.request_cancel(data, "已取消")
+                return dict(data, cancel_requested=True)
+            if not job.done:
+                self.cancel_locked(job, "已取消")
+            return job.to_dict()
+    
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        job = self.jobs.get(job_id)
+        if job is not None:
+            return job.to_dict()
+        return self.storage.get_value(f"job:{job_id}")
+    
+    def list_jobs(self) -> List[Dict[str, Any]]:
+        """列出所有进程的任务（新任务在前）"""
+        jobs = list(self.storage.get_values("job:").values())
+        return sorted(jobs, key=lambda job: job["created_at"], reverse=True)
+    
+    def prune_locked(self, keep_seconds: float):
+        """清理超过保留时间的已结束任务"""
+        cutoff = (datetime.now() - timedelta(seconds=keep_seconds)).isoformat()
+        for job_id in [job_id for job_id, job in self.jobs.items() if job.done and job.finished_at < cutoff]:
+            del self.jobs[job_id]
+        for key, job in self.storage.get_values("job:").items():
+            if job["status"] in Job.TERMINAL:
+                if (job.get("finished_at") or "") < cutoff:
+                    self.storage.delete_value(key)
+                    self.storage.delete_value(f"job_cancel:{job['id']}")
+            elif job["id"] not in self.jobs and not pid_alive(job.get("pid")):
+                # 所属worker已退出，任务不会再有进展
+                self.storage.set_value(key, dict(job, status="failed", message="所属进程已退出",
+                                                 finished_at=datetime.now().isoformat(), updated_at=time.time()))
+    
+    def mirror(self):
+        """推送其他worker进程中任务的变化（多worker部署时由共享状态同步调用）"""
+        current = self.storage.get_values("job:")
+        seen = {}
+        for data in current.values():
+            seen[data["id"]] = data["updated_at"]
+            if data["id"] in self.jobs or self.seen is None:
+                continue
+            if self.seen.get(data["id"]) != data["updated_at"]:
+                self.bus.publish("job", data)
+        self.seen = seen
+    
+    def _run(self, job: Job, func):
+        with self.lock:
+            run_lock = self.run_locks.setdefault((job.kind, job.key), threading.Lock())
+        with run_lock:
+            # 排队期间被取消的任务不再执行
+            if job.cancel_requested.is_set():
+                return
+            if job.kind not in self.SHARED_KINDS:
+                self._execute(job, func)
+                return
+            with self.shared_slot(job) as acquired:
+                if acquired:
+                    self._execute(job, func)
+    
+    def check_cancel_request(self, job: Job):
+        """读取其他worker写入的取消请求"""
+        reason = self.storage.get_value(f"job_cancel:{job.id}")
+        if reason is not None and not job.cancel_requested.is_set():
+            with self.lock:
+                self.cancel_locked(job, reason)
+    
+    @contextmanager
+    def shared_slot(self, job: Job):
+        """跨进程互斥的任务槽位（文件锁）；等待期间被取消时返回False"""
+        self.lock_path.parent.mkdir(parents=True, exist_ok=True)
+        fd = os.open(str(self.lock_path), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            waiting = False
+            while True:
+                self.check_cancel_request(job)
+                if job.cancel_requested.is_set():
+                    yield False
+                    return
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except OSError:
+                    if not waiting:
+                        waiting = True
+                        job.update(message="等待其他服务操作完成")
+                    time.sleep(self.SLOT_POLL_INTERVAL)
+            yield True
+        finally:
+            os.close(fd)
+    
+    def _execute(self, job: Job, func):
+        job.status = "running"
+        job.started_at = datetime.now().isoformat()
+        job.update(message="执行中")
+        try:
+            payload, status_code = func(job)
+            job.result = payload
+            job.status_code = status_code
+            succeeded = status_code < 400 and payload.get("success", True)
+            job.status = "succeeded" if succeeded else "failed"
+            job.progress = 100
+            job.message = payload.get("message") or ("完成" if succeeded else "失败")
+        except Exception as e:
+            logger.error(f"任务执行失败 {job.kind}/{job.id}: {e}")
+            job.status = "failed"
+            job.error = str(e)
+            job.status_code = 500
+            job.result = {"success": False, "message": str(e)}
+            job.message = str(e)
+        finally:
+            job.finished_at = datetime.now().isoformat()
+            with self.lock:
+                if self.active.get((job.kind, job.key)) == job.id:
+                    del self.active[(job.kind, job.key)]
+            self.changed(job)
+            job.finished.set()
+
+# ==================== 多进程共享状态 ====================
+class SharedState:
+    """多worker部署时的进程间状态同步
+
+    节点、用户、会话、订阅等数据都在SQLite中，各进程天然一致。其余内存状态：
+    - 配置文件按修改时间自动重新加载
+    - 只有持有文件锁的 leader 进程运行状态采集、故障切换与订阅刷新，
+      采集结果写入SQLite，其他进程每秒读取一次并推送给各自的SSE客户端
+    - leader 退出后文件锁释放，其他进程在下一次同步时接替
+    """
     
-    def restart_service(self) -> Tuple[bool, str]:
-        """重启Hysteria2服务"""
-        self.stop_service()
-        time.sleep(2)
-        return self.start_service()
+    def __init__(self, storage: Storage, lock_path: Path):
+        self.storage = storage
+        self.lock_path = lock_path
+        self.lock_fd = None
+        self.is_leader = False
+        self.shared = False
+        self.current_node = None
+        self.metrics_version = None
+        self.demand_published = 0.0
+        self.thread = None
+        self.running = False
     
-    def get_service_status(self) -> Dict[str, Any]:
-        """获取服务状态"""
-        # 检查Hysteria2服务
-        ret, stdout, _ = run_command(["systemctl", "is-active", "hysteria2-client"])
-        self.service_status["hysteria"] = "running" if ret == 0 and "active" in stdout else "stopped"
-        
-        # 检查TUN接口
-        ret, _, _ = run_command(["ip", "link", "show", "hytun"])
-        tun_exists = ret == 0
-        
-        return {
-            "hysteria": self.service_status["hysteria"],
-            "manager": "running",
-            "tun_interface": tun_exists
-        }
+    def acquire_leadership(self) -> bool:
+        """尝试获取 leader 文件锁（非阻塞）"""
+        if self.is_leader:
+            return True
+        self.lock_path.parent.mkdir(parents=True, exist_ok=True)
+        fd = os.open(str(self.lock_path), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        os.ftruncate(fd, 0)
+        os.write(fd, str(os.getpid()).encode())
+        self.lock_fd = fd
+        self.is_leader = True
+        return True
     
-    def test_connection(self) -> Dict[str, Any]:
-        """测试连接状态"""
-        result = {
-            "status": "unknown",
-            "latency": -1,
-            "ip": "N/A",
-            "location": "N/A",
-            "dns": False,
-            "http": False
-        }
+    def start(self, shared: bool = False):
+        """启动后台服务；shared 为真表示存在多个worker进程"""
+        self.shared = shared
+        self.current_node = self.storage.get_value("current_node")
+        traffic_sampler.start()
+        dns_cache.start(lambda: [node["server"] for node in self.storage.list_nodes()])
+        service_watcher.start()
+        if self.acquire_leadership():
+            self.start_leader_services()
+        else:
+            logger.info(f"worker {os.getpid()} 以跟随模式运行，状态由 leader 进程采集")
         
-        try:
-            # 检查服务状态
-            if self.service_status["hysteria"] != "running":
-                result["status"] = "disconnected"
-                return result
-            
-            # 测试DNS解析（多种方法）
-            dns_tests = [
-                ["nslookup", "google.com", "8.8.8.8"],
-                ["getent", "hosts", "google.com"],
-            ]
-            for test in dns_tests:
-                ret, _, _ = run_command(test, timeout=3)
-                if ret == 0:
-                    result["dns"] = True
-                    break
-            
-            # 测试HTTP连接并获取IP
+        if shared and not self.running:
+            self.running = True
+            self.thread = threading.Thread(target=self._run, name="shared-state", daemon=True)
+            self.thread.start()
+    
+    def start_leader_services(self):
+        logger.info(f"worker {os.getpid()} 成为 leader，启动状态采集与调度")
+        traffic_sampler.persist = True
+        status_collector.start(self.storage if self.shared else None)
+        failover_scheduler.start(self.shared)
+        subscription_manager.start()
+        log_archive.start()
+        if self.shared:
+            self.prune_metrics()
+    
+    def publish_metrics(self):
+        """把本进程的指标快照写入SQLite（有变化时）"""
+        version = metrics_registry.version
+        if version != self.metrics_version:
+            self.storage.set_value(f"metrics:{os.getpid()}", metrics_registry.snapshot())
+            self.metrics_version = version
+    
+    def prune_metrics(self):
+        """删除已退出进程的指标快照（上次运行遗留或被重启的worker）"""
+        for key in self.storage.get_values("metrics:"):
             try:
-                response = requests.get("https://api.ipify.org?format=json", timeout=5)
-                if response.status_code == 200:
-                    result["http"] = True
-                    result["ip"] = response.json().get("ip", "N/A")
-                    
-                    # 获取IP位置
-                    loc_resp = requests.get(f"https://ipapi.co/{result['ip']}/country/", timeout=3)
-                    if loc_resp.status_code == 200:
-                        result["location"] = loc_resp.text.strip()
-            except:
-                # 备用方法
-                ret, stdout, _ = run_command(["curl", "-s", "-m", "5", "https://ifconfig.io/ip"])
-                if ret == 0 and stdout.strip():
-                    result["http"] = True
-                    result["ip"] = stdout.strip()
-                    
-                    ret, stdout, _ = run_command(["curl", "-s", "-m", "3", "https://ifconfig.io/country_code"])
-                    if ret == 0:
-                        result["location"] = stdout.strip()
-            
-            # 如果HTTP正常但DNS显示失败，修正为正常
-            if result["http"] and not result["dns"]:
-                result["dns"] = True
-            
-            # 测试延迟
-            ret, stdout, _ = run_command(["ping", "-c", "1", "-W", "2", "8.8.8.8"])
-            if ret == 0:
-                import re
-                match = re.search(r'time=(\d+\.?\d*)', stdout)
-                if match:
-                    result["latency"] = float(match.group(1))
-            
-            # 判断连接状态
-            tun_exists = run_command(["ip", "link", "show", "hytun"])[0] == 0
-            
-            if tun_exists and result["http"]:
-                result["status"] = "connected"
-            elif self.service_status["hysteria"] == "running":
-                result["status"] = "connecting"
-            else:
-                result["status"] = "disconnected"
-                
-        except Exception as e:
-            logger.error(f"连接测试失败: {e}")
+                os.kill(int(key.split(':', 1)[1]), 0)
+            except (ValueError, ProcessLookupError):
+                self.storage.delete_value(key)
+            except PermissionError:
+                pass
+    
+    def metrics_snapshots(self) -> Optional[List[Dict[str, Any]]]:
+        """所有进程的指标快照；单进程部署返回None（直接使用本进程数据）"""
+        if not self.shared:
+            return None
+        key = f"metrics:{os.getpid()}"
+        snapshots = [value for name, value in self.storage.get_values("metrics:").items() if name != key]
+        snapshots.append(metrics_registry.snapshot())
+        return snapshots
+    
+    def sync(self):
+        """同步一次共享状态"""
+        hysteria_manager.reload_config_if_changed()
         
-        return result
+        if not self.is_leader and self.acquire_leadership():
+            self.start_leader_services()
+        
+        if self.is_leader:
+            if self.storage.get_value("failover_trigger"):
+                self.storage.set_value("failover_trigger", None)
+                failover_scheduler.trigger()
+            refresh = self.storage.get_value("status_refresh")
+            if refresh:
+                self.storage.set_value("status_refresh", None)
+                status_collector.request_refresh(*refresh)
+        else:
+            # 本进程有人查看状态时通知 leader 继续执行按需探针
+            now = time.time()
+            if status_collector.local_demand() and now - self.demand_published >= 10:
+                self.storage.set_value("status_demand", now)
+                self.demand_published = now
+            for name in status_collector.probes:
+                entry = self.storage.get_value(f"status:{name}")
+                if entry and entry.get("collected_at") != status_collector.get(name).get("collected_at"):
+                    status_collector.apply(name, entry)
+        
+        job_manager.mirror()
+        
+        # 其他进程切换节点时通知本进程的SSE客户端
+        current = self.storage.get_value("current_node")
+        if current != self.current_node:
+            self.current_node = current
+            node = self.storage.get_node(current) if current else None
+            event_bus.publish("node", {"current_node": current, "name": node["name"] if node else None})
+        
+        self.publish_metrics()
+    
+    def _run(self):
+        while self.running:
+            try:
+                self.sync()
+            except Exception as e:
+                logger.error(f"共享状态同步失败: {e}")
+            time.sleep(1)
 
 # ==================== Flask应用 ====================
 app = Flask(__name__)
@@ -735,8 +5036,210 @@ CORS(app, origins="*", allow_headers="*", methods="*")  # 开发环境配置
 app.config['SECRET_KEY'] = os.environ.get('FLASK_SECRET', 'hysteria2-flask-secret-key')
 
 # 全局对象
-auth_manager = AuthManager()
-hysteria_manager = Hysteria2Manager()
+persistence_writer = PersistenceWriter()
+atexit.register(persistence_writer.flush)
+event_bus = EventBus()
+logger.addHandler(EventBusHandler(event_bus))
+storage = Storage(DB_FILE)
+auth_manager = AuthManager(storage)
+hysteria_manager = Hysteria2Manager(storage)
+config_cache = ConfigCache(hysteria_manager, DATA_DIR / "configs")
+
+persistence_writer.configure(**dict(DEFAULT_CONFIG["persistence"], **hysteria_manager.config.get("persistence", {})))
+dns_cache = DNSCache(lambda: dict(DEFAULT_CONFIG["dns"], **hysteria_manager.config.get("dns", {})))
+system_status = SystemStatus(lambda: hysteria_manager.config.get("monitor", {}).get("status_backend", "auto"))
+
+def _monitor_interval(key: str, default: float) -> float:
+    return hysteria_manager.config.get("monitor", {}).get(key, default)
+
+node_benchmark = NodeBenchmark(hysteria_manager)
+failover_scheduler = FailoverScheduler(hysteria_manager, node_benchmark)
+subscription_manager = SubscriptionManager(hysteria_manager)
+traffic_sampler = TrafficSampler(hysteria_manager)
+
+status_collector = StatusCollector()
+status_collector.register(
+    "service", hysteria_manager.get_service_status,
+    _monitor_interval("service_interval", 5),
+    {"hysteria": "stopped", "manager": "running", "tun_interface": False}
+)
+status_collector.register(
+    "connection", hysteria_manager.test_connection,
+    _monitor_interval("connection_interval", 300),
+    {"status": "unknown", "latency": -1, "ip": "N/A", "location": "N/A", "dns": False, "http": False},
+    on_demand=True
+)
+status_collector.register(
+    "stats", collect_traffic_stats,
+    _monitor_interval("traffic_interval", 5),
+    {"traffic": {"up": 0, "down": 0, "total": 0, "rate_up": 0, "rate_down": 0,
+                 "tun_rate_up": 0, "tun_rate_down": 0},
+     "connections": 0, "uptime": 0}
+)
+
+def _sync_service_status(name: str, entry: Dict[str, Any]):
+    # 未运行监听时，跟随模式下服务状态来自 leader 的采集结果
+    if name == "service" and not service_watcher.running:
+        hysteria_manager.service_status["hysteria"] = entry.get("hysteria", "stopped")
+
+def _on_service_change(state: Dict[str, Any], changed: Dict[str, Any]):
+    # 每个进程各自监听，状态变化立即生效并推送，不等下一次采集
+    hysteria_manager.service_status["hysteria"] = state["hysteria"]
+    if status_collector.running and service_watcher.running:
+        status_collector.update("service", hysteria_manager.get_service_status())
+
+status_collector.add_listener(_sync_service_status)
+service_watcher = ServiceWatcher("hysteria2-client.service", TrafficSampler.TUN_INTERFACE,
+                                 lambda: _monitor_interval("service_interval", 5))
+service_watcher.add_listener(_on_service_change)
+shared_state = SharedState(storage, LEADER_LOCK_FILE)
+log_reader = LogReader()
+log_stream_hub = LogStreamHub(log_reader)
+log_archive = LogArchive(hysteria_manager, LOG_DIR / "archive")
+sampling_profiler = SamplingProfiler()
+job_manager = JobManager(hysteria_manager, storage, event_bus, SERVICE_LOCK_FILE)
+stream_limiter = StreamLimiter(lambda: dict(DEFAULT_CONFIG["streams"], **hysteria_manager.config.get("streams", {})))
+
+NODE_SUMMARY_TTL = 30
+_node_summary = {"expires": 0.0, "value": None}
+_node_summary_lock = threading.Lock()
+
+def node_benchmark_summary() -> Dict[str, Any]:
+    """全部节点测速结果的汇总，缓存 NODE_SUMMARY_TTL 秒（节点很多时避免每次抓取都读取全部结果）"""
+    with _node_summary_lock:
+        if _node_summary["value"] is not None and _node_summary["expires"] > time.monotonic():
+            return _node_summary["value"]
+        
+        node_ids = set(storage.node_endpoints().values())
+        latest = [result for node_id, result in storage.latest_benchmarks().items() if node_id in node_ids]
+        rtts = sorted(result["rtt_p50"] / 1000 for result in latest if result.get("rtt_p50") is not None)
+        value = {
+            "nodes": len(node_ids),
+            "benchmarked": len(latest),
+            "reachable": len(rtts),
+            "rtt_best": rtts[0] if rtts else None,
+            "rtt_median": rtts[len(rtts) // 2] if rtts else None
+        }
+        _node_summary.update(value=value, expires=time.monotonic() + NODE_SUMMARY_TTL)
+        return value
+
+def collect_runtime_metrics() -> List[Tuple[str, str, str, List[Tuple[Dict[str, Any], float]]]]:
+    """抓取时读取的瞬时指标：只读 /proc、内存快照与当前节点的记录，节点汇总使用缓存
+
+    节点相关的序列只有当前节点与汇总值，以 node_id 为标签，序列数不随节点数增长。
+    """
+    counters = read_net_dev()
+    service = status_collector.get("service")
+    current = storage.get_value("current_node")
+    history = storage.get_benchmarks(current) if current else []
+    latest = history[-1] if history else {}
+    summary = node_benchmark_summary()
+    writer = persistence_writer.get_metrics()
+    streams = stream_limiter.get_state()
+    
+    def current_value(field, scale=1.0):
+        if latest.get(field) is None:
+            return []
+        return [({"node_id": current}, latest[field] * scale)]
+    
+    def optional(value):
+        return [({}, value)] if value is not None else []
+    
+    return [
+        ("hysteria2_interface_receive_bytes_total", "counter", "网卡接收字节数",
+         [({"interface": name}, rx) for name, (rx, _) in counters.items()]),
+        ("hysteria2_interface_transmit_bytes_total", "counter", "网卡发送字节数",
+         [({"interface": name}, tx) for name, (_, tx) in counters.items()]),
+        ("hysteria2_tun_up", "gauge", "TUN网卡是否存在",
+         [({"interface": TrafficSampler.TUN_INTERFACE}, 1 if service.get("tun_interface") else 0)]),
+        ("hysteria2_service_up", "gauge", "hysteria 客户端服务是否运行",
+         [({}, 1 if service.get("hysteria") == "running" else 0)]),
+        ("hysteria2_current_node_info", "gauge", "当前使用的节点",
+         [({"node_id": current}, 1)] if current else []),
+        ("hysteria2_current_node_rtt_p50_seconds", "gauge", "当前节点最近一次测速的RTT中位数",
+         current_value("rtt_p50", 1 / 1000)),
+        ("hysteria2_current_node_rtt_p95_seconds", "gauge", "当前节点最近一次测速的RTT P95",
+         current_value("rtt_p95", 1 / 1000)),
+        ("hysteria2_current_node_probe_loss_ratio", "gauge", "当前节点最近一次测速的丢包率",
+         current_value("loss")),
+        ("hysteria2_nodes", "gauge", "节点数量",
+         [({"state": "total"}, summary["nodes"]), ({"state": "benchmarked"}, summary["benchmarked"]),
+          ({"state": "reachable"}, summary["reachable"])]),
+        ("hysteria2_nodes_rtt_p50_best_seconds", "gauge", "各节点最近一次测速RTT中位数的最小值",
+         optional(summary["rtt_best"])),
+        ("hysteria2_nodes_rtt_p50_median_seconds", "gauge", "各节点最近一次测速RTT中位数的中位数",
+         optional(summary["rtt_median"])),
+        ("hysteria2_manager_persistence_pending", "gauge", "本进程待写入的文件数", [({}, writer["pending"])]),
+        ("hysteria2_manager_sse_streams", "gauge", "本进程打开的SSE连接数", [({}, streams["active"])]),
+        ("hysteria2_manager_sse_rejected_total", "counter", "本进程因连接数达到上限拒绝的SSE连接数",
+         [({}, streams["rejected"])])
+    ]
+
+metrics_registry.add_collector(collect_runtime_metrics)
+
+@app.before_request
+def assign_request_id():
+    g.request_id = request.headers.get('X-Request-ID', '')[:64] or uuid.uuid4().hex[:16]
+    g.request_started = time.perf_counter()
+
+@app.before_request
+def reload_shared_config():
+    """其他worker修改配置后，本进程在下一个请求时生效"""
+    hysteria_manager.reload_config_if_changed()
+
+def tracing_settings() -> Dict[str, Any]:
+    return dict(DEFAULT_CONFIG["tracing"], **hysteria_manager.config.get("tracing", {}))
+
+@app.before_request
+def start_trace():
+    """开启追踪时记录本请求；此前的 before_request 处理计入 before_request 段"""
+    if not tracing_settings()["enabled"]:
+        return
+    tracer.begin({
+        "request_id": g.request_id,
+        "method": request.method,
+        "path": request.path,
+        "pid": os.getpid(),
+        "started_at": datetime.now().isoformat()
+    }, g.request_started)
+    tracer.record_span("before_request", g.request_started)
+    g.handler_started = time.perf_counter()
+
+@app.after_request
+def log_access(response):
+    """记录访问日志（请求ID、路径、状态码、耗时）与按路由统计的请求指标"""
+    duration = time.perf_counter() - g.request_started
+    response.headers['X-Request-ID'] = g.request_id
+    # 使用路由模板而不是实际路径，避免节点ID等参数导致标签基数膨胀
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    metrics_registry.inc("hysteria2_manager_http_requests_total",
+                         (route, request.method, str(response.status_code)))
+    metrics_registry.observe("hysteria2_manager_http_request_duration_seconds", (route, request.method), duration)
+    if request.path.startswith('/api/'):
+        access_logger.info(
+            f"{request.method} {request.path} {response.status_code}",
+            extra={
+                "status": response.status_code,
+                "duration_ms": round(duration * 1000, 2)
+            }
+        )
+    return response
+
+@app.after_request
+def finish_trace(response):
+    if tracer.current() is not None:
+        tracer.record_span("handler", g.handler_started, request.endpoint or "")
+        settings = tracing_settings()
+        tracer.finish(
+            int(settings["slow_requests"]), float(settings["min_duration_ms"]),
+            route=request.url_rule.rule if request.url_rule else None,
+            status=response.status_code
+        )
+    return response
+
+@app.teardown_request
+def discard_trace(exc):
+    tracer.discard()
 
 # ==================== 认证装饰器 ====================
 def require_auth(f):
@@ -844,7 +5347,6 @@ def api_change_username():
         return jsonify({"success": False, "message": "用户名长度不能超过20位"}), 400
     
     # 验证用户名格式（只允许字母数字和下划线）
-    import re
     if not re.match(r'^[a-zA-Z0-9_]+$', new_username):
         return jsonify({"success": False, "message": "用户名只能包含字母、数字和下划线"}), 400
     
@@ -857,36 +5359,106 @@ def api_change_username():
 @app.route('/api/status')
 @require_auth
 def api_status():
-    """获取系统状态"""
+    """获取系统状态（返回后台采集器的最新快照）"""
     try:
-        service_status = hysteria_manager.get_service_status()
-        connection_status = hysteria_manager.test_connection()
-        
-        # 获取流量统计（简化版本）
-        net_stats = get_network_traffic()
-        stats = {
-            "traffic": {
-                "up": net_stats["bytes_sent"],
-                "down": net_stats["bytes_recv"],
-                "total": net_stats["bytes_sent"] + net_stats["bytes_recv"]
-            },
-            "connections": 0,
-            "uptime": 0
-        }
+        status_collector.touch()
+        snapshot = status_collector.get_snapshot()
         
         return jsonify({
             "success": True,
             "data": {
-                "service": service_status,
-                "connection": connection_status,
-                "stats": stats,
-                "current_node": hysteria_manager.nodes.get("current")
+                "service": snapshot["service"],
+                "connection": snapshot["connection"],
+                "stats": snapshot["stats"],
+                "current_node": hysteria_manager.current_node_id
             }
         })
     except Exception as e:
         logger.error(f"获取状态失败: {e}")
         return jsonify({"success": False, "message": str(e)}), 500
 
+def verify_stream_token() -> bool:
+    """验证SSE请求的令牌（EventSource无法设置请求头，令牌通过 ?token= 传递）"""
+    token = request.args.get('token')
+    if not token:
+        auth_header = request.headers.get('Authorization', '')
+        token = auth_header.split(' ')[-1] if auth_header else None
+    return bool(token and auth_manager.verify_token(token))
+
+def stream_unavailable():
+    """SSE连接数已达上限：返回503，客户端在 Retry-After 秒后重试或改为轮询"""
+    response = jsonify({"success": False, "message": "实时推送连接数已达上限，请稍后重试"})
+    response.status_code = 503
+    response.headers["Retry-After"] = str(int(stream_limiter.settings()["retry_after"]))
+    return response
+
+def stream_response(stream: Iterator[str]) -> Response:
+    """SSE响应；连接关闭时释放 stream_limiter 的名额（生成器未开始执行时也会释放）"""
+    response = Response(stream, mimetype='text/event-stream', headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
+    response.call_on_close(stream_limiter.release)
+    return response
+
+@app.route('/api/events')
+def api_events():
+    """SSE事件流"""
+    if not verify_stream_token():
+        return jsonify({"success": False, "message": "认证令牌无效或已过期"}), 401
+    if not stream_limiter.acquire():
+        return stream_unavailable()
+    
+    subscriber = event_bus.subscribe()
+    status_collector.touch()
+    
+    def stream():
+        try:
+            # 连接建立时先发送完整快照，之后只推送增量事件
+            yield "retry: 3000\n\n"
+            yield EventBus.format("snapshot", {
+                **status_collector.get_snapshot(),
+                "current_node": hysteria_manager.current_node_id
+            })
+            while True:
+                try:
+                    frame = subscriber.get(timeout=15)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                if frame is None:
+                    break
+                yield frame
+        finally:
+            event_bus.unsubscribe(subscriber)
+    
+    return stream_response(stream())
+
+@app.route('/api/stats/traffic')
+@require_auth
+def api_traffic_stats():
+    """获取流量速率序列（range: 5m/1h/24h/7d/30d 等，单位 s/m/h/d）"""
+    match = re.fullmatch(r'(\d+)([smhd])', request.args.get('range', '5m'))
+    if not match:
+        return jsonify({"success": False, "message": "无效的时间范围"}), 400
+    seconds = int(match.group(1)) * {"s": 1, "m": 60, "h": 3600, "d": 86400}[match.group(2)]
+    
+    resolution = request.args.get('resolution') or traffic_sampler.resolution_for(seconds)
+    if resolution not in TrafficSampler.RESOLUTIONS:
+        return jsonify({"success": False, "message": "无效的采样级别"}), 400
+    step = TrafficSampler.RESOLUTIONS[resolution][0]
+    
+    return jsonify({
+        "success": True,
+        "data": {
+            "range": seconds,
+            "resolution": resolution,
+            "step": step,
+            "points": traffic_sampler.get_series(resolution, max(1, seconds // step)),
+            "current": traffic_sampler.get_current()
+        }
+    })
+
 @app.route('/api/nodes')
 @require_auth
 def api_get_nodes():
@@ -894,8 +5466,8 @@ def api_get_nodes():
     return jsonify({
         "success": True,
         "data": {
-            "nodes": hysteria_manager.nodes.get("nodes", []),
-            "current": hysteria_manager.nodes.get("current")
+            "nodes": hysteria_manager.get_nodes(),
+            "current": hysteria_manager.current_node_id
         }
     })
 
@@ -915,18 +5487,36 @@ def api_add_node():
     else:
         return jsonify({"success": False, "message": message}), 400
 
+@app.route('/api/nodes/import', methods=['POST'])
+@require_auth
+def api_import_nodes():
+    """批量导入节点链接（每行一个）"""
+    data = request.get_json(silent=True) or {}
+    content = data.get('content', '')
+    if not content.strip():
+        return jsonify({"success": False, "message": "导入内容不能为空"}), 400
+    
+    parser = SubscriptionParser(hysteria_manager, int(DEFAULT_CONFIG["subscription"]["max_bytes"]))
+    try:
+        report = hysteria_manager.import_nodes(parser.parse_lines(content.splitlines()))
+    except Exception as e:
+        return jsonify({"success": False, "message": f"解析失败: {e}"}), 400
+    report["format"] = parser.format
+    return jsonify({
+        "success": report["added"] > 0,
+        "message": f"新增 {report['added']} 个，重复 {report['duplicate']} 个，无效 {report['invalid']} 个",
+        "data": report
+    })
+
 @app.route('/api/nodes/<node_id>', methods=['PUT'])
 @require_auth
 def api_update_node(node_id):
     """更新节点"""
     data = request.get_json()
     
-    # 查找并更新节点
-    for node in hysteria_manager.nodes["nodes"]:
-        if node["id"] == node_id:
-            node.update(data)
-            save_json_file(NODES_FILE, hysteria_manager.nodes)
-            return jsonify({"success": True, "message": "节点已更新"})
+    # 只更新该节点所在的行
+    if hysteria_manager.update_node(node_id, data):
+        return jsonify({"success": True, "message": "节点已更新"})
     
     return jsonify({"success": False, "message": "节点不存在"}), 404
 
@@ -940,86 +5530,388 @@ def api_delete_node(node_id):
     else:
         return jsonify({"success": False, "message": message}), 404
 
+@app.route('/api/nodes/benchmark')
+@require_auth
+def api_get_benchmarks():
+    """获取所有节点最近一次测速结果"""
+    return jsonify({"success": True, "data": node_benchmark.latest()})
+
+@app.route('/api/nodes/benchmark', methods=['POST'])
+@require_auth
+def api_benchmark_nodes():
+    """并发测速多个节点，默认全部（后台任务）"""
+    data = request.get_json(silent=True) or {}
+    node_ids = data.get('node_ids')
+    full = bool(data.get('full'))
+    nodes = hysteria_manager.get_nodes()
+    if node_ids:
+        nodes = [node for node in nodes if node["id"] in node_ids]
+    
+    def run(job):
+        reported = [0]
+        
+        def progress(done, total):
+            # 节点较多时只在百分比变化时更新任务，避免频繁写入
+            percent = done * 100 // total
+            if percent != reported[0]:
+                reported[0] = percent
+                job.update(percent, f"已完成 {done}/{total} 个节点")
+        
+        job.update(0, f"正在测速 {len(nodes)} 个节点")
+        results = node_benchmark.benchmark_nodes(nodes, full=full, progress=progress,
+                                                 cancelled=job.cancel_requested)
+        if job.cancel_requested.is_set():
+            return {"success": False, "message": f"测速已取消，完成 {len(results)} 个节点", "data": results}, 200
+        return {"success": True, "data": results}, 200
+    
+    # 相同的节点集合与模式共用一个任务
+    key = hashlib.sha256(json.dumps([sorted(node["id"] for node in nodes), full]).encode()).hexdigest()[:16]
+    return job_response(*job_manager.submit("benchmark", key, "节点测速", run), nodes=len(nodes))
+
+@app.route('/api/nodes/<node_id>/benchmark')
+@require_auth
+def api_get_node_benchmark(node_id):
+    """获取节点测速历史"""
+    return jsonify({"success": True, "data": node_benchmark.get_history(node_id)})
+
+@app.route('/api/nodes/<node_id>/benchmark', methods=['POST'])
+@require_auth
+def api_benchmark_node(node_id):
+    """测速单个节点（后台任务）"""
+    data = request.get_json(silent=True) or {}
+    full = bool(data.get('full'))
+    node = hysteria_manager.get_node(node_id)
+    if not node:
+        return jsonify({"success": False, "message": "节点不存在"}), 404
+    
+    def run(job):
+        job.update(10, f"正在测速 {node['name']}")
+        return {"success": True, "data": node_benchmark.benchmark_node(node, full=full)}, 200
+    return job_response(*job_manager.submit("benchmark", f"{node_id}:{int(full)}", "节点测速", run))
+
+@app.route('/api/failover')
+@require_auth
+def api_get_failover():
+    """获取故障切换状态、节点得分与事件日志"""
+    return jsonify({"success": True, "data": failover_scheduler.get_state()})
+
+@app.route('/api/failover', methods=['POST'])
+@require_auth
+def api_update_failover():
+    """更新故障切换配置"""
+    data = request.get_json(silent=True) or {}
+    allowed = set(DEFAULT_CONFIG["failover"])
+    settings = dict(hysteria_manager.config.get("failover", {}))
+    settings.update({k: v for k, v in data.items() if k in allowed})
+    hysteria_manager.update_config({"failover": settings})
+    failover_scheduler.trigger()
+    return jsonify({"success": True, "message": "故障切换配置已更新", "data": failover_scheduler.settings()})
+
+@app.route('/api/failover/evaluate', methods=['POST'])
+@require_auth
+def api_evaluate_failover():
+    """立即执行一次评估"""
+    failover_scheduler.trigger()
+    return jsonify({"success": True, "message": "已触发评估"})
+
+def job_response(job: Optional[Dict[str, Any]], deduplicated: bool, **extra):
+    """任务已提交：返回202与任务ID，客户端通过 /api/jobs/<id> 或 job 事件获取结果"""
+    if job is None:
+        return jsonify({"success": False, "message": "任务队列已满，请稍后重试"}), 429
+    response = jsonify({
+        "success": True,
+        "message": "已有相同任务正在执行" if deduplicated else "任务已提交",
+        "data": dict(extra, job_id=job["id"], status=job["status"], deduplicated=deduplicated)
+    })
+    response.status_code = 202
+    response.headers["Location"] = f"/api/jobs/{job['id']}"
+    return response
+
+def submit_service_job(description: str, action):
+    """服务相关操作共用一个任务槽位：新的操作取代尚未开始的旧操作"""
+    return job_response(*job_manager.submit_service(description, action))
+
 @app.route('/api/nodes/<node_id>/use', methods=['POST'])
 @require_auth
 def api_use_node(node_id):
-    """使用指定节点"""
-    success, message = hysteria_manager.use_node(node_id)
-    if success:
-        return jsonify({"success": True, "message": message})
-    else:
-        return jsonify({"success": False, "message": message}), 400
+    """使用指定节点（后台任务）"""
+    if hysteria_manager.get_node(node_id) is None:
+        return jsonify({"success": False, "message": "节点不存在"}), 404
+    
+    def action():
+        success, message, switch = hysteria_manager.use_node(node_id)
+        return {"success": success, "message": message, "data": {"switch": switch}}, 200 if success else 400
+    return submit_service_job("切换节点", action)
 
 @app.route('/api/service/start', methods=['POST'])
 @require_auth
 def api_start_service():
-    """启动服务"""
-    success, message = hysteria_manager.start_service()
-    if success:
-        return jsonify({"success": True, "message": message})
-    else:
-        return jsonify({"success": False, "message": message}), 400
+    """启动服务（后台任务）"""
+    def action():
+        success, message = hysteria_manager.start_service()
+        return {"success": success, "message": message}, 200 if success else 400
+    return submit_service_job("启动服务", action)
 
 @app.route('/api/service/stop', methods=['POST'])
 @require_auth
 def api_stop_service():
-    """停止服务"""
-    success, message = hysteria_manager.stop_service()
-    return jsonify({"success": success, "message": message})
+    """停止服务（后台任务）"""
+    def action():
+        success, message = hysteria_manager.stop_service()
+        return {"success": success, "message": message}, 200
+    return submit_service_job("停止服务", action)
 
 @app.route('/api/service/restart', methods=['POST'])
 @require_auth
 def api_restart_service():
-    """重启服务"""
-    success, message = hysteria_manager.restart_service()
-    if success:
-        return jsonify({"success": True, "message": message})
-    else:
-        return jsonify({"success": False, "message": message}), 400
+    """重启服务（后台任务）"""
+    def action():
+        success, message = hysteria_manager.restart_service()
+        return {"success": success, "message": message}, 200 if success else 400
+    return submit_service_job("重启服务", action)
 
 @app.route('/api/test')
 @require_auth
 def api_test_connection():
-    """测试连接"""
-    result = hysteria_manager.test_connection()
-    return jsonify({"success": True, "data": result})
+    """测试连接（后台任务，同时只执行一次测试）"""
+    try:
+        deadline = min(max(float(request.args.get('timeout', 8)), 1), 30)
+    except ValueError:
+        deadline = 8
+    
+    def run(job):
+        job.update(10, "正在测试连接")
+        result = hysteria_manager.test_connection(deadline)
+        status_collector.update("connection", result)
+        return {"success": True, "data": result}, 200
+    return job_response(*job_manager.submit("test", "", "连接测试", run))
+
+@app.route('/api/jobs')
+@require_auth
+def api_list_jobs():
+    """列出后台任务"""
+    return jsonify({"success": True, "data": job_manager.list_jobs()})
+
+@app.route('/api/jobs/<job_id>')
+@require_auth
+def api_get_job(job_id):
+    """查询任务状态与结果"""
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({"success": False, "message": "任务不存在或已过期"}), 404
+    return jsonify({"success": True, "data": job})
+
+@app.route('/api/jobs/<job_id>', methods=['DELETE'])
+@require_auth
+def api_cancel_job(job_id):
+    """取消任务（已开始的任务在当前步骤完成后结束）"""
+    job = job_manager.cancel(job_id)
+    if job is None:
+        if job_manager.get(job_id) is not None:
+            return jsonify({"success": False, "message": "任务在其他worker进程中执行，无法取消"}), 409
+        return jsonify({"success": False, "message": "任务不存在或已过期"}), 404
+    return jsonify({"success": True, "message": "已请求取消", "data": job})
 
 @app.route('/api/logs')
 @require_auth
 def api_get_logs():
-    """获取日志"""
+    """获取日志（source 指定来源；since 为上次返回的 cursor，只返回新增的行）"""
     try:
         lines = int(request.args.get('lines', 100))
+        source = request.args.get('source')
+        if source and source not in LogReader.SOURCES:
+            return jsonify({"success": False, "message": "未知的日志来源"}), 400
+        sources = [source] if source else list(LogReader.SOURCES)
+        since = LogReader.decode_cursor(request.args.get('since'))
         
-        logs = {
-            "hysteria": [],
-            "manager": []
-        }
-        
-        # 使用journalctl读取日志
-        ret, stdout, _ = run_command(["journalctl", "-u", "hysteria2-client", "-n", str(lines), "--no-pager"])
-        if ret == 0 and stdout:
-            logs["hysteria"] = [line for line in stdout.split('\n') if line.strip()]
-        
-        # 备用：读取日志文件
-        if not logs["hysteria"]:
-            hysteria_log = LOG_DIR / "hysteria.log"
-            if hysteria_log.exists():
-                with open(hysteria_log, 'r', encoding='utf-8', errors='ignore') as f:
-                    all_lines = f.readlines()
-                    logs["hysteria"] = [line.strip() for line in all_lines[-lines:]]
-        
-        # 管理器日志
-        ret, stdout, _ = run_command(["journalctl", "-u", "hysteria2-manager", "-n", str(lines), "--no-pager"])
-        if ret == 0 and stdout:
-            logs["manager"] = [line for line in stdout.split('\n') if line.strip()]
+        logs = {}
+        cursors = dict(since)
+        reset = []
+        for name in sources:
+            result = log_reader.read(name, lines, since.get(name))
+            logs[name] = result["lines"]
+            cursors[name] = result["cursor"]
+            if result["reset"]:
+                reset.append(name)
         
+        logs["cursor"] = LogReader.encode_cursor(cursors)
+        logs["reset"] = reset
         return jsonify({"success": True, "data": logs})
         
     except Exception as e:
         logger.error(f"获取日志失败: {e}")
         return jsonify({"success": False, "message": str(e), "data": {"hysteria": [], "manager": []}}), 500
 
+@app.route('/api/logs/stream')
+def api_stream_logs():
+    """实时日志流（SSE）
+
+    source: 逗号分隔的来源（默认全部）；level: 最低级别；q: 正则过滤。
+    同一来源的所有连接共享一个跟随器。
+    """
+    if not verify_stream_token():
+        return jsonify({"success": False, "message": "认证令牌无效或已过期"}), 401
+    
+    sources = [name for name in request.args.get('source', '').split(',') if name] or list(LogReader.SOURCES)
+    if any(name not in LogReader.SOURCES for name in sources):
+        return jsonify({"success": False, "message": "未知的日志来源"}), 400
+    try:
+        subscription = LogSubscription(sources, request.args.get('level'), request.args.get('q'))
+    except re.error as e:
+        return jsonify({"success": False, "message": f"无效的正则表达式: {e}"}), 400
+    
+    if not stream_limiter.acquire():
+        return stream_unavailable()
+    log_stream_hub.subscribe(subscription)
+    
+    def stream():
+        try:
+            yield "retry: 3000\n\n"
+            idle = 0.0
+            while True:
+                items, dropped = subscription.drain(timeout=1.0)
+                if dropped:
+                    yield EventBus.format("dropped", {"count": dropped})
+                for source, line in items:
+                    yield EventBus.format("log", {"source": source, "line": line})
+                if subscription.closed is not None:
+                    # 跟随器已停止：通知客户端后结束连接，EventSource 按 retry 间隔重连
+                    yield EventBus.format("end", subscription.closed)
+                    break
+                idle = 0.0 if items else idle + 1.0
+                if idle >= 15:
+                    idle = 0.0
+                    yield ": keepalive\n\n"
+        finally:
+            log_stream_hub.unsubscribe(subscription)
+    
+    return stream_response(stream())
+
+def parse_time_arg(value: Optional[str]) -> Optional[float]:
+    """解析Unix时间戳或ISO格式时间参数"""
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+
+@app.route('/api/logs/search')
+@require_auth
+def api_search_logs():
+    """搜索归档与当前日志（q: 正则；since/until: 时间范围；source: 逗号分隔的来源）"""
+    sources = [name for name in request.args.get('source', '').split(',') if name] or list(LogReader.SOURCES)
+    if any(name not in LogReader.SOURCES for name in sources):
+        return jsonify({"success": False, "message": "未知的日志来源"}), 400
+    try:
+        pattern = re.compile(request.args.get('q', ''), re.IGNORECASE)
+        since = parse_time_arg(request.args.get('since'))
+        until = parse_time_arg(request.args.get('until'))
+        limit = max(1, min(int(request.args.get('limit', 200)), LogReader.MAX_LINES))
+    except re.error as e:
+        return jsonify({"success": False, "message": f"无效的正则表达式: {e}"}), 400
+    except ValueError as e:
+        return jsonify({"success": False, "message": f"参数错误: {e}"}), 400
+    
+    try:
+        return jsonify({"success": True, "data": log_archive.search(sources, pattern, since, until, limit)})
+    except Exception as e:
+        logger.error(f"搜索日志失败: {e}")
+        return jsonify({"success": False, "message": str(e)}), 500
+
+@app.route('/api/logs/archives')
+@require_auth
+def api_log_archives():
+    """列出日志归档片段"""
+    segments = log_archive.list_segments()
+    return jsonify({"success": True, "data": {
+        "segments": segments,
+        "total_bytes": sum(segment["bytes"] for segment in segments),
+        "settings": log_archive.settings()
+    }})
+
+@app.route('/api/logs/rotate', methods=['POST'])
+@require_auth
+def api_rotate_logs():
+    """立即轮转日志"""
+    try:
+        rotated = []
+        for source in LogReader.SOURCES:
+            segment = log_archive.rotate(source, force=True)
+            if segment:
+                rotated.append(segment["file"])
+        return jsonify({"success": True, "message": f"已轮转 {len(rotated)} 个日志文件", "data": rotated})
+    except Exception as e:
+        logger.error(f"轮转日志失败: {e}")
+        return jsonify({"success": False, "message": str(e)}), 500
+
+@app.route('/api/system/persistence')
+@require_auth
+def api_persistence_metrics():
+    """获取持久化写入统计"""
+    return jsonify({"success": True, "data": persistence_writer.get_metrics()})
+
+@app.route('/api/system/dns')
+@require_auth
+def api_dns_cache():
+    """获取节点域名解析缓存状态"""
+    return jsonify({"success": True, "data": dns_cache.get_state()})
+
+@app.route('/api/debug/slow')
+@require_auth
+def api_debug_slow_requests():
+    """最慢的请求及其分段耗时（本worker进程）"""
+    settings = tracing_settings()
+    return jsonify({"success": True, "data": {
+        "enabled": settings["enabled"],
+        "pid": os.getpid(),
+        "requests": tracer.get_slowest()[:int(settings["slow_requests"])]
+    }})
+
+@app.route('/api/debug/slow', methods=['DELETE'])
+@require_auth
+def api_debug_clear_slow_requests():
+    tracer.clear()
+    return jsonify({"success": True, "message": "已清空慢请求记录"})
+
+@app.route('/api/debug/profile')
+@require_auth
+def api_debug_profile():
+    """采样分析，返回折叠栈文本（可用 flamegraph.pl 或 speedscope 生成火焰图）"""
+    if not tracing_settings()["profiler"]:
+        return jsonify({"success": False, "message": "采样分析未启用（tracing.profiler）"}), 403
+    try:
+        seconds = min(max(float(request.args.get('seconds', 10)), 0.1), 60)
+        interval = min(max(float(request.args.get('interval', 0.01)), 0.001), 1)
+    except ValueError:
+        return jsonify({"success": False, "message": "参数错误"}), 400
+    
+    result = sampling_profiler.profile(seconds, interval)
+    if result is None:
+        return jsonify({"success": False, "message": "已有采样分析正在进行"}), 409
+    stacks, samples = result
+    return Response(stacks, mimetype='text/plain', headers={"X-Profile-Samples": str(samples)})
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Prometheus 指标（不使用JWT：配置token时校验Bearer token，否则默认只允许本机抓取）"""
+    settings = dict(DEFAULT_CONFIG["metrics"], **hysteria_manager.config.get("metrics", {}))
+    if not settings["enabled"]:
+        return jsonify({"success": False, "message": "指标接口未启用"}), 404
+    if settings["token"]:
+        auth_header = request.headers.get('Authorization', '')
+        if not hmac.compare_digest(auth_header.encode(), f"Bearer {settings['token']}".encode()):
+            return jsonify({"success": False, "message": "指标token无效"}), 401
+    elif not settings["allow_remote"]:
+        address = ipaddress.ip_address(request.remote_addr or "0.0.0.0")
+        if getattr(address, "ipv4_mapped", None):
+            address = address.ipv4_mapped
+        if not address.is_loopback:
+            return jsonify({"success": False, "message": "仅允许本机抓取指标，远程抓取请配置 metrics.token"}), 403
+    
+    return Response(metrics_registry.render(shared_state.metrics_snapshots()),
+                    content_type="text/plain; version=0.0.4; charset=utf-8")
+
 @app.route('/api/system/optimize', methods=['POST'])
 @require_auth
 def api_optimize_system():
@@ -1056,47 +5948,104 @@ def api_get_config():
 def api_update_config():
     """更新配置"""
     data = request.get_json()
-    hysteria_manager.config.update(data)
-    save_json_file(CONFIG_FILE, hysteria_manager.config)
+    hysteria_manager.update_config(data)
     return jsonify({"success": True, "message": "配置已更新"})
 
+@app.route('/api/config/history')
+@require_auth
+def api_config_history():
+    """获取客户端配置历史与缓存统计"""
+    return jsonify({"success": True, "data": config_cache.get_state()})
+
+@app.route('/api/config/rollback', methods=['POST'])
+@require_auth
+def api_rollback_config():
+    """回滚客户端配置（后台任务）"""
+    key = (request.get_json(silent=True) or {}).get("key")
+    
+    def action():
+        success, message, switch = hysteria_manager.rollback_config(key)
+        return {"success": success, "message": message, "data": {"switch": switch}}, 200 if success else 400
+    return submit_service_job("回滚配置", action)
+
+def refresh_subscription_result(subscription_id: str, force: bool = False) -> Tuple[Dict[str, Any], int]:
+    """刷新订阅，返回 (响应内容, 状态码)"""
+    try:
+        result = subscription_manager.refresh(subscription_id, force=force)
+    except KeyError:
+        return {"success": False, "message": "订阅不存在"}, 404
+    except SubscriptionTooLarge as e:
+        logger.warning(f"刷新订阅失败: {e}")
+        return {"success": False, "message": str(e)}, 413
+    except Exception as e:
+        logger.error(f"刷新订阅失败: {e}")
+        return {"success": False, "message": str(e)}, 500
+    
+    result["subscription_id"] = subscription_id
+    if result["status"] != "updated":
+        return {"success": True, "message": "订阅内容未变化", "data": result}, 200
+    if result["added"] + result["updated"] + result["unchanged"] + result["kept"] == 0:
+        return {"success": False, "message": "未找到有效节点", "data": result}, 400
+    return {
+        "success": True,
+        "message": f"新增 {result['added']} 个节点，更新 {result['updated']} 个，删除 {result['removed']} 个",
+        "data": result
+    }, 200
+
+def submit_subscription_refresh(subscription_id: str, force: bool = False):
+    """提交订阅刷新任务，同一订阅同时只刷新一次"""
+    def run(job):
+        job.update(10, "正在下载订阅")
+        return refresh_subscription_result(subscription_id, force)
+    job, deduplicated = job_manager.submit("subscription", subscription_id, "刷新订阅", run)
+    return job_response(job, deduplicated, subscription_id=subscription_id)
+
 @app.route('/api/subscription', methods=['POST'])
+@app.route('/api/subscriptions', methods=['POST'])
 @require_auth
 def api_import_subscription():
-    """导入订阅"""
+    """导入订阅（创建订阅并在后台任务中立即刷新）"""
     data = request.get_json()
     url = data.get('url')
-    name = data.get('name', '未命名订阅')
     
     if not url:
         return jsonify({"success": False, "message": "订阅地址不能为空"}), 400
     
-    try:
-        # 获取订阅内容
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-        content = response.text
-        
-        # 解析订阅（假设每行一个节点链接）
-        nodes_added = 0
-        for line in content.split('\n'):
-            line = line.strip()
-            if line and (line.startswith('hy2://') or line.startswith('hysteria')):
-                success, _, _ = hysteria_manager.add_node({"url": line})
-                if success:
-                    nodes_added += 1
-        
-        if nodes_added > 0:
-            return jsonify({
-                "success": True,
-                "message": f"成功导入 {nodes_added} 个节点"
-            })
-        else:
-            return jsonify({"success": False, "message": "未找到有效节点"}), 400
-            
-    except Exception as e:
-        logger.error(f"导入订阅失败: {e}")
-        return jsonify({"success": False, "message": str(e)}), 500
+    subscription = subscription_manager.add(url, data.get('name'), data.get('interval'))
+    return submit_subscription_refresh(subscription["id"], force=True)
+
+@app.route('/api/subscriptions')
+@require_auth
+def api_get_subscriptions():
+    """获取订阅列表"""
+    return jsonify({"success": True, "data": subscription_manager.list_subscriptions()})
+
+@app.route('/api/subscriptions/<subscription_id>', methods=['PUT'])
+@require_auth
+def api_update_subscription(subscription_id):
+    """更新订阅名称、地址、刷新间隔或启用状态"""
+    subscription = subscription_manager.update(subscription_id, request.get_json() or {})
+    if subscription is None:
+        return jsonify({"success": False, "message": "订阅不存在"}), 404
+    return jsonify({"success": True, "message": "订阅已更新", "data": subscription})
+
+@app.route('/api/subscriptions/<subscription_id>', methods=['DELETE'])
+@require_auth
+def api_delete_subscription(subscription_id):
+    """删除订阅（?keep_nodes=1 保留其节点）"""
+    keep_nodes = request.args.get('keep_nodes', '0') in ('1', 'true')
+    if not subscription_manager.delete(subscription_id, keep_nodes):
+        return jsonify({"success": False, "message": "订阅不存在"}), 404
+    return jsonify({"success": True, "message": "订阅已删除"})
+
+@app.route('/api/subscriptions/<subscription_id>/refresh', methods=['POST'])
+@require_auth
+def api_refresh_subscription(subscription_id):
+    """立即刷新订阅（后台任务；?force=1 忽略缓存校验）"""
+    if subscription_manager.get(subscription_id) is None:
+        return jsonify({"success": False, "message": "订阅不存在"}), 404
+    force = request.args.get('force', '0') in ('1', 'true')
+    return submit_subscription_refresh(subscription_id, force=force)
 
 @app.route('/api/export/config')
 @require_auth
@@ -1105,7 +6054,10 @@ def api_export_config():
     config_data = {
         "version": VERSION,
         "config": hysteria_manager.config,
-        "nodes": hysteria_manager.nodes,
+        "nodes": {
+            "nodes": hysteria_manager.get_nodes(),
+            "current": hysteria_manager.current_node_id
+        },
         "exported_at": datetime.now().isoformat()
     }
     
@@ -1130,13 +6082,12 @@ def api_import_config():
         
         # 导入配置
         if 'config' in import_data:
-            hysteria_manager.config = import_data['config']
-            save_json_file(CONFIG_FILE, hysteria_manager.config)
+            hysteria_manager.update_config(import_data['config'], replace=True)
         
         # 导入节点
         if 'nodes' in import_data:
-            hysteria_manager.nodes = import_data['nodes']
-            save_json_file(NODES_FILE, hysteria_manager.nodes)
+            storage.replace_nodes(import_data['nodes'].get('nodes', []),
+                                  import_data['nodes'].get('current'))
         
         logger.info("配置导入成功")
         return jsonify({"success": True, "message": "配置导入成功"})
@@ -1167,6 +6118,65 @@ def internal_error(error):
     return jsonify({"success": False, "message": "服务器内部错误"}), 500
 
 # ==================== 主程序 ====================
+def run_waitress(args):
+    """使用waitress运行（单进程多线程）"""
+    try:
+        from waitress import serve
+    except ImportError:
+        logger.error("未安装waitress，请执行: pip install waitress")
+        sys.exit(1)
+    
+    stream_limiter.threads = args.threads
+    shared_state.start()
+    logger.info(f"waitress: {args.threads} 线程，SSE连接上限 {stream_limiter.limit()}")
+    serve(app, host=args.host, port=args.port, threads=args.threads,
+          channel_timeout=300, ident="hysteria2-manager")
+
+def run_gunicorn(args):
+    """使用gunicorn运行（多进程，每个worker多线程）"""
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        logger.error("未安装gunicorn，请执行: pip install gunicorn")
+        sys.exit(1)
+    
+    workers = max(1, args.workers)
+    stream_limiter.threads = max(1, args.threads)
+    
+    def post_worker_init(worker):
+        # 后台线程必须在fork之后启动；多个worker通过SQLite与文件锁共享状态
+        shared_state.start(shared=workers > 1)
+    
+    def worker_exit(server, worker):
+        if shared_state.is_leader:
+            traffic_sampler.save()
+        persistence_writer.flush()
+        shared_state.publish_metrics()
+    
+    class ManagerApplication(BaseApplication):
+        def load_config(self):
+            options = {
+                "bind": f"{args.host}:{args.port}",
+                "workers": workers,
+                "threads": max(1, args.threads),
+                # gthread 下每个SSE连接占用一个线程，stream_limiter 保证至少一半线程留给普通请求；
+                # timeout 只约束worker心跳，不限制单个请求的时长
+                "worker_class": "gthread",
+                "timeout": 120,
+                "graceful_timeout": 5,
+                "post_worker_init": post_worker_init,
+                "worker_exit": worker_exit,
+                "proc_name": "hysteria2-manager"
+            }
+            for key, value in options.items():
+                self.cfg.set(key, value)
+        
+        def load(self):
+            return app
+    
+    logger.info(f"gunicorn: {workers} worker x {args.threads} 线程，每个worker SSE连接上限 {stream_limiter.limit()}")
+    ManagerApplication().run()
+
 def main():
     """主程序入口"""
     parser = argparse.ArgumentParser(description='Hysteria2 Manager v2.0')
@@ -1174,6 +6184,10 @@ def main():
     parser.add_argument('--host', default='0.0.0.0', help='监听地址')
     parser.add_argument('--debug', action='store_true', help='调试模式')
     parser.add_argument('--no-auth', action='store_true', help='禁用认证（不推荐）')
+    parser.add_argument('--server', choices=['werkzeug', 'gunicorn', 'waitress'], default='werkzeug',
+                        help='Web服务器：werkzeug为开发服务器，生产环境使用gunicorn或waitress')
+    parser.add_argument('--workers', type=int, default=1, help='gunicorn worker进程数')
+    parser.add_argument('--threads', type=int, default=8, help='每个worker的线程数')
     args = parser.parse_args()
     
     # 确保目录结构
@@ -1200,16 +6214,26 @@ def main():
     logger.info(f"认证状态: {'启用' if config['auth']['enabled'] else '禁用'}")
     logger.info("默认账号: admin / admin (首次登录后请修改)")
     
-    # 启动Flask应用
+    # 启动Web服务
     try:
-        app.run(
-            host=args.host,
-            port=args.port,
-            debug=args.debug,
-            use_reloader=False
-        )
+        if args.server == 'gunicorn':
+            run_gunicorn(args)
+        elif args.server == 'waitress':
+            run_waitress(args)
+        else:
+            # 后台流量采样、状态采集、故障切换与订阅刷新调度
+            shared_state.start()
+            app.run(
+                host=args.host,
+                port=args.port,
+                debug=args.debug,
+                use_reloader=False,
+                threaded=True
+            )
     except KeyboardInterrupt:
         logger.info("\n正在关闭...")
+        if shared_state.is_leader:
+            traffic_sampler.save()
     except Exception as e:
         logger.error(f"启动失败: {e}")
         sys.exit(1)
@@ -310,6 +310,9 @@ bcrypt==4.1.2
 psutil==5.9.8
 PyYAML==6.0.1
 requests==2.31.0
+gunicorn==21.2.0
+waitress==3.0.0
+jeepney==0.8.0
 EOF
     
     pip install -r /tmp/requirements.txt -q
@@ -495,7 +498,7 @@ WorkingDirectory=$INSTALL_DIR
 Environment="PATH=$INSTALL_DIR/venv/bin:/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin"
 Environment="PYTHONPATH=$INSTALL_DIR"
 ExecStartPre=/bin/bash -c 'if [ ! -f $DATA_DIR/config.json ]; then exit 1; fi'
-ExecStart=$INSTALL_DIR/venv/bin/python $INSTALL_DIR/hysteria2_manager.py
+ExecStart=$INSTALL_DIR/venv/bin/python $INSTALL_DIR/hysteria2_manager.py --server gunicorn --workers 2 --threads 8
 Restart=always
 RestartSec=10
 StandardOutput=journal
@@ -524,7 +527,7 @@ User=root
 Group=root
 WorkingDirectory=$CONFIG_DIR
 ExecStartPre=-/usr/sbin/ip link delete hytun 2>/dev/null
-ExecStartPre=/bin/sleep 2
+ExecStartPre=/bin/bash -c 'timeout 2 sh -c "until ip route show default | grep -q .; do sleep 0.1; done" || true'
 ExecStart=$HYSTERIA_BIN client -c $CONFIG_DIR/client.yaml
 ExecStopPost=-/usr/sbin/ip link delete hytun 2>/dev/null
 Restart=on-failure
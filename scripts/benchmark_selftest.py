@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Hysteria2 Manager 节点测速离线自测
+
+在本机启动替身服务，不依赖外网与真实节点，验证 NodeBenchmark 的测速结果：
+- UDP 应答服务：对每个探测包回复一个数据包，用于 rtt / loss
+- HTTP 下载服务：返回固定大小的内容，用于 throughput
+- 替身 hysteria 客户端：按生成的配置在 socks5.listen 上提供 SOCKS5 转发
+
+管理器模块在临时目录中运行，不触碰正在使用的数据。任一断言失败时以非零状态退出。
+
+用法:
+    python3 scripts/benchmark_selftest.py
+    python3 scripts/benchmark_selftest.py --download-bytes 20000000
+"""
+
+import os
+import sys
+import shutil
+import socket
+import argparse
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 替身 hysteria 客户端：hysteria client -c <config>，只实现 SOCKS5 无认证 CONNECT
+STAND_IN_CLIENT = r'''
+import sys, socket, struct, threading, yaml
+
+config = yaml.safe_load(open(sys.argv[sys.argv.index("-c") + 1]))
+host, port = config["socks5"]["listen"].rsplit(":", 1)
+
+
+def pipe(src, dst):
+    try:
+        while True:
+            data = src.recv(65536)
+            if not data:
+                break
+            dst.sendall(data)
+    except OSError:
+        pass
+    finally:
+        dst.close()
+
+
+def recv_exact(conn, size):
+    data = b""
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            raise OSError("连接已关闭")
+        data += chunk
+    return data
+
+
+def handle(conn):
+    try:
+        _, methods = recv_exact(conn, 2)
+        recv_exact(conn, methods)
+        conn.sendall(b"\x05\x00")
+        _, _, _, atyp = recv_exact(conn, 4)
+        if atyp == 1:
+            target = socket.inet_ntoa(recv_exact(conn, 4))
+        elif atyp == 3:
+            target = recv_exact(conn, recv_exact(conn, 1)[0]).decode()
+        else:
+            target = socket.inet_ntop(socket.AF_INET6, recv_exact(conn, 16))
+        target_port, = struct.unpack("!H", recv_exact(conn, 2))
+        upstream = socket.create_connection((target, target_port), timeout=5)
+        conn.sendall(b"\x05\x00\x00\x01" + socket.inet_aton("0.0.0.0") + b"\x00\x00")
+        threading.Thread(target=pipe, args=(upstream, conn), daemon=True).start()
+        pipe(conn, upstream)
+    except OSError:
+        conn.close()
+
+
+server = socket.socket()
+server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+server.bind((host, int(port)))
+server.listen(16)
+while True:
+    client, _ = server.accept()
+    threading.Thread(target=handle, args=(client,), daemon=True).start()
+'''
+
+
+def start_udp_responder():
+    """对每个数据包回复一个数据包，返回端口"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+
+    def serve():
+        while True:
+            _, address = sock.recvfrom(4096)
+            sock.sendto(b"\x00" * 32, address)
+
+    threading.Thread(target=serve, daemon=True).start()
+    return sock.getsockname()[1]
+
+
+def start_download_server(size):
+    """返回 size 字节内容的HTTP服务，返回端口"""
+    chunk = b"\x00" * 65536
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Length", str(size))
+            self.end_headers()
+            remaining = size
+            while remaining > 0:
+                self.wfile.write(chunk[:min(remaining, len(chunk))])
+                remaining -= len(chunk)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server.server_address[1]
+
+
+def closed_udp_port():
+    """获取一个当前没有监听的UDP端口"""
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def check(failures, condition, message):
+    print(f"{'通过' if condition else '失败'}: {message}")
+    if not condition:
+        failures.append(message)
+
+
+def run(module, workdir, args):
+    """对替身服务测速并检查结果，返回失败项"""
+    client_path = os.path.join(workdir, "hysteria")
+    with open(client_path, "w") as f:
+        f.write(f"#!{sys.executable}\n{STAND_IN_CLIENT}")
+    os.chmod(client_path, 0o755)
+
+    udp_port = start_udp_responder()
+    http_port = start_download_server(args.download_bytes)
+    module.hysteria_manager.update_config({
+        "hysteria": dict(module.hysteria_manager.config.get("hysteria", {}), bin_path=client_path),
+        "benchmark": dict(module.DEFAULT_CONFIG["benchmark"], samples=args.samples, timeout=0.5,
+                          download_url=f"http://127.0.0.1:{http_port}/download", download_timeout=10,
+                          bind_interface="")
+    })
+
+    benchmark = module.NodeBenchmark(module.hysteria_manager)
+    alive = {"id": "selftest-alive", "name": "alive", "server": "127.0.0.1", "port": udp_port, "password": "x"}
+    dead = {"id": "selftest-dead", "name": "dead", "server": "127.0.0.1", "port": closed_udp_port(), "password": "x"}
+    results = benchmark.benchmark_nodes([alive, dead], full=True)
+
+    failures = []
+    good, bad = results[alive["id"]], results[dead["id"]]
+    print(f"应答节点: rtt_p50={good['rtt_p50']} ms rtt_p95={good['rtt_p95']} ms loss={good['loss']} "
+          f"throughput={good['throughput_mbps']} Mbps")
+    print(f"无应答节点: rtt_p50={bad['rtt_p50']} loss={bad['loss']} throughput={bad['throughput_mbps']}")
+
+    check(failures, good["samples"] == args.samples, f"应答节点发送 {args.samples} 个探测包")
+    check(failures, good["loss"] == 0, "应答节点无丢包")
+    check(failures, good["rtt_p50"] is not None and 0 <= good["rtt_p50"] <= good["rtt_p95"] < 500,
+          "应答节点 0 <= rtt_p50 <= rtt_p95 < 500ms")
+    check(failures, good["rtt_min"] is not None and good["rtt_min"] <= good["rtt_p50"], "rtt_min 不大于 rtt_p50")
+    check(failures, good.get("download", {}).get("bytes") == args.download_bytes,
+          f"经替身客户端下载 {args.download_bytes} 字节")
+    check(failures, (good["throughput_mbps"] or 0) > 0, "吞吐量大于 0")
+    check(failures, bad["loss"] == 1.0 and bad["rtt_p50"] is None, "无应答节点 loss=1 且没有 rtt")
+    check(failures, bad["throughput_mbps"] is None, "无应答节点不做下载测速")
+    check(failures, len(benchmark.get_history(alive["id"])) == 1, "测速结果写入历史")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Hysteria2 Manager 节点测速离线自测')
+    parser.add_argument('--module-dir', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'),
+                        help='hysteria2_manager.py 所在目录')
+    parser.add_argument('--samples', type=int, default=5, help='UDP探测次数')
+    parser.add_argument('--download-bytes', type=int, default=5_000_000, help='下载测速的内容大小')
+    args = parser.parse_args()
+
+    # 导入管理器模块会初始化数据库与日志，指向临时目录
+    workdir = tempfile.mkdtemp(prefix='hy2-benchmark-selftest-')
+    os.environ['HY2_MANAGER_BASE_DIR'] = workdir
+    os.environ['HY2_MANAGER_DATA_DIR'] = os.path.join(workdir, 'data')
+    os.environ['HY2_MANAGER_LOG_DIR'] = os.path.join(workdir, 'log')
+    os.environ['HY2_MANAGER_CLIENT_CONFIG'] = os.path.join(workdir, 'client.yaml')
+    sys.path.insert(0, os.path.abspath(args.module_dir))
+    try:
+        import hysteria2_manager
+        failures = run(hysteria2_manager, workdir, args)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if failures:
+        print(f"{len(failures)} 项检查失败")
+        sys.exit(1)
+    print("全部检查通过")
+
+
+if __name__ == '__main__':
+    main()
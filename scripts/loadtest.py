@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Hysteria2 Manager 压力测试脚本
+
+以固定并发持续请求API，统计吞吐量(req/s)与延迟分位数。
+用于对比开发服务器与 gunicorn / waitress 部署模式。
+
+用法:
+    python3 scripts/loadtest.py --url http://127.0.0.1:8080 --concurrency 32 --duration 20
+    python3 scripts/loadtest.py --paths /api/status /api/nodes "/api/test?timeout=2"
+"""
+
+import sys
+import time
+import math
+import argparse
+import threading
+from collections import defaultdict
+
+import requests
+
+DEFAULT_PATHS = ["/api/status", "/api/nodes", "/api/status", "/api/test?timeout=2"]
+
+
+def percentile(values, pct):
+    """计算百分位数（最近秩法）"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(pct / 100.0 * len(ordered)) - 1)]
+
+
+def login(url, username, password):
+    response = requests.post(f"{url}/api/login", json={"username": username, "password": password}, timeout=10)
+    response.raise_for_status()
+    return response.json()["data"]["token"]
+
+
+def worker(url, token, paths, deadline, offset, results, lock):
+    session = requests.Session()
+    session.headers["Authorization"] = f"Bearer {token}"
+    local = defaultdict(list)
+    errors = 0
+    index = offset
+
+    while time.monotonic() < deadline:
+        path = paths[index % len(paths)]
+        index += 1
+        started = time.monotonic()
+        try:
+            response = session.get(f"{url}{path}", timeout=30)
+            if response.status_code >= 500:
+                errors += 1
+        except requests.RequestException:
+            errors += 1
+        local[path].append((time.monotonic() - started) * 1000)
+
+    with lock:
+        for path, latencies in local.items():
+            results["latency"][path].extend(latencies)
+        results["errors"] += errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Hysteria2 Manager 压力测试')
+    parser.add_argument('--url', default='http://127.0.0.1:8080', help='管理器地址')
+    parser.add_argument('--username', default='admin')
+    parser.add_argument('--password', default='admin')
+    parser.add_argument('--concurrency', type=int, default=32, help='并发连接数')
+    parser.add_argument('--duration', type=float, default=20, help='测试时长(秒)')
+    parser.add_argument('--paths', nargs='+', default=DEFAULT_PATHS, help='轮流请求的API路径')
+    args = parser.parse_args()
+
+    url = args.url.rstrip('/')
+    try:
+        token = login(url, args.username, args.password)
+    except Exception as e:
+        print(f"登录失败: {e}")
+        sys.exit(1)
+
+    results = {"latency": defaultdict(list), "errors": 0}
+    lock = threading.Lock()
+    started = time.monotonic()
+    deadline = started + args.duration
+    threads = [
+        threading.Thread(target=worker, args=(url, token, args.paths, deadline, i, results, lock))
+        for i in range(args.concurrency)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    all_latencies = [value for values in results["latency"].values() for value in values]
+    print(f"并发 {args.concurrency}，时长 {elapsed:.1f}s，请求 {len(all_latencies)}，错误 {results['errors']}")
+    print(f"{'路径':<28}{'请求数':>8}{'p50(ms)':>10}{'p99(ms)':>10}")
+    for path, latencies in sorted(results["latency"].items()):
+        print(f"{path:<28}{len(latencies):>8}{percentile(latencies, 50):>10.1f}{percentile(latencies, 99):>10.1f}")
+    print(f"{'合计':<28}{len(all_latencies):>8}{percentile(all_latencies, 50):>10.1f}"
+          f"{percentile(all_latencies, 99):>10.1f}")
+    print(f"吞吐量: {len(all_latencies) / elapsed:.1f} req/s")
+
+
+if __name__ == '__main__':
+    main()
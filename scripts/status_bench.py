@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Hysteria2 Manager 状态查询基准测试
+
+对比服务状态与TUN网卡检测各后端（D-Bus、cgroup、sysfs）与调用 systemctl / ip 子进程的耗时。
+需要在管理器所在主机上运行，并使用与管理器相同的 Python 环境（D-Bus 后端需要 jeepney）。
+
+用法:
+    sudo /opt/hysteria2-manager/venv/bin/python3 scripts/status_bench.py --iterations 200
+    python3 scripts/status_bench.py --module-dir /opt/hysteria2-manager --unit hysteria2-client.service
+"""
+
+import os
+import sys
+import time
+import math
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+
+def percentile(values, pct):
+    """计算百分位数（最近秩法）"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(pct / 100.0 * len(ordered)) - 1)]
+
+
+def measure(func, iterations):
+    """预热后重复调用 func，返回 (最后一次结果, 各次耗时ms)"""
+    for _ in range(3):
+        result = func()
+    latencies = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        result = func()
+        latencies.append((time.perf_counter() - started) * 1000)
+    return result, latencies
+
+
+def run(SystemStatus, args):
+    """依次测量各后端"""
+    status = SystemStatus(lambda: "auto")
+    unit = args.unit
+    cases = [
+        ("unit: D-Bus", lambda: status.dbus_active(unit)),
+        ("unit: cgroup", lambda: status.cgroup_active(unit)),
+        ("unit: systemctl is-active", lambda: subprocess.run(
+            ["systemctl", "is-active", unit], capture_output=True, text=True).stdout.strip() == "active"),
+        ("tun: /sys/class/net", lambda: status.interface_exists(args.interface)),
+        ("tun: ip link show", lambda: subprocess.run(
+            ["ip", "link", "show", args.interface], capture_output=True).returncode == 0),
+    ]
+
+    print(f"单元 {unit}，网卡 {args.interface}，每项 {args.iterations} 次")
+    print(f"{'方式':<30}{'结果':>8}{'mean(ms)':>10}{'p50(ms)':>10}{'p99(ms)':>10}")
+    for name, func in cases:
+        try:
+            result, latencies = measure(func, args.iterations)
+        except Exception as e:
+            print(f"{name:<30}  不可用: {e}")
+            continue
+        if result is None:
+            print(f"{name:<30}  不可用")
+            continue
+        mean = sum(latencies) / len(latencies)
+        print(f"{name:<30}{str(result):>8}{mean:>10.3f}{percentile(latencies, 50):>10.3f}"
+              f"{percentile(latencies, 99):>10.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Hysteria2 Manager 状态查询基准测试')
+    parser.add_argument('--module-dir', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'),
+                        help='hysteria2_manager.py 所在目录')
+    parser.add_argument('--unit', default='hysteria2-client.service', help='systemd 单元')
+    parser.add_argument('--interface', default='hytun', help='网卡名')
+    parser.add_argument('--iterations', type=int, default=200, help='每个后端的调用次数')
+    args = parser.parse_args()
+
+    # 导入管理器模块会初始化数据库与日志，指向临时目录，不触碰正在使用的数据
+    workdir = tempfile.mkdtemp(prefix='hy2-status-bench-')
+    os.environ['HY2_MANAGER_BASE_DIR'] = workdir
+    os.environ['HY2_MANAGER_DATA_DIR'] = os.path.join(workdir, 'data')
+    os.environ['HY2_MANAGER_LOG_DIR'] = os.path.join(workdir, 'log')
+    os.environ['HY2_MANAGER_CLIENT_CONFIG'] = os.path.join(workdir, 'client.yaml')
+    sys.path.insert(0, os.path.abspath(args.module_dir))
+    try:
+        from hysteria2_manager import SystemStatus
+        run(SystemStatus, args)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()